@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021 National Institute of Information and Communication Technology (Raj Dabre)
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the
+# Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute,
+# sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+# The above copyright notice and this permission notice shall
+# be included in all copies or substantial portions of the
+# Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY
+# KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+# WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+# PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS
+# OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+## Basic imports
+import os
+import sys
+import argparse
+import subprocess
+import time
+##
+
+def run_benchmark():
+    parser = argparse.ArgumentParser(description="Measures the CPU decoding throughput of decode_nmt.py for different numbers of processes. Every run uses --device cpu and --shard_decoding so the cores of the node are split among the processes and each process translates its own part of the test set. The times are wall clock times including loading the model in every process. All the unknown arguments (the model, tokenizer, languages, --test_src etc.) are passed on to decode_nmt.py. Example: python benchmark_cpu_decoding.py --process_counts 1 2 4 8 --model_path model.pure_model --tokenizer_name_or_path tokenizer --slang en --tlang hi --test_src test.en")
+    parser.add_argument('--process_counts', nargs='+', type=int, default=[1, 2, 4, 8], help='The numbers of decoding processes to try.')
+    parser.add_argument('--output_dir', default='cpu_decoding_benchmark', type=str, help='The directory for the translations of each run.')
+    parser.add_argument('--port', default='26023', type=str, help='The port for the process group.')
+    args, decode_args = parser.parse_known_args()
+    test_src = decode_args[decode_args.index("--test_src")+1]
+    num_lines = sum(1 for _ in open(test_src))
+    os.makedirs(args.output_dir, exist_ok=True)
+    results = []
+    for num_processes in args.process_counts:
+        test_tgt = os.path.join(args.output_dir, "translations."+str(num_processes))
+        command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "decode_nmt.py")] + decode_args + ["--device", "cpu", "--shard_decoding", "--gpus", str(num_processes), "--port", args.port, "--test_tgt", test_tgt]
+        print("Running:", " ".join(command))
+        start = time.time()
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+        elapsed = time.time()-start
+        results.append((num_processes, elapsed))
+        print(num_processes, "processes translated", num_lines, "lines in", round(elapsed, 2), "seconds.")
+    print("Processes\tSeconds\tLines per second\tSpeedup")
+    for num_processes, elapsed in results:
+        print(num_processes, round(elapsed, 2), round(num_lines/elapsed, 2), round(results[0][1]/elapsed, 2), sep="\t")
+
+if __name__ == "__main__":
+    run_benchmark()
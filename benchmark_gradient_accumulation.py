@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021 National Institute of Information and Communication Technology (Raj Dabre)
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the
+# Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute,
+# sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+# The above copyright notice and this permission notice shall
+# be included in all copies or substantial portions of the
+# Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY
+# KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+# WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+# PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS
+# OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+## Basic imports
+import os
+import argparse
+import time
+##
+
+## Huggingface imports
+from transformers import MBartForConditionalGeneration, MBartConfig
+##
+
+## Pytorch imports
+import torch
+import torch.multiprocessing as mp
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+##
+
+## Our imports
+from common_utils import *
+##
+
+def run_steps(model, optimizer, args, gpu, synchronize_every_batch):
+    """Runs args.steps optimizer steps of args.multistep_optimizer_steps batches of random token ids each and returns the average time per optimizer step. Either every backward pass all-reduces the gradients or only the last one of each optimizer step does, like in the training scripts."""
+    input_ids = torch.randint(5, args.vocab_size, (args.batch_size, args.length)).to(gpu)
+    labels = torch.randint(5, args.vocab_size, (args.batch_size, args.length)).to(gpu)
+    for step in range(args.warmup_steps + args.steps):
+        if step == args.warmup_steps:
+            torch.cuda.synchronize(gpu)
+            start = time.time()
+        optimizer.zero_grad(set_to_none=True)
+        for batch_idx in range(args.multistep_optimizer_steps):
+            set_gradient_synchronization(model, synchronize_every_batch or batch_idx == args.multistep_optimizer_steps - 1)
+            lprobs = torch.nn.functional.log_softmax(model(input_ids=input_ids, decoder_input_ids=labels).logits, dim=-1)
+            loss = label_smoothed_nll_loss(lprobs, labels, 0.1, ignore_index=0)/args.multistep_optimizer_steps
+            loss.backward()
+        optimizer.step()
+    torch.cuda.synchronize(gpu)
+    return (time.time()-start)/args.steps
+
+def time_all_reduce(num_elements, args, gpu):
+    """Returns the average time of the all-reduce of a float32 buffer with the given number of elements which is about what DDP communicates in one synchronized backward pass."""
+    buffer = torch.ones(num_elements, dtype=torch.float32).to(gpu)
+    for _ in range(args.warmup_steps):
+        dist.all_reduce(buffer)
+    torch.cuda.synchronize(gpu)
+    start = time.time()
+    for _ in range(args.steps):
+        dist.all_reduce(buffer)
+    torch.cuda.synchronize(gpu)
+    return (time.time()-start)/args.steps
+
+def benchmark(gpu, args):
+    rank = args.nr * args.gpus + gpu
+    dist.init_process_group(backend='nccl', init_method='env://', world_size=args.world_size, rank=rank)
+    torch.cuda.set_device(gpu)
+    config = MBartConfig(vocab_size=args.vocab_size, encoder_layers=args.layers, decoder_layers=args.layers, d_model=args.d_model, encoder_ffn_dim=4*args.d_model, decoder_ffn_dim=4*args.d_model, encoder_attention_heads=args.d_model//64, decoder_attention_heads=args.d_model//64, dropout=0.1, pad_token_id=0, eos_token_id=2, bos_token_id=1)
+    model = MBartForConditionalGeneration(config)
+    model.cuda(gpu)
+    model.train()
+    model = DistributedDataParallel(model, device_ids=[gpu], output_device=gpu)
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-5)
+    num_elements = sum(param.numel() for param in model.parameters() if param.requires_grad)
+    gradient_gigabytes = num_elements*4/(1024**3)
+    all_reduce_time = time_all_reduce(num_elements, args, gpu)
+    step_time_sync = run_steps(model, optimizer, args, gpu, True)
+    step_time_no_sync = run_steps(model, optimizer, args, gpu, False)
+    if rank == 0:
+        print("Gradients of", num_elements, "parameters:", round(gradient_gigabytes, 3), "GB per all-reduce which takes", round(all_reduce_time, 4), "seconds on", args.world_size, "GPUs.")
+        print("All-reduce on every batch:", args.multistep_optimizer_steps, "all-reduces or", round(args.multistep_optimizer_steps*gradient_gigabytes, 3), "GB (about", round(args.multistep_optimizer_steps*all_reduce_time, 4), "seconds) and", round(step_time_sync, 4), "seconds per optimizer step.")
+        print("All-reduce on the last batch only: 1 all-reduce or", round(gradient_gigabytes, 3), "GB (about", round(all_reduce_time, 4), "seconds) and", round(step_time_no_sync, 4), "seconds per optimizer step.")
+        print("Speedup per optimizer step:", round(step_time_sync/step_time_no_sync, 2))
+    dist.destroy_process_group()
+
+def run_benchmark():
+    parser = argparse.ArgumentParser(description="Measures the all-reduce volume and the time per optimizer step of gradient accumulation with and without skipping the gradient synchronization of all but the last batch of an optimizer step. Run it on the same nodes and GPUs as training to see what --multistep_optimizer_steps saves.")
+    parser.add_argument('-n', '--nodes', default=1, type=int, metavar='N')
+    parser.add_argument('-g', '--gpus', default=1, type=int, help='number of gpus per node')
+    parser.add_argument('-nr', '--nr', default=0, type=int, help='ranking within the nodes')
+    parser.add_argument('-a', '--ipaddr', default='localhost', type=str, help='IP address of the main node')
+    parser.add_argument('-p', '--port', default='26023', type=str, help='Port main node')
+    parser.add_argument('--multistep_optimizer_steps', default=4, type=int, help='How many batches are accumulated per optimizer step?')
+    parser.add_argument('--steps', default=20, type=int, help='How many optimizer steps should be timed?')
+    parser.add_argument('--warmup_steps', default=3, type=int, help='How many optimizer steps should be run before timing?')
+    parser.add_argument('--batch_size', default=16, type=int, help='Number of sentences per batch.')
+    parser.add_argument('--length', default=64, type=int, help='Number of tokens per sentence.')
+    parser.add_argument('--layers', default=6, type=int, help='Number of encoder and decoder layers.')
+    parser.add_argument('--d_model', default=512, type=int, help='The hidden size of the model.')
+    parser.add_argument('--vocab_size', default=32000, type=int, help='The vocabulary size of the model.')
+    args = parser.parse_args()
+    print("IP address is", args.ipaddr)
+    args.world_size = args.gpus * args.nodes
+    os.environ['MASTER_ADDR'] = args.ipaddr
+    os.environ['MASTER_PORT'] = args.port
+    mp.spawn(benchmark, nprocs=args.gpus, args=(args,))
+
+if __name__ == "__main__":
+    run_benchmark()
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021 National Institute of Information and Communication Technology (Raj Dabre)
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the
+# Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute,
+# sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+# The above copyright notice and this permission notice shall
+# be included in all copies or substantial portions of the
+# Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY
+# KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+# WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+# PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS
+# OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+## Basic imports
+import os
+import sys
+import re
+import argparse
+import subprocess
+##
+
+## Other imports
+import sacrebleu
+##
+
+def get_dev_pairs(args):
+    """Returns the (source language, target language) pairs to benchmark on. These are the given pairs or else all the pairs of the given languages whose dev files are in the data directory."""
+    if args.dev_pairs != "":
+        return [tuple(pair.split("-")) for pair in args.dev_pairs.split(",")]
+    languages = [lang for lang in args.languages.split(",") if os.path.exists(os.path.join(args.data_dir, "dev."+lang))]
+    return [(slang, tlang) for slang in languages for tlang in languages if slang != tlang]
+
+def run_decoding(decode_args, quantize, slang, tlang, test_tgt, args):
+    """Runs decode_nmt.py on the CPU with or without quantization on the dev set of a language pair and returns the number of translated lines and the decoding time which decode_nmt.py reports. Loading the model is not included in the time."""
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "decode_nmt.py")] + decode_args + ["--device", "cpu", "--gpus", "1", "--num_threads_per_process", str(args.num_threads), "--port", args.port, "--slang", slang, "--tlang", tlang, "--test_src", os.path.join(args.data_dir, "dev."+slang), "--test_tgt", test_tgt, "--quantize", quantize]
+    if quantize != "none" and args.quantized_model_path is not None:
+        command += ["--quantized_model_path", args.quantized_model_path]
+    print("Running:", " ".join(command))
+    output = subprocess.run(command, check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+    num_lines, seconds = re.findall(r"Translated (\d+) lines in ([0-9.]+) seconds", output)[-1]
+    return int(num_lines), float(seconds)
+
+def run_benchmark():
+    parser = argparse.ArgumentParser(description="Compares the BLEU score and the CPU decoding latency of a model with and without dynamic int8 quantization (--quantize dynamic_int8 of decode_nmt.py) on dev sets, by default on all the language pairs of the English, Hindi and Vietnamese dev sets in examples/data. All the runs use a single process with the same number of threads. All the unknown arguments (the model, tokenizer, --batch_size, --beam_size etc.) are passed on to decode_nmt.py except for the languages which are set for each pair. Use --batch_size 1 to measure the latency of single sentences as in the interface. Example: python benchmark_quantized_decoding.py --model_path model_deploy/pytorch_model.bin --tokenizer_name_or_path examples/tokenizers/albert-vienhi16k --dev_pairs hi-en --batch_size 1")
+    parser.add_argument('--data_dir', default='examples/data', type=str, help='The directory with the dev sets named dev.<language>. The lines of the dev sets of the different languages must be translations of each other.')
+    parser.add_argument('--languages', default='en,hi,vi', type=str, help='Comma separated languages whose dev sets are used if they are present in --data_dir. Every pair of these languages is benchmarked in both directions unless --dev_pairs is given.')
+    parser.add_argument('--dev_pairs', default='', type=str, help='Comma separated language pairs like hi-en to benchmark on instead of all the pairs of --languages. Use this if the model does not translate between all of them.')
+    parser.add_argument('--quantized_model_path', default=None, type=str, help='Passed on to decode_nmt.py so that the quantized model is saved there (or loaded if it exists). Use the deploy folder of the model to serve the quantized model with the interface.')
+    parser.add_argument('--num_threads', default=1, type=int, help='The number of CPU threads for decoding.')
+    parser.add_argument('--output_dir', default='quantized_decoding_benchmark', type=str, help='The directory for the translations of each run.')
+    parser.add_argument('--port', default='26023', type=str, help='The port for the process group.')
+    args, decode_args = parser.parse_known_args()
+    dev_pairs = get_dev_pairs(args)
+    assert len(dev_pairs) > 0, "No dev sets of the languages "+args.languages+" were found in "+args.data_dir+"."
+    os.makedirs(args.output_dir, exist_ok=True)
+    results = []
+    for slang, tlang in dev_pairs:
+        refs = [[line.strip() for line in open(os.path.join(args.data_dir, "dev."+tlang))]]
+        pair_results = []
+        for quantize in ["none", "dynamic_int8"]:
+            test_tgt = os.path.join(args.output_dir, "translations."+slang+"-"+tlang+"."+quantize)
+            num_lines, seconds = run_decoding(decode_args, quantize, slang, tlang, test_tgt, args)
+            hyp = [line.strip() for line in open(test_tgt)]
+            bleu = sacrebleu.corpus_bleu(hyp, refs).score
+            pair_results.append((slang+"-"+tlang, quantize, bleu, seconds, num_lines, pair_results[0][3]/seconds if len(pair_results) > 0 else 1.0))
+            print("Quantization", quantize, "gives a BLEU score of", round(bleu, 2), "on", slang+"-"+tlang, "and translated", num_lines, "lines in", round(seconds, 2), "seconds.")
+        results.extend(pair_results)
+    print("Pair\tQuantization\tBLEU\tSeconds\tMilliseconds per line\tSpeedup")
+    for pair, quantize, bleu, seconds, num_lines, speedup in results:
+        print(pair, quantize, round(bleu, 2), round(seconds, 2), round(1000*seconds/num_lines, 2), round(speedup, 2), sep="\t")
+    if args.quantized_model_path is not None and os.path.exists(args.quantized_model_path):
+        print("The quantized model takes", round(os.path.getsize(args.quantized_model_path)/(1024**2), 2), "MB.")
+
+if __name__ == "__main__":
+    run_benchmark()
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021 National Institute of Information and Communication Technology (Raj Dabre)
+# 
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the
+# Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute,
+# sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+# The above copyright notice and this permission notice shall
+# be included in all copies or substantial portions of the
+# Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY
+# KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+# WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+# PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS
+# OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+## Basic imports
+import os
+import sys
+import argparse
+import math
+import time
+from array import array
+from multiprocessing import Pool
+##
+
+## Huggingface imports
+from transformers import MBartTokenizer, MBart50Tokenizer, BartTokenizer, AlbertTokenizer
+##
+
+## Other imports
+import numpy as np
+##
+
+def load_tokenizer(args):
+    """Loads the tokenizer exactly the way the training scripts do so that the token ids are compatible with them."""
+    if args.use_official_pretrained_tokenizer:
+        if "mbart" in args.pretrained_model or "IndicBART" in args.pretrained_model:
+            if "50" in args.pretrained_model:
+                tok = MBart50Tokenizer.from_pretrained(args.tokenizer_name_or_path, use_fast=False)
+            elif "IndicBART" in args.pretrained_model:
+                tok = AlbertTokenizer.from_pretrained(args.tokenizer_name_or_path, do_lower_case=False, use_fast=False, keep_accents=True)
+            else:
+                tok = MBartTokenizer.from_pretrained(args.tokenizer_name_or_path, use_fast=False)
+        else:
+            tok = BartTokenizer.from_pretrained(args.tokenizer_name_or_path, use_fast=False)
+    else:
+        if "albert" in args.tokenizer_name_or_path:
+            tok = AlbertTokenizer.from_pretrained(args.tokenizer_name_or_path, do_lower_case=False, use_fast=False, keep_accents=True)
+        elif "mbart" in args.tokenizer_name_or_path:
+            tok = MBartTokenizer.from_pretrained(args.tokenizer_name_or_path, do_lower_case=False, use_fast=False, keep_accents=True)
+    return tok
+
+def init_worker(args):
+    """Each worker process loads its own copy of the tokenizer."""
+    global tok
+    tok = load_tokenizer(args)
+
+def tokenize_lines(lines):
+    """Tokenizes a chunk of lines without adding any special tokens. Language indicator tokens, EOS tokens etc. are added by the batch generators."""
+    return [tok(line.strip(), add_special_tokens=False).input_ids for line in lines]
+
+def read_chunks(infile, chunk_size):
+    """Reads a file lazily in chunks of lines so that huge files never have to be loaded into memory."""
+    chunk = []
+    for line in infile:
+        chunk.append(line)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+class BinarizedCorpusWriter(object):
+    """Streams the token ids of a corpus (shard) to a raw temporary file while keeping track of the line offsets. On closing, the ids are copied into a .npy file so that the dtype is stored along with the data and the file can be memory mapped."""
+    def __init__(self, path, dtype):
+        self.ids_path, self.offsets_path = path+".ids.npy", path+".idx.npy"
+        self.tmp_path = self.ids_path+".tmp"
+        self.dtype = dtype
+        self.tmp_file = open(self.tmp_path, "wb")
+        self.offsets = array("q", [0])
+        
+    def add(self, ids):
+        self.tmp_file.write(np.asarray(ids, dtype=self.dtype).tobytes())
+        self.offsets.append(self.offsets[-1]+len(ids))
+    
+    def close(self):
+        self.tmp_file.close()
+        num_tokens = self.offsets[-1]
+        ids = np.lib.format.open_memmap(self.ids_path, mode="w+", dtype=self.dtype, shape=(num_tokens,))
+        copy_chunk_size = 1 << 26 ## Copy 64M tokens at a time.
+        with open(self.tmp_path, "rb") as tmp_file:
+            for start in range(0, num_tokens, copy_chunk_size):
+                chunk = np.fromfile(tmp_file, dtype=self.dtype, count=min(copy_chunk_size, num_tokens-start))
+                ids[start:start+len(chunk)] = chunk
+        ids.flush()
+        del ids
+        os.remove(self.tmp_path)
+        np.save(self.offsets_path, np.frombuffer(self.offsets, dtype=np.int64))
+        return len(self.offsets)-1, num_tokens
+
+def binarize_file(path, args, dtype, pool):
+    """Tokenizes a file and writes it in the binarized format. If the number of shards is specified then the lines are split across shards in the same way as the sharding functions in common_utils.py do for raw text."""
+    if args.num_shards > 0:
+        with open(path) as infile:
+            num_lines = sum(1 for _ in infile)
+        lines_per_shard = math.ceil(num_lines/args.num_shards)
+        print("The total number of lines are:", num_lines, "and number of lines per shard are:", lines_per_shard)
+        writers = [BinarizedCorpusWriter(path+"."+"%02d" % shard_id, dtype) for shard_id in range(args.num_shards)]
+    else:
+        lines_per_shard = None
+        writers = [BinarizedCorpusWriter(path, dtype)]
+    line_idx = 0
+    with open(path) as infile:
+        chunks = read_chunks(infile, args.chunk_size)
+        tokenized_chunks = pool.imap(tokenize_lines, chunks) if pool is not None else map(tokenize_lines, chunks)
+        for tokenized_chunk in tokenized_chunks:
+            for ids in tokenized_chunk:
+                writers[0 if lines_per_shard is None else line_idx // lines_per_shard].add(ids)
+                line_idx += 1
+            if line_idx % (args.chunk_size*100) == 0:
+                print("Binarized", line_idx, "lines")
+                sys.stdout.flush()
+    for writer in writers:
+        num_lines, num_tokens = writer.close()
+        print("Wrote", num_lines, "lines and", num_tokens, "tokens to", writer.ids_path, "and", writer.offsets_path)
+
+def run_binarization():
+    parser = argparse.ArgumentParser(description="Tokenizes corpora once and saves them as memory mappable token id arrays. Training with --use_binarized_corpora then reads batches directly from these arrays instead of tokenizing the raw text on the fly.")
+    parser.add_argument('--files', default='', type=str, 
+                        help='Comma separated list of files to binarize. These are the same files you would pass as --mono_src, --train_src or --train_tgt to the training scripts.')
+    parser.add_argument('--num_shards', default=0, type=int, 
+                        help='Should we shard the files while binarizing them? Set this to the world size (number of gpus times number of nodes) of the training run. This replaces --shard_files for binarized corpora. If 0 then the files are binarized as they are which is what you want if you have already sharded the files yourself in which case you should pass each shard in --files.')
+    parser.add_argument('--tokenizer_name_or_path', default='ai4bharat/indic-bert', type=str, 
+                        help='Name of or path to the tokenizer. This should be the same tokenizer that you use for training.')
+    parser.add_argument('--use_official_pretrained_tokenizer', action='store_true', 
+                        help='Use this flag if you want the official tokenizer of the pretrained model specified by --pretrained_model. Same as in the training scripts.')
+    parser.add_argument('--pretrained_model', default='', type=str, 
+                        help='Name of the official pretrained model whose tokenizer we use. Only needed with --use_official_pretrained_tokenizer.')
+    parser.add_argument('--num_workers', default=1, type=int, 
+                        help='How many processes should be used for tokenization?')
+    parser.add_argument('--chunk_size', default=10000, type=int, 
+                        help='How many lines should be given to a tokenization process at a time?')
+    args = parser.parse_args()
+    
+    tokenizer = load_tokenizer(args)
+    dtype = np.uint16 if len(tokenizer) <= 65536 else np.uint32 ## Most of our vocabularies fit in 16 bits which halves the disk and memory footprint.
+    print("Vocabulary size is", len(tokenizer), "so the token ids will be stored as", np.dtype(dtype).name)
+    pool = Pool(args.num_workers, initializer=init_worker, initargs=(args,)) if args.num_workers > 1 else None
+    if pool is None:
+        init_worker(args)
+    for path in args.files.strip().split(","):
+        print("Binarizing", path)
+        start = time.time()
+        binarize_file(path, args, dtype, pool)
+        print("Binarized", path, "in", round(time.time()-start, 2), "seconds")
+        sys.stdout.flush()
+    if pool is not None:
+        pool.close()
+        pool.join()
+    
+if __name__ == "__main__":
+    run_binarization()
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021 National Institute of Information and Communication Technology (Raj Dabre)
+# 
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the
+# Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute,
+# sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+# The above copyright notice and this permission notice shall
+# be included in all copies or substantial portions of the
+# Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY
+# KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+# WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+# PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS
+# OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+## Basic imports
+import argparse
+import random
+import sys
+##
+
+## Our imports
+from common_utils import *
+from binarize_corpus import load_tokenizer
+##
+
+## Other imports
+import numpy as np
+##
+
+def batch_generator(tok, args, files, seed, tokenize_once):
+    """Returns the monolingual denoising or bilingual batch generator with the RNGs seeded so that both pipelines sample the same sentences and masks."""
+    random.seed(seed)
+    np.random.seed(seed)
+    args = argparse.Namespace(**vars(args)) ## The generators read the flags lazily so each one needs its own copy.
+    args.tokenize_once = tokenize_once
+    if args.mono:
+        return generate_batches_monolingual_masked(tok, args, files, 0)
+    return generate_batches_bilingual(tok, args, files, 0)
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Checks that --tokenize_once produces the same batches as the text based batch generators for a given tokenizer and corpus. Use a small corpus since the text based path is slow.")
+    parser.add_argument('--tokenizer_name_or_path', default='ai4bharat/indic-bert', type=str, help='Name of or path to the tokenizer.')
+    parser.add_argument('--use_official_pretrained', action='store_true', help='Are we checking the tokenizer of an official pretrained model? Use it with --pretrained_model.')
+    parser.add_argument('--pretrained_model', default='', type=str, help='Name of the official pretrained model such as facebook/bart-base or facebook/mbart-large-cc25.')
+    parser.add_argument('--mono', action='store_true', help='Should we check the monolingual denoising batches instead of the bilingual ones? Only --src and --slang are used then.')
+    parser.add_argument('--src', default='', type=str, help='Source (or monolingual) file.')
+    parser.add_argument('--tgt', default='', type=str, help='Target file.')
+    parser.add_argument('--slang', default='en', type=str, help='Source (or monolingual) language.')
+    parser.add_argument('--tlang', default='hi', type=str, help='Target language.')
+    parser.add_argument('--num_batches', default=100, type=int, help='How many batches should be compared?')
+    parser.add_argument('--batch_size', default=2048, type=int, help='Batch size in tokens.')
+    parser.add_argument('--max_length', default=100, type=int, help='Maximum number of words for denoising.')
+    parser.add_argument('--max_src_length', default=256, type=int, help='Maximum number of source words.')
+    parser.add_argument('--max_tgt_length', default=256, type=int, help='Maximum number of target words.')
+    parser.add_argument('--hard_truncate_length', default=1024, type=int, help='Maximum number of subwords. Sentences longer than this will likely differ because the text based path decodes and re-tokenizes them.')
+    parser.add_argument('--token_masking_lambda', default=3.5, type=float, help='The poisson lambda for span masking.')
+    parser.add_argument('--token_masking_probs_range', nargs='+', type=float, default=[0.3], help='The masking ratio or range.')
+    parser.add_argument('--seed', default=621311, type=int, help='Random seed.')
+    return parser
+
+def count_batch_mismatches(args):
+    """Generates batches with both pipelines and returns the number of batches which differ. The first difference in each such batch is printed."""
+    ## The flags which the batch generators expect but which we dont support changing here.
+    args.use_official_pretrained_tokenizer = args.use_official_pretrained
+    args.world_size = 1
+    args.virtual_sharding = True ## We read the files directly via a line index so that no shards need to be written.
+    args.use_binarized_corpora = False
+    args.tokenization_sampling = False
+    args.tokenization_nbest_list_size = 64
+    args.tokenization_alpha_or_dropout = 0.1
+    args.num_domains_for_domain_classifier = 1
+    args.sorted_batching = False
+    args.batch_size_indicates_lines = False
+    args.bucketed_batching = False ## The text based generators only batch in the order in which the examples are sampled.
+    args.pack_examples = False
+    args.language_homogeneous_batches = False
+    args.data_sampling_temperature = 1.0
+    args.is_document = False
+    args.document_level_sentence_delimiter = "</s>"
+    args.future_prediction = False
+    args.span_prediction = False
+    args.span_to_sentence_prediction = False
+    args.is_summarization = False
+    args.source_masking_for_bilingual = False
+    args.cross_distillation = False
+    args.multi_source = False
+    args.unify_encoder = False
+    
+    tok = load_tokenizer(args)
+    if args.mono:
+        build_line_index(args.src)
+        files = [(args.slang, args.src)]
+    else:
+        build_line_index(args.src)
+        build_line_index(args.tgt)
+        files = [(args.slang+"-"+args.tlang, (args.src, args.tgt))]
+    
+    text_batches = batch_generator(tok, args, files, args.seed, False)
+    text_rng_state = (random.getstate(), np.random.get_state())
+    id_batches = batch_generator(tok, args, files, args.seed, True)
+    id_rng_state = (random.getstate(), np.random.get_state())
+    num_mismatches = 0
+    names = ["input_ids", "input_masks", "decoder_input_ids", "labels"]
+    for batch_idx in range(args.num_batches):
+        random.setstate(text_rng_state[0]) ## Generators are lazy so each one needs its own RNG state.
+        np.random.set_state(text_rng_state[1])
+        text_batch = next(text_batches)
+        text_rng_state = (random.getstate(), np.random.get_state())
+        random.setstate(id_rng_state[0])
+        np.random.set_state(id_rng_state[1])
+        id_batch = next(id_batches)
+        id_rng_state = (random.getstate(), np.random.get_state())
+        for name, text_tensor, id_tensor in zip(names, text_batch, id_batch):
+            if text_tensor.size() != id_tensor.size() or not (text_tensor.long() == id_tensor.long()).all():
+                num_mismatches += 1
+                print("Batch", batch_idx, "differs in", name, "with sizes", tuple(text_tensor.size()), "and", tuple(id_tensor.size()))
+                for text_row, id_row in zip(text_tensor.tolist(), id_tensor.tolist()):
+                    if text_row != id_row:
+                        print("Text based:", tok.convert_ids_to_tokens(text_row))
+                        print("Tokenize once:", tok.convert_ids_to_tokens(id_row))
+                        break
+                break
+    print("Compared", args.num_batches, "batches.", num_mismatches, "of them differ.")
+    return num_mismatches
+
+def run_check():
+    args = get_parser().parse_args()
+    num_mismatches = count_batch_mismatches(args)
+    sys.exit(1 if num_mismatches > 0 else 0)
+
+if __name__ == "__main__":
+    run_check()
@@ -49,6 +49,8 @@ import torch.nn.functional as F
 
 ## Our imports
 from common_utils import *
+from span_masking import *
+from model_quantization import *
 ##
 
 ## Other imports
@@ -66,35 +68,58 @@ rcParams['font.sans-serif'] = ['Source Han Sans TW',
                                    "FreeSerif"  # fc-list :lang=hi family
                                    ]
 from copy import deepcopy
+import threading
+import queue
+import shutil
+import traceback
+from itertools import islice
+from array import array
+import json
+import hashlib
 ##
 
 ## Seed setting here
 torch.manual_seed(621311)
 ##
 
+foreach_autograd_supported = tuple(int(part) for part in torch.__version__.split(".")[:2]) >= (2, 1) ## The foreach kernels are differentiable from torch 2.1 onwards.
+
 
 class EWC(object):
-    def __init__(self, model, dataset, gpu, label_smoothing, ignore_index=None):
+    """Elastic weight consolidation. The means (the parameters the model starts from) and the diagonal Fisher coefficients (precisions) of all the trainable parameters are kept in one flat buffer each and the penalty sum(F*(p-mu)**2) is computed with foreach kernels on per parameter views into these buffers so that the parameters are never concatenated. The Fisher coefficients are loaded from fisher_cache_path if it exists and are saved there otherwise."""
+    def __init__(self, model, dataset, gpu, label_smoothing, ignore_index=None, fisher_cache_path=None):
 
         self.model = model
         self.dataset = dataset
 
-        self.params = {n: p for n, p in self.model.named_parameters() if p.requires_grad}
-        self._means = {}
+        self.param_names = [n for n, p in self.model.named_parameters() if p.requires_grad]
+        self.params = [p for n, p in self.model.named_parameters() if p.requires_grad]
         self.gpu = gpu
         self.label_smoothing = label_smoothing
         self.ignore_index = ignore_index
-        self._precision_matrices = self._diag_fisher()
-        
-        for n, p in deepcopy(self.params).items():
-            self._means[n] = torch.tensor(p.detach().cpu().numpy()).to(gpu)
-            self._means[n].requires_grad = False
+        self._means = self._flatten([p.detach() for p in self.params]).clone()
+        self._mean_views = self._unflatten(self._means)
+        if fisher_cache_path is not None and os.path.exists(fisher_cache_path):
+            print("Loading cached Fisher coefficients from", fisher_cache_path)
+            fisher_cache = torch.load(fisher_cache_path, map_location="cpu")
+            assert fisher_cache["names"] == self.param_names, "The cached Fisher coefficients are for different parameters."
+            self._precision_matrices = fisher_cache["fisher"].to(gpu)
+        else:
+            self._precision_matrices = self._diag_fisher()
+            if fisher_cache_path is not None and (not dist.is_initialized() or dist.get_rank() == 0): ## The gradients are averaged by DDP so every process has the same coefficients.
+                print("Saving the Fisher coefficients to", fisher_cache_path)
+                atomic_torch_save({"names": self.param_names, "fisher": self._precision_matrices.cpu()}, fisher_cache_path)
+        self._precision_scales = self._unflatten(self._precision_matrices.sqrt()) ## sum(F*(p-mu)**2) is the squared L2 norm of sqrt(F)*(p-mu).
+
+    def _flatten(self, tensors):
+        return torch.cat([tensor.reshape(-1) for tensor in tensors]).to(self.gpu)
+
+    def _unflatten(self, flat_buffer):
+        """Returns views into a flat buffer shaped like the parameters."""
+        return [view.view_as(p) for view, p in zip(flat_buffer.split([p.numel() for p in self.params]), self.params)]
 
     def _diag_fisher(self):
-        precision_matrices = {}
-        for n, p in deepcopy(self.params).items():
-            p.data.zero_()
-            precision_matrices[n] = torch.tensor(p.detach().cpu().numpy()).to(self.gpu)            
+        precision_matrices = torch.zeros_like(self._means)
 
         self.model.eval()
         num_samples = 0
@@ -110,30 +135,31 @@ class EWC(object):
             loss = label_smoothed_nll_loss(lprobs, labels, self.label_smoothing, self.ignore_index)
             loss.backward()
             loss.detach()
-
-            for n, p in self.model.named_parameters():
-                if p.requires_grad:
-                    precision_matrices[n].data += p.grad.data ** 2
+            precision_matrices += self._flatten([p.grad if p.grad is not None else torch.zeros_like(p) for p in self.params]) ** 2
         
-        for n, p in self.model.named_parameters():
-            if p.requires_grad:
-                precision_matrices[n].data = precision_matrices[n].data / num_samples
-        
-        precision_matrices = {n: p for n, p in precision_matrices.items()}
-        for n, p in precision_matrices.items():
-            precision_matrices[n].requires_grad = False
+        precision_matrices /= num_samples
         
         self.model.zero_grad(set_to_none=True)    
         self.model.train()
         return precision_matrices
 
     def penalty(self, model):
-        loss = 0
-        for n, p in model.named_parameters():
-            if p.requires_grad:
-                _loss = self._precision_matrices[n] * (p - self._means[n]) ** 2
-                loss += _loss.sum()
-        return loss
+        params = self.params if model is self.model else [p for n, p in model.named_parameters() if p.requires_grad]
+        if not foreach_autograd_supported: ## Older versions of torch cant differentiate the foreach kernels.
+            return sum(((p - mean) * scale).pow(2).sum() for p, mean, scale in zip(params, self._mean_views, self._precision_scales))
+        differences = torch._foreach_sub(params, self._mean_views) ## A few fused kernels over all the parameters instead of concatenating them into a new flat tensor every step.
+        torch._foreach_mul_(differences, self._precision_scales)
+        return torch.stack(torch._foreach_norm(differences)).pow(2).sum()
+
+def get_fisher_cache_path(model, files, args):
+    """Returns the path where the Fisher coefficients of EWC are cached or None if they should not be cached. The name is a hash of the checksums of the parameters the coefficients are computed for and of the data and flags that affect them, so cached coefficients are only reused for the same base checkpoint and setup."""
+    if args.ewc_fisher_cache_dir == "":
+        return None
+    os.makedirs(args.ewc_fisher_cache_dir, exist_ok=True)
+    fingerprint = hashlib.md5(compute_parameter_checksums(model).cpu().numpy().tobytes())
+    data_flags = ["token_masking_probs_range", "token_masking_lambda", "span_prediction", "span_to_sentence_prediction", "future_prediction", "source_masking_for_bilingual", "is_document", "document_level_sentence_delimiter", "max_length", "max_src_length", "max_tgt_length", "hard_truncate_length", "batch_size_indicates_lines", "pack_examples", "tokenization_sampling", "tokenizer_name_or_path"] ## The masking, length and truncation flags change the batches the coefficients are computed on. Some of them only exist in one of the training scripts.
+    fingerprint.update(repr([files, args.ewc_samples, args.label_smoothing, args.batch_size, args.world_size]+[vars(args).get(flag) for flag in data_flags]).encode())
+    return os.path.join(args.ewc_fisher_cache_dir, "fisher."+fingerprint.hexdigest()+".pt")
 
 def label_smoothed_nll_loss(lprobs, target, epsilon, ignore_index=None):
     """From fairseq. This returns the label smoothed cross entropy loss."""
@@ -164,6 +190,98 @@ def label_smoothed_nll_loss(lprobs, target, epsilon, ignore_index=None):
     loss = loss/denominator
     return loss
 
+class ChunkedLabelSmoothedCrossEntropy(torch.autograd.Function):
+    """Computes the LM head projection, the label smoothed cross entropy (same as label_smoothed_nll_loss with an ignore index) and optionally the softmax entropy (same as the entropy maximization code in the training scripts) a chunk of target tokens at a time. Only the log normalizers of the tokens are kept for the backward pass where the logits of each chunk are computed again. This means that the [batch, target length, vocabulary] logits and log probabilities are never materialized which matters a lot for large vocabularies."""
+    @staticmethod
+    @torch.cuda.amp.custom_fwd
+    def forward(ctx, hidden_states, weight, bias, target, epsilon, ignore_index, softmax_temperature, chunk_size, compute_entropy):
+        num_tokens = hidden_states.size(0)
+        vocab_size = weight.size(0)
+        pad_mask = target.eq(ignore_index)
+        nll_loss = hidden_states.new_zeros((), dtype=torch.float32)
+        smooth_loss = hidden_states.new_zeros((), dtype=torch.float32)
+        entropy = hidden_states.new_zeros((), dtype=torch.float32)
+        log_normalizers = []
+        raw_log_normalizers = []
+        entropies = []
+        for chunk_start in range(0, num_tokens, chunk_size):
+            chunk_end = min(chunk_start+chunk_size, num_tokens)
+            raw_logits = torch.nn.functional.linear(hidden_states[chunk_start:chunk_end], weight, bias).float()
+            logits = raw_logits/softmax_temperature
+            log_normalizer = torch.logsumexp(logits, dim=-1)
+            chunk_pad_mask = pad_mask[chunk_start:chunk_end]
+            chunk_nll_loss = log_normalizer - logits.gather(dim=-1, index=target[chunk_start:chunk_end].unsqueeze(-1)).squeeze(-1)
+            chunk_smooth_loss = vocab_size*log_normalizer - logits.sum(dim=-1)
+            nll_loss += chunk_nll_loss.masked_fill(chunk_pad_mask, 0.0).sum()
+            smooth_loss += chunk_smooth_loss.masked_fill(chunk_pad_mask, 0.0).sum()
+            log_normalizers.append(log_normalizer)
+            if compute_entropy: ## The entropy is computed on the untempered logits and includes the padding positions just like the original code.
+                raw_log_normalizer = torch.logsumexp(raw_logits, dim=-1) if softmax_temperature != 1.0 else log_normalizer
+                chunk_entropy = raw_log_normalizer - (torch.softmax(raw_logits, dim=-1)*raw_logits).sum(dim=-1)
+                entropy += chunk_entropy.sum()
+                raw_log_normalizers.append(raw_log_normalizer)
+                entropies.append(chunk_entropy)
+            del raw_logits, logits
+        denominator = (1.0 - 1.0*pad_mask.float()).sum()
+        loss = ((1.0 - epsilon)*nll_loss + (epsilon/vocab_size)*smooth_loss)/denominator
+        entropy = entropy/(num_tokens*vocab_size)
+        ctx.save_for_backward(hidden_states, weight, bias, target, torch.cat(log_normalizers), torch.cat(raw_log_normalizers) if compute_entropy else None, torch.cat(entropies) if compute_entropy else None, denominator)
+        ctx.epsilon = epsilon
+        ctx.ignore_index = ignore_index
+        ctx.softmax_temperature = softmax_temperature
+        ctx.chunk_size = chunk_size
+        ctx.compute_entropy = compute_entropy
+        return loss, entropy
+    
+    @staticmethod
+    @torch.cuda.amp.custom_bwd
+    def backward(ctx, grad_loss, grad_entropy):
+        hidden_states, weight, bias, target, log_normalizers, raw_log_normalizers, entropies, denominator = ctx.saved_tensors
+        num_tokens = hidden_states.size(0)
+        vocab_size = weight.size(0)
+        epsilon = ctx.epsilon
+        grad_hidden_states = torch.empty_like(hidden_states) if ctx.needs_input_grad[0] else None
+        grad_weight = torch.zeros_like(weight, dtype=torch.float32) if ctx.needs_input_grad[1] else None
+        grad_bias = torch.zeros_like(bias, dtype=torch.float32) if bias is not None and ctx.needs_input_grad[2] else None
+        loss_scale = grad_loss/(denominator*ctx.softmax_temperature) ## The gradient wrt the logits is divided by the temperature to get the gradient wrt the untempered logits.
+        for chunk_start in range(0, num_tokens, ctx.chunk_size):
+            chunk_end = min(chunk_start+ctx.chunk_size, num_tokens)
+            chunk_hidden_states = hidden_states[chunk_start:chunk_end]
+            raw_logits = torch.nn.functional.linear(chunk_hidden_states, weight, bias).float()
+            chunk_target = target[chunk_start:chunk_end]
+            ## d(loss)/d(logits) = softmax(logits) - (1-epsilon)*one_hot(target) - epsilon/vocab_size for the non padding tokens.
+            grad_logits = torch.exp(raw_logits/ctx.softmax_temperature - log_normalizers[chunk_start:chunk_end].unsqueeze(-1))
+            grad_logits -= epsilon/vocab_size
+            grad_logits.scatter_add_(-1, chunk_target.unsqueeze(-1), grad_logits.new_full((chunk_end-chunk_start, 1), -(1.0 - epsilon)))
+            grad_logits.masked_fill_(chunk_target.eq(ctx.ignore_index).unsqueeze(-1), 0.0)
+            grad_logits *= loss_scale
+            if ctx.compute_entropy: ## d(entropy)/d(logits) = -softmax(logits)*(log_softmax(logits) + entropy)
+                log_probs = raw_logits - raw_log_normalizers[chunk_start:chunk_end].unsqueeze(-1)
+                grad_logits -= (grad_entropy/(num_tokens*vocab_size))*torch.exp(log_probs)*(log_probs + entropies[chunk_start:chunk_end].unsqueeze(-1))
+                del log_probs
+            del raw_logits
+            grad_logits = grad_logits.to(chunk_hidden_states.dtype if grad_hidden_states is not None else weight.dtype)
+            if grad_hidden_states is not None:
+                grad_hidden_states[chunk_start:chunk_end] = torch.matmul(grad_logits, weight.to(grad_logits.dtype))
+            if grad_weight is not None:
+                grad_weight += torch.matmul(grad_logits.t(), chunk_hidden_states.to(grad_logits.dtype)).float()
+            if grad_bias is not None:
+                grad_bias += grad_logits.float().sum(dim=0)
+        return grad_hidden_states, grad_weight.to(weight.dtype) if grad_weight is not None else None, grad_bias.to(bias.dtype) if grad_bias is not None else None, None, None, None, None, None, None
+
+def chunked_label_smoothed_nll_loss(hidden_states, lm_head_weight, final_logits_bias, target, epsilon, ignore_index, softmax_temperature, chunk_size, compute_entropy=False):
+    """Memory lean replacement for log_softmax + label_smoothed_nll_loss (with an ignore index) on the logits of the LM head. The hidden states are the decoder outputs of shape [batch, target length, hidden size] which would be fed to the LM head. The logits are computed chunk_size tokens at a time in the forward and the backward passes. Returns the loss and the mean softmax entropy of the untempered logits (0 if compute_entropy is False)."""
+    hidden_size = hidden_states.size(-1)
+    bias = final_logits_bias.view(-1) if final_logits_bias is not None else None
+    return ChunkedLabelSmoothedCrossEntropy.apply(hidden_states.reshape(-1, hidden_size), lm_head_weight, bias, target.reshape(-1), epsilon, ignore_index, softmax_temperature, chunk_size, compute_entropy)
+
+def compute_lm_loss(model, lm_inputs, target, ignore_index, args, compute_entropy=True):
+    """Returns the label smoothed cross entropy of one output layer of the (DDP wrapped) model and the softmax entropy if it was computed along with the loss (None otherwise). With --chunked_loss the inputs are the decoder outputs fed to the LM head and the loss (and the entropy if entropy maximization is on) are computed by chunked_label_smoothed_nll_loss. Otherwise the inputs are the logits."""
+    if args.chunked_loss:
+        return chunked_label_smoothed_nll_loss(lm_inputs, model.module.lm_head.weight, model.module.final_logits_bias, target, args.label_smoothing, ignore_index, args.softmax_temperature, args.loss_chunk_size, compute_entropy=compute_entropy and args.max_ent_weight != -1)
+    lprobs = torch.nn.functional.log_softmax(lm_inputs, dim=-1) ## Softmax tempering of logits if needed.
+    return label_smoothed_nll_loss(lprobs, target, args.label_smoothing, ignore_index=ignore_index), None
+
 def prune_weights(model_weight_dict, prune_ratio):
     """Prunes the weights of the model.
     Args:
@@ -212,11 +330,20 @@ def compute_distillation_losses(child_mod_compute, parent_mod_compute, target, i
             
     for distillation_loss_to_compute in distillation_losses_to_compute:
         if distillation_loss_to_compute == "cross_entropy":
-            parent_logits = parent_mod_compute.logits
-            parent_lprobs = torch.nn.functional.log_softmax(parent_logits/args.distillation_temperature, dim=-1)
             child_logits = child_mod_compute.logits
             child_lprobs = torch.nn.functional.log_softmax(child_logits/args.distillation_temperature, dim=-1)
-            parent_softmax = torch.exp(parent_lprobs)
+            if isinstance(parent_mod_compute, TeacherOutputs): ## Cached parent outputs only have the top-k tokens of each position. The parent distribution is renormalized over them and only the child log probabilities of these tokens are needed.
+                parent_softmax = torch.softmax(parent_mod_compute.topk_lprobs, dim=-1)
+                child_lprobs = child_lprobs.gather(-1, parent_mod_compute.topk_ids)
+            else:
+                parent_logits = parent_mod_compute.logits.float() ## The parent may be run in half precision.
+                parent_lprobs = torch.nn.functional.log_softmax(parent_logits/args.distillation_temperature, dim=-1)
+                if args.distillation_topk > 0: ## Sparse distribution matching over the top-k parent tokens like with cached parent outputs.
+                    parent_lprobs, parent_topk_ids = parent_lprobs.topk(args.distillation_topk, dim=-1)
+                    parent_softmax = torch.softmax(parent_lprobs, dim=-1)
+                    child_lprobs = child_lprobs.gather(-1, parent_topk_ids)
+                else:
+                    parent_softmax = torch.exp(parent_lprobs)
             distillation_cross_entropy = parent_softmax*child_lprobs
             distillation_cross_entropy.masked_fill_(pad_mask, 0.0)
             distillation_cross_entropy = distillation_cross_entropy.sum(dim=-1)
@@ -267,6 +394,117 @@ def compute_distillation_losses(child_mod_compute, parent_mod_compute, target, i
         
     return -torch.mean(torch.stack(all_distillation_losses), dim=0)
 
+class TeacherOutputs(object):
+    """The parent model computations needed for distillation when they are read from a teacher output cache instead of running the parent. The logits are replaced by the top-k token ids and their log probabilities (at the distillation temperature) for every target position. The hidden states are dictionaries from the (zero indexed) parent layer to the states so that they are indexed like the hidden states of the model outputs."""
+    def __init__(self, topk_ids, topk_lprobs, encoder_hidden_states=None, decoder_hidden_states=None):
+        self.topk_ids = topk_ids
+        self.topk_lprobs = topk_lprobs
+        self.encoder_hidden_states = encoder_hidden_states
+        self.decoder_hidden_states = decoder_hidden_states
+    
+    def to(self, device):
+        move = lambda states: {layer: state.to(device, non_blocking=True) for layer, state in states.items()} if states is not None else None
+        return TeacherOutputs(self.topk_ids.to(device, non_blocking=True), self.topk_lprobs.to(device, non_blocking=True), move(self.encoder_hidden_states), move(self.decoder_hidden_states))
+
+def teacher_cache_shard_path(path, rank):
+    """Returns the directory of the teacher output cache of the process with the given rank. Each process caches the examples of its own training shards."""
+    return path+"."+"%02d" % rank
+
+def teacher_cache_key(encoder_input, labels):
+    """Hashes the encoder input and decoder label ids of an example (without padding) into a 64 bit key. Examples are sampled, truncated and batched in a different order every time so their content is what identifies them in the teacher output cache."""
+    ids = np.concatenate([encoder_input, [-1], labels]).astype(np.int32)
+    return int.from_bytes(hashlib.blake2b(ids.tobytes(), digest_size=8).digest(), "little")
+
+def teacher_cache_keys(input_ids, labels, pad_id):
+    """Returns the teacher output cache keys of the examples in a padded batch as an uint64 array."""
+    input_ids, labels = input_ids.numpy(), labels.numpy()
+    return np.array([teacher_cache_key(encoder_input[encoder_input != pad_id], example_labels[example_labels != pad_id]) for encoder_input, example_labels in zip(input_ids, labels)], dtype=np.uint64)
+
+class TeacherOutputCacheWriter(object):
+    """Appends the parent model outputs of examples to the raw files of a teacher output cache. The top-k ids are stored as int32 and the log probabilities and hidden states as float16 with one row per target (or source) position. The index of the examples sorted by their keys and the metadata are written when the cache is closed and the metadata marks the cache as complete. An example that occurs several times in the corpus is stored once."""
+    def __init__(self, path, topk, layers, temperature):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.topk = topk
+        self.layers = layers
+        self.temperature = temperature
+        self.d_model = 0
+        self.index = []
+        self.seen_keys = set()
+        self.num_source_positions = 0
+        self.num_target_positions = 0
+        names = ["topk_ids", "topk_lprobs"] + (["encoder_hidden_states", "decoder_hidden_states"] if len(layers) > 0 else [])
+        self.files = {name: open(os.path.join(path, name+".bin"), "wb") for name in names}
+    
+    def add(self, key, topk_ids, topk_lprobs, encoder_hidden_states=None, decoder_hidden_states=None):
+        """Stores the [target length, k] top-k ids and log probabilities of an example and, if layers are cached, its [length, layers, d_model] encoder and decoder hidden states."""
+        if key in self.seen_keys:
+            return
+        self.seen_keys.add(key)
+        self.files["topk_ids"].write(np.ascontiguousarray(topk_ids, dtype=np.int32).tobytes())
+        self.files["topk_lprobs"].write(np.ascontiguousarray(topk_lprobs, dtype=np.float16).tobytes())
+        source_length = 0
+        if len(self.layers) > 0:
+            source_length = len(encoder_hidden_states)
+            self.d_model = encoder_hidden_states.shape[-1]
+            self.files["encoder_hidden_states"].write(np.ascontiguousarray(encoder_hidden_states, dtype=np.float16).tobytes())
+            self.files["decoder_hidden_states"].write(np.ascontiguousarray(decoder_hidden_states, dtype=np.float16).tobytes())
+        self.index.append((key, self.num_source_positions, source_length, self.num_target_positions, len(topk_ids)))
+        self.num_source_positions += source_length
+        self.num_target_positions += len(topk_ids)
+    
+    def close(self):
+        for cache_file in self.files.values():
+            cache_file.close()
+        self.index.sort()
+        np.save(os.path.join(self.path, "keys.npy"), np.array([entry[0] for entry in self.index], dtype=np.uint64))
+        np.save(os.path.join(self.path, "offsets.npy"), np.array([entry[1:] for entry in self.index], dtype=np.int64).reshape(-1, 4))
+        meta = {"topk": self.topk, "layers": self.layers, "temperature": self.temperature, "d_model": self.d_model, "num_examples": len(self.index), "num_source_positions": self.num_source_positions, "num_target_positions": self.num_target_positions}
+        with open(os.path.join(self.path, "meta.json.tmp"), "w") as f:
+            json.dump(meta, f)
+        os.replace(os.path.join(self.path, "meta.json.tmp"), os.path.join(self.path, "meta.json"))
+
+class TeacherOutputCache(object):
+    """Memory maps a teacher output cache written by TeacherOutputCacheWriter and gathers the cached parent outputs of the examples of a padded batch into TeacherOutputs. Only the rows of the examples in the batch are read from disk."""
+    def __init__(self, path):
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        self.topk = meta["topk"]
+        self.layers = meta["layers"]
+        self.temperature = meta["temperature"]
+        self.keys = np.load(os.path.join(path, "keys.npy"), mmap_mode="r")
+        self.offsets = np.load(os.path.join(path, "offsets.npy"), mmap_mode="r")
+        self.topk_ids = np.memmap(os.path.join(path, "topk_ids.bin"), dtype=np.int32, mode="r", shape=(meta["num_target_positions"], self.topk))
+        self.topk_lprobs = np.memmap(os.path.join(path, "topk_lprobs.bin"), dtype=np.float16, mode="r", shape=(meta["num_target_positions"], self.topk))
+        if len(self.layers) > 0:
+            self.encoder_hidden_states = np.memmap(os.path.join(path, "encoder_hidden_states.bin"), dtype=np.float16, mode="r", shape=(meta["num_source_positions"], len(self.layers), meta["d_model"]))
+            self.decoder_hidden_states = np.memmap(os.path.join(path, "decoder_hidden_states.bin"), dtype=np.float16, mode="r", shape=(meta["num_target_positions"], len(self.layers), meta["d_model"]))
+        print("Loaded a teacher output cache with", meta["num_examples"], "examples from", path)
+    
+    def lookup(self, input_ids, labels, pad_id):
+        """Returns the TeacherOutputs of a batch. The outputs are padded to the shape of the batch with zeros. Every example must be in the cache."""
+        keys = teacher_cache_keys(input_ids, labels, pad_id)
+        entries = np.minimum(np.searchsorted(self.keys, keys), len(self.keys)-1)
+        if not np.array_equal(self.keys[entries], keys):
+            raise KeyError("Examples of the batch are missing from the teacher output cache. The cache must be built for the same training files, number of processes and truncation flags.")
+        batch_size, source_length = input_ids.size()
+        target_length = labels.size(1)
+        topk_ids = np.zeros((batch_size, target_length, self.topk), dtype=np.int64)
+        topk_lprobs = np.zeros((batch_size, target_length, self.topk), dtype=np.float32)
+        if len(self.layers) > 0:
+            encoder_hidden_states = np.zeros((batch_size, source_length)+self.encoder_hidden_states.shape[1:], dtype=np.float32)
+            decoder_hidden_states = np.zeros((batch_size, target_length)+self.decoder_hidden_states.shape[1:], dtype=np.float32)
+        for row, entry in enumerate(entries):
+            source_offset, example_source_length, target_offset, example_target_length = self.offsets[entry]
+            topk_ids[row, :example_target_length] = self.topk_ids[target_offset:target_offset+example_target_length]
+            topk_lprobs[row, :example_target_length] = self.topk_lprobs[target_offset:target_offset+example_target_length]
+            if len(self.layers) > 0:
+                encoder_hidden_states[row, :example_source_length] = self.encoder_hidden_states[source_offset:source_offset+example_source_length]
+                decoder_hidden_states[row, :example_target_length] = self.decoder_hidden_states[target_offset:target_offset+example_target_length]
+        if len(self.layers) == 0:
+            return TeacherOutputs(torch.from_numpy(topk_ids), torch.from_numpy(topk_lprobs))
+        return TeacherOutputs(torch.from_numpy(topk_ids), torch.from_numpy(topk_lprobs), {layer: torch.from_numpy(encoder_hidden_states[:, :, layer_idx]) for layer_idx, layer in enumerate(self.layers)}, {layer: torch.from_numpy(decoder_hidden_states[:, :, layer_idx]) for layer_idx, layer in enumerate(self.layers)})
+
 def remap_layers(model, idx, args): ### Cut this code into half.
     """This method is used to remap the layers from a pretrained model to the current model. The remapping info comes in the form of 2-1,... which means, map the second layer of the pretrained model to the first layer of the current model."""
     print("Remapping layers from parent to child.")
@@ -388,58 +626,280 @@ def init_weights(module, in_features, out_features):
         if module.padding_idx is not None:
             module.weight.data[module.padding_idx].zero_()
             
-def shard_files_mono(files, args):
-    """This method shards files into N parts containing the same number of lines. Each shard will go to a different GPU which may even be located on another machine. This method is run when the 'shard_files' argument is passed."""
-    print("Sharding files into", args.world_size, "parts")
-    for lang, file_details in files:
-        infile = open(file_details[0]).readlines() if args.num_domains_for_domain_classifier > 1 else open(file_details).readlines()
-        num_lines = len(infile)
-        lines_per_shard = math.ceil(num_lines/args.world_size)
-        print("For language:",lang," the total number of lines are:", num_lines, "and number of lines per shard are:", lines_per_shard)
-        for shard_id in range(args.world_size):
-            outfile = open(file_details[0]+"."+"%02d" % shard_id, "w") if args.num_domains_for_domain_classifier > 1 else open(file_details+"."+"%02d" % shard_id, "w")
-            for line in infile[shard_id*lines_per_shard:(shard_id+1)*lines_per_shard]:
+def count_lines(path):
+    """Counts the lines in a file by scanning it in binary blocks. Memory usage is constant no matter how large the file is."""
+    num_lines = 0
+    last_block = b""
+    with open(path, "rb") as infile:
+        while True:
+            block = infile.read(1 << 24)
+            if not block:
+                break
+            num_lines += block.count(b"\n")
+            last_block = block
+    if last_block and not last_block.endswith(b"\n"): ## The last line has no newline.
+        num_lines += 1
+    return num_lines
+
+def get_shard_line_range(num_lines, shard_id, num_shards):
+    """Returns the index of the first line of a shard and the index of the line after its last line. Lines are split across shards the same way for physical and virtual sharding."""
+    lines_per_shard = math.ceil(num_lines/num_shards)
+    return min(shard_id*lines_per_shard, num_lines), min((shard_id+1)*lines_per_shard, num_lines)
+
+def write_shards(paths, num_shards):
+    """Splits one file (or several line aligned files such as the source and target side of a parallel corpus) into N shards in a single streaming pass after counting the lines. Only one line per file is held in memory at a time."""
+    num_lines = min(count_lines(path) for path in paths)
+    infiles = [open(path) for path in paths]
+    lines = zip(*infiles)
+    for shard_id in range(num_shards):
+        start, end = get_shard_line_range(num_lines, shard_id, num_shards)
+        outfiles = [open(path+"."+"%02d" % shard_id, "w") for path in paths]
+        for line_tuple in islice(lines, end-start):
+            for outfile, line in zip(outfiles, line_tuple):
                 outfile.write(line)
+        for outfile in outfiles:
             outfile.flush()
             outfile.close()
+    for infile in infiles:
+        infile.close()
+    return num_lines, math.ceil(num_lines/num_shards)
+
+def line_index_path(path):
+    """Returns the path of the line index of a file used for virtual sharding."""
+    return path+".lineidx"
+
+def build_line_index(path):
+    """Builds the line index of a file for virtual sharding. The index is a raw int64 file containing the byte offset of the start of each line followed by the file size so the lines of any shard can be read with a single seek. The file is scanned in blocks so memory usage is constant."""
+    file_size = os.path.getsize(path)
+    last_offset = 0
+    block_start = 0
+    with open(path, "rb") as infile, open(line_index_path(path), "wb") as outfile:
+        np.array([0], dtype=np.int64).tofile(outfile)
+        while True:
+            block = infile.read(1 << 24)
+            if not block:
+                break
+            line_starts = np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == ord("\n")).astype(np.int64) + block_start + 1
+            line_starts.tofile(outfile)
+            if len(line_starts) > 0:
+                last_offset = line_starts[-1]
+            block_start += len(block)
+        if last_offset != file_size: ## The last line has no newline.
+            np.array([file_size], dtype=np.int64).tofile(outfile)
+    return (os.path.getsize(line_index_path(path)) // 8) - 1
+
+data_worker_split = (0, 1) ## The id of this batch producer worker process and the number of workers. Each worker only keeps its part of the lines of every corpus shard so that the corpora are not held in memory once per worker.
+
+def iterate_shard_lines(path, rank, args):
+    """Lazily returns the lines of a file meant for the process with the given rank. With virtual sharding, the line index is used to read only this rank's part of the original file. Otherwise the physical shard is read. In a batch producer worker, only the worker's part of these lines is returned."""
+    worker_id, num_workers = data_worker_split
+    if args.virtual_sharding:
+        offsets = np.memmap(line_index_path(path), dtype=np.int64, mode="r")
+        start, end = get_shard_line_range(len(offsets)-1, rank, args.world_size)
+        worker_start, worker_end = get_shard_line_range(end-start, worker_id, num_workers)
+        start, end = start+worker_start, start+worker_end
+        with open(path, "rb") as infile:
+            infile.seek(int(offsets[start]))
+            for _ in range(end-start):
+                yield infile.readline().decode("utf-8")
+    else:
+        with open(path+"."+"%02d" % rank) as infile:
+            for line_idx, line in enumerate(infile):
+                if line_idx % num_workers == worker_id:
+                    yield line
+
+class CompactCorpus(object):
+    """Stores the lines of a corpus (shard) in one contiguous utf-8 buffer along with a numpy array of line offsets instead of as a python list of strings. This avoids the per string object overhead which is several times the size of the text itself. The line lengths (in characters) are precomputed for sorted batching. Lines are decoded only when accessed."""
+    def __init__(self, lines):
+        buffer = bytearray()
+        offsets = array("q", [0])
+        lengths = array("q")
+        for line in lines:
+            buffer += line.encode("utf-8")
+            offsets.append(len(buffer))
+            lengths.append(len(line))
+        self.buffer = buffer
+        self.offsets = np.frombuffer(offsets, dtype=np.int64)
+        self.lengths = np.frombuffer(lengths, dtype=np.int64)
+    
+    def __len__(self):
+        return len(self.lengths)
+    
+    def __getitem__(self, idx):
+        return self.buffer[self.offsets[idx]:self.offsets[idx+1]].decode("utf-8")
+
+corpus_manifests = {} ## The manifests which this process has built in memory because they could not be found on disk.
+
+def corpus_manifest_paths(path):
+    """Returns the paths where the manifest of a corpus (shard) is looked for. It is saved next to the corpus and, if that directory is read only, in the user's cache directory under the md5 of the absolute path of the corpus."""
+    cache_name = hashlib.md5(os.path.abspath(path).encode("utf-8")).hexdigest()+".manifest.json"
+    return [path+".manifest.json", os.path.join(os.path.expanduser("~"), ".cache", "yanmtt", "manifests", cache_name)]
+
+def build_corpus_manifest(path, tok=None, max_histogram_length=1024, token_length_sample_size=10000):
+    """Builds the manifest of a corpus (shard) in a single streaming pass. The manifest contains the number of lines, the size in bytes, the modification time, a histogram of the line lengths in words (longer lines are counted in the last bin) and an md5 checksum of the contents. If a tokenizer is given then a reservoir sample of the lines is tokenized to get a histogram of the line lengths in tokens (without special tokens) which is used to plan batch sizes. Tokenizing the whole corpus just for this would take as long as binarizing it."""
+    num_lines = 0
+    length_histogram = np.zeros(max_histogram_length+1, dtype=np.int64)
+    checksum = hashlib.md5()
+    sampler = random.Random(621311) ## The sample does not depend on the global random state.
+    sample = []
+    with open(path, "rb") as infile:
+        for line in infile:
+            checksum.update(line)
+            length_histogram[min(len(line.split()), max_histogram_length)] += 1
+            if tok is not None:
+                if num_lines < token_length_sample_size:
+                    sample.append(line)
+                else:
+                    sample_idx = sampler.randrange(num_lines+1)
+                    if sample_idx < token_length_sample_size:
+                        sample[sample_idx] = line
+            num_lines += 1
+    file_stat = os.stat(path)
+    manifest = {"num_lines": num_lines, "num_bytes": file_stat.st_size, "mtime": file_stat.st_mtime, "length_histogram": length_histogram.tolist(), "checksum": checksum.hexdigest()}
+    if tok is not None:
+        token_length_histogram = np.zeros(max_histogram_length+1, dtype=np.int64)
+        for line in sample:
+            token_length_histogram[min(len(tok(line.decode("utf-8").strip(), add_special_tokens=False).input_ids), max_histogram_length)] += 1
+        manifest["token_length_histogram"] = token_length_histogram.tolist()
+    return manifest
+
+def save_corpus_manifest(path, manifest):
+    """Saves the manifest of a corpus (shard) next to it or, if that fails, in the cache directory. The manifest is written to a temporary file first and then renamed so that processes reading it never see a partial file."""
+    for manifest_path in corpus_manifest_paths(path):
+        temp_path = manifest_path+".tmp."+str(os.getpid())
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(manifest_path)), exist_ok=True)
+            with open(temp_path, "w") as outfile:
+                json.dump(manifest, outfile)
+            os.replace(temp_path, manifest_path)
+            return manifest_path
+        except OSError:
+            print("Could not save the manifest of", path, "in", manifest_path)
+    return None
+
+def find_corpus_manifest(path):
+    """Returns the saved manifest of a corpus (shard) or None if there is no manifest or if the corpus has changed since (different size or modification time). The checksum is not verified here since that needs a full scan."""
+    file_stat = os.stat(path)
+    for manifest_path in corpus_manifest_paths(path):
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as infile:
+                manifest = json.load(infile)
+            if manifest["num_bytes"] == file_stat.st_size and manifest["mtime"] == file_stat.st_mtime:
+                return manifest
+            print("The manifest of", path, "in", manifest_path, "is stale.")
+    return None
+
+def get_corpus_paths(files):
+    """Returns the paths of the corpora in a list of (language, file details) tuples as used by the batch generators. The file details are a path or a tuple of paths and possibly other things like domain labels."""
+    paths = []
+    for _, file_details in files:
+        if type(file_details) is str:
+            paths.append(file_details)
+        else:
+            paths.extend(detail for detail in file_details if type(detail) is str)
+    return paths
+
+def prepare_corpus_manifests(paths, tok, args):
+    """Builds and saves the manifests of the corpora (or of all their physical shards) which are missing, stale or were built without a tokenizer. This must be run by the prime process only, before a barrier, so that the other processes (and their data workers) only read the manifests and never scan the corpora or race to write the same files. Binarized corpora dont need manifests."""
+    if args.use_binarized_corpora:
+        return
+    for path in paths:
+        shard_paths = [path] if args.virtual_sharding else [path+"."+"%02d" % rank for rank in range(args.world_size)]
+        for shard_path in shard_paths:
+            if not os.path.exists(shard_path): ## With physical shards on local disks, only the shards of this node are visible.
+                continue
+            manifest = find_corpus_manifest(shard_path)
+            if manifest is None or "token_length_histogram" not in manifest:
+                print("Building the manifest of", shard_path)
+                save_corpus_manifest(shard_path, build_corpus_manifest(shard_path, tok))
+
+def load_corpus_manifest(path):
+    """Loads the manifest of a corpus (shard) which prepare_corpus_manifests has built. If it cannot be found then it is built in memory once per process and not saved, since several processes could be doing the same at the same time."""
+    manifest = find_corpus_manifest(path)
+    if manifest is not None:
+        return manifest
+    if path not in corpus_manifests:
+        print("No manifest found for", path, "so this process is building one in memory. This is slow and is done by every process which needs it.")
+        corpus_manifests[path] = build_corpus_manifest(path)
+    return corpus_manifests[path]
+
+def get_length_stats(length_histogram):
+    """Returns the mean and the 95th percentile of the line lengths in a histogram from a manifest. Useful for deciding batch sizes without reading the corpus."""
+    length_histogram = np.array(length_histogram)
+    num_lines = max(length_histogram.sum(), 1)
+    mean_length = (length_histogram*np.arange(len(length_histogram))).sum()/num_lines
+    percentile_95 = int(np.searchsorted(np.cumsum(length_histogram), 0.95*num_lines))
+    return round(float(mean_length), 2), percentile_95
+
+def get_shard_num_lines(path, rank, args):
+    """Returns the number of lines of the shard of a corpus meant for the process with the given rank without reading the corpus. For binarized corpora, this comes from the memory mapped offsets and otherwise from the manifest of the physical shard or, with virtual sharding, of the whole file."""
+    if args.use_binarized_corpora:
+        ids, offsets = load_binarized_shard(path, rank, args)
+        return len(offsets)-1
+    if args.virtual_sharding:
+        start, end = get_shard_line_range(load_corpus_manifest(path)["num_lines"], rank, args.world_size)
+        return end-start
+    return load_corpus_manifest(path+"."+"%02d" % rank)["num_lines"]
+
+def print_corpus_stats(path, rank, language, args, max_histogram_length=1024):
+    """Prints the line length statistics of the corpus (shard) of a language and a batch size plan based on the 95th percentile of the line lengths in tokens. For binarized corpora the token lengths come from the offsets and otherwise from the tokenized sample in the manifest."""
+    if args.use_binarized_corpora:
+        ids, offsets = load_binarized_shard(path, rank, args)
+        token_length_histogram = np.bincount(np.minimum(np.diff(offsets), max_histogram_length), minlength=max_histogram_length+1)
+    else:
+        manifest = load_corpus_manifest(path if args.virtual_sharding else path+"."+"%02d" % rank)
+        mean_length, percentile_95 = get_length_stats(manifest["length_histogram"])
+        print("Corpus stats for", language, ": mean length of", mean_length, "words and 95 percent of the lines have at most", percentile_95, "words.")
+        if "token_length_histogram" not in manifest:
+            return
+        token_length_histogram = manifest["token_length_histogram"]
+    mean_length, percentile_95 = get_length_stats(token_length_histogram)
+    padded_length = min(percentile_95 + 2, args.hard_truncate_length) ## Language indicator token and EOS.
+    print("Corpus stats for", language, ": mean length of", mean_length, "tokens and 95 percent of the lines have at most", percentile_95, "tokens.")
+    if args.batch_size_indicates_lines:
+        print("Batch plan for", language, ": a batch of", args.batch_size, "lines padded to", padded_length, "tokens has", args.batch_size*padded_length, "tokens.")
+    else:
+        print("Batch plan for", language, ": a batch of", args.batch_size, "tokens fits about", max(args.batch_size//padded_length, 1), "lines of", padded_length, "tokens. Use this number with --batch_size_indicates_lines for the same batch sizes in lines.")
+
+def shard_files_mono(files, args):
+    """This method shards files into N parts containing the same number of lines. Each shard will go to a different GPU which may even be located on another machine. This method is run when the 'shard_files' argument is passed. With virtual sharding, no shards are written and only a line index is built per file."""
+    print("Sharding files into", args.world_size, "parts")
+    for lang, file_details in files:
+        path = file_details[0] if args.num_domains_for_domain_classifier > 1 else file_details
+        if args.virtual_sharding:
+            num_lines = build_line_index(path)
+            print("For language:",lang," the total number of lines are:", num_lines, "and the line index has been built for virtual sharding.")
+        else:
+            num_lines, lines_per_shard = write_shards([path], args.world_size)
+            print("For language:",lang," the total number of lines are:", num_lines, "and number of lines per shard are:", lines_per_shard)
         print("File for language", lang, "has been sharded.")
         sys.stdout.flush()
 
 def shard_files_mono_lm(files, args):
-    """This method shards files into N parts containing the same number of lines. Each shard will go to a different GPU which may even be located on another machine. This method is run when the 'shard_files' argument is passed."""
+    """This method shards files into N parts containing the same number of lines. Each shard will go to a different GPU which may even be located on another machine. This method is run when the 'shard_files' argument is passed. With virtual sharding, no shards are written and only a line index is built per file."""
     print("Sharding files into", args.world_size, "parts")
     for lang in files:
-        infile = open(files[lang]).readlines()
-        num_lines = len(infile)
-        lines_per_shard = math.ceil(num_lines/args.world_size)
-        print("For language:",lang," the total number of lines are:", num_lines, "and number of lines per shard are:", lines_per_shard)
-        for shard_id in range(args.world_size):
-            outfile = open(files[lang]+"."+"%02d" % shard_id, "w")
-            for line in infile[shard_id*lines_per_shard:(shard_id+1)*lines_per_shard]:
-                outfile.write(line)
-            outfile.flush()
-            outfile.close()
+        if args.virtual_sharding:
+            num_lines = build_line_index(files[lang])
+            print("For language:",lang," the total number of lines are:", num_lines, "and the line index has been built for virtual sharding.")
+        else:
+            num_lines, lines_per_shard = write_shards([files[lang]], args.world_size)
+            print("For language:",lang," the total number of lines are:", num_lines, "and number of lines per shard are:", lines_per_shard)
         print("File for language", lang, "has been sharded.")
         sys.stdout.flush()
         
 def shard_files_bi(files, args):
-    """This method shards files into N parts containing the same number of lines. Each shard will go to a different GPU which may even be located on another machine. This method is run when the 'shard_files' argument is passed."""
+    """This method shards files into N parts containing the same number of lines. Each shard will go to a different GPU which may even be located on another machine. This method is run when the 'shard_files' argument is passed. With virtual sharding, no shards are written and only a line index is built per file."""
     print("Sharding files into", args.world_size, "parts")
     for pair, file_details in files:
-        infile = list(zip(open(file_details[0]).readlines(), open(file_details[1]).readlines()))
-        num_lines = len(infile)
-        lines_per_shard = math.ceil(num_lines/args.world_size)
-        print("For language pair:",pair," the total number of lines are:", num_lines, "and number of lines per shard are:", lines_per_shard)
-        for shard_id in range(args.world_size):
-            srcoutfile = open(file_details[0]+"."+"%02d" % shard_id, "w")
-            tgtoutfile = open(file_details[1]+"."+"%02d" % shard_id, "w")
-            for src_line, tgt_line in infile[shard_id*lines_per_shard:(shard_id+1)*lines_per_shard]:
-                srcoutfile.write(src_line)
-                tgtoutfile.write(tgt_line)
-            srcoutfile.flush()
-            srcoutfile.close()
-            tgtoutfile.flush()
-            tgtoutfile.close()
+        if args.virtual_sharding:
+            num_lines = build_line_index(file_details[0])
+            num_tgt_lines = build_line_index(file_details[1])
+            assert num_lines == num_tgt_lines, "The source and target files for "+pair+" have a different number of lines."
+            print("For language pair:",pair," the total number of lines are:", num_lines, "and the line indices have been built for virtual sharding.")
+        else:
+            num_lines, lines_per_shard = write_shards([file_details[0], file_details[1]], args.world_size)
+            print("For language pair:",pair," the total number of lines are:", num_lines, "and number of lines per shard are:", lines_per_shard)
         print("File for language pair", pair, "has been sharded.")
         sys.stdout.flush()
         
@@ -448,53 +908,141 @@ def get_sacrebleu(refs, hyp):
     bleu = sacrebleu.corpus_bleu(hyp, refs)
     return bleu.score
 
-def yield_corpus_indefinitely_mono(corpus, lang, sorted_batching):
-    """This shuffles the corpus or corpus shard at the beginning of each epoch and returns sentences indefinitely."""
-    epoch_counter = 0
-    num_lines = len(corpus)
-    num_sentences_before_sort = 20000
-    num_sorted_segments = (num_lines // num_sentences_before_sort) + 1
+def yield_corpus_indefinitely_mono(lines, lang, sorted_batching):
+    """This shuffles the corpus or corpus shard at the beginning of each epoch and returns sentences indefinitely. The lines are loaded into a CompactCorpus only when the first sentence is requested so that training can start before all corpora are read. Only an index permutation is shuffled and sorted so each epoch starts almost instantly."""
     try:
-        while True:
-            print("Shuffling corpus!")
-            sys.stdout.flush()
-            random.shuffle(corpus)
-            if sorted_batching:
-                for curr_segment_id in range(num_sorted_segments):
-                    curr_segment = corpus[curr_segment_id*num_sentences_before_sort:(curr_segment_id+1)*num_sentences_before_sort]
-                    for src_line in sorted(curr_segment, key=len):
-                        yield src_line
-            else:
-                for src_line in corpus:
-                    yield src_line
-            epoch_counter += 1
-            print("Finished epoch", epoch_counter, "for language:", lang)
+        corpus = CompactCorpus(lines)
+        for line_idx in yield_line_indices_indefinitely(corpus.lengths, lang, sorted_batching):
+            yield corpus[line_idx]
     except Exception as e:
         print(e)
         print("Catastrophic data gen failure")
     return None
 
-def yield_corpus_indefinitely_bi(corpus, language, sorted_batching):
-    """This shuffles the corpus at the beginning of each epoch and returns sentences indefinitely."""
+def yield_corpus_indefinitely_bi(lines, language, sorted_batching):
+    """This shuffles the corpus (a pair of line aligned iterables of lines) at the beginning of each epoch and returns sentence pairs indefinitely. The lines are loaded into a pair of CompactCorpus objects only when the first sentence pair is requested. Sorting is done on the target lengths."""
+    src_corpus, tgt_corpus = CompactCorpus(lines[0]), CompactCorpus(lines[1])
+    num_lines = min(len(src_corpus), len(tgt_corpus)) ## Extra lines on either side are ignored just like zip would.
+    for line_idx in yield_line_indices_indefinitely(tgt_corpus.lengths[:num_lines], language, sorted_batching):
+        yield src_corpus[line_idx], tgt_corpus[line_idx]
+    return None, None ## We should never reach this point.
+
+def yield_corpus_line_indices_indefinitely(corpus, language, sorted_batching):
+    """Same as yield_line_indices_indefinitely but the line lengths of the corpus are only accessed (and thus the corpus only loaded) when the first line index is requested."""
+    yield from yield_line_indices_indefinitely(corpus.lengths, language, sorted_batching)
+
+def binarized_corpus_paths(path):
+    """Returns the paths of the token id array and the line offsets array of a corpus (shard) binarized by binarize_corpus.py."""
+    return path+".ids.npy", path+".idx.npy"
+
+def load_binarized_corpus(path):
+    """Memory maps a corpus (shard) binarized by binarize_corpus.py. The token ids of line i are ids[offsets[i]:offsets[i+1]]. Nothing is read into memory till it is sliced so large corpora cost (almost) no RAM and start up instantly."""
+    ids_path, offsets_path = binarized_corpus_paths(path)
+    ids = np.load(ids_path, mmap_mode="r")
+    offsets = np.load(offsets_path, mmap_mode="r")
+    return ids, offsets
+
+def load_binarized_shard(path, rank, args):
+    """Memory maps the binarized shard of a corpus meant for the process with the given rank. With virtual sharding, the whole corpus is binarized as a single file and we only keep the offsets of this rank's lines. In a batch producer worker, only the offsets of the worker's part of these lines are kept. The offsets stay absolute so slicing the ids works as usual."""
+    if args.virtual_sharding:
+        ids, offsets = load_binarized_corpus(path)
+        start, end = get_shard_line_range(len(offsets)-1, rank, args.world_size)
+        offsets = offsets[start:end+1]
+    else:
+        ids, offsets = load_binarized_corpus(path+"."+"%02d" % rank)
+    worker_id, num_workers = data_worker_split
+    start, end = get_shard_line_range(len(offsets)-1, worker_id, num_workers)
+    return ids, offsets[start:end+1]
+
+def yield_line_indices_indefinitely(lengths, language, sorted_batching):
+    """This shuffles the line indices of a corpus at the beginning of each epoch and returns them indefinitely. The lines themselves are never moved around. For sorted batching, segments of 20000 shuffled indices are sorted by the given line lengths."""
     epoch_counter = 0
-    num_lines = len(corpus)
+    num_lines = len(lengths)
     num_sentences_before_sort = 20000
-    num_sorted_segments = (num_lines // num_sentences_before_sort) + 1
     while True:
         print("Shuffling corpus:", language)
-        random.shuffle(corpus)
         sys.stdout.flush()
+        permutation = np.random.permutation(num_lines)
         if sorted_batching:
-            for curr_segment_id in range(num_sorted_segments):
-                curr_segment = corpus[curr_segment_id*num_sentences_before_sort:(curr_segment_id+1)*num_sentences_before_sort]
-                for src_line, tgt_line in sorted(curr_segment, key=lambda x: len(x[1])):
-                    yield src_line, tgt_line
+            for segment_start in range(0, num_lines, num_sentences_before_sort):
+                curr_segment = permutation[segment_start:segment_start+num_sentences_before_sort]
+                for line_idx in curr_segment[np.argsort(lengths[curr_segment], kind="stable")]:
+                    yield line_idx
         else:
-            for src_line, tgt_line in corpus:
-                yield src_line, tgt_line
+            for line_idx in permutation:
+                yield line_idx
         epoch_counter += 1
         print("Finished epoch", epoch_counter, "for language:", language)
-    return None, None ## We should never reach this point.
+    return None ## We should never reach this point.
+
+class TokenIdCorpus(object):
+    """Gives the token ids of the lines of a training corpus shard. With binarized corpora, the ids are sliced out of the memory mapped arrays. Otherwise the shard is kept as a CompactCorpus and a line is tokenized exactly once when it is accessed. The CompactCorpus is only built when the corpus is first used so that training can start before all the shards are read. The ids never include special tokens. The line lengths are used for sorted batching."""
+    def __init__(self, path, rank, tok, args):
+        self.tok = tok
+        self.binarized = args.use_binarized_corpora
+        self.corpus = None
+        self._lengths = None
+        if self.binarized:
+            self.lines = None
+            self.ids, self.offsets = load_binarized_shard(path, rank, args)
+            self._lengths = np.diff(self.offsets)
+        else:
+            self.lines = iterate_shard_lines(path, rank, args)
+    
+    @property
+    def lengths(self):
+        if self._lengths is None:
+            self.corpus = CompactCorpus(self.lines)
+            self.lines = None
+            self._lengths = self.corpus.lengths
+        return self._lengths
+    
+    def __len__(self):
+        return len(self.lengths)
+    
+    def __getitem__(self, idx):
+        if self.binarized:
+            return np.asarray(self.ids[self.offsets[idx]:self.offsets[idx+1]], dtype=np.int64)
+        if self.corpus is None:
+            self.lengths ## Loads the corpus.
+        return np.array(self.tok(self.corpus[idx].strip(), add_special_tokens=False).input_ids, dtype=np.int64)
+
+def get_word_start_flags(tok):
+    """Returns a boolean array over the vocabulary which indicates the subwords that begin a new word. These are the subwords with the sentencepiece or GPT2 word boundary markers and the special tokens other than the unknown token, which is used for unknown characters in the middle of words. This lets us truncate and mask binarized sentences at the word level like we do for raw text."""
+    special_ids = set(tok.all_special_ids) - {tok.unk_token_id}
+    vocab = tok.convert_ids_to_tokens(list(range(len(tok))))
+    return np.array([idx in special_ids or (token is not None and (token.startswith("▁") or token.startswith("Ġ"))) for idx, token in enumerate(vocab)], dtype=bool)
+
+def get_mask_word_ids(tok, args):
+    """Returns the token ids of a mask word exactly as the tokenizer encodes it between two words of raw text. Sentencepiece tokenizers with an added [MASK] token put a separate word boundary subword before it, so the text based generators see two ids and the id based ones have to insert both to produce the same batches."""
+    mask_token = "<mask>" if args.use_official_pretrained else "[MASK]"
+    prefix_ids = tok("a", add_special_tokens=False).input_ids
+    return np.array(tok("a "+mask_token, add_special_tokens=False).input_ids[len(prefix_ids):], dtype=np.int64)
+
+def split_words_from_ids(ids, word_starts):
+    """Splits the token ids of a sentence into a list of words (arrays of token ids) using the word start flags. The first subword always starts a word. This gives the same words as splitting the raw text on spaces unless the line contains other whitespace, such as tabs, non breaking spaces or runs of spaces, which the tokenizer normalizes away, or invisible formatting characters like zero width joiners, which sentencepiece turns into word boundaries. Such lines have fewer words here so they are truncated and masked slightly differently than in the text based generators."""
+    boundaries = np.flatnonzero(word_starts[ids[1:]]) + 1
+    return np.split(ids, boundaries)
+
+def mask_words_from_ids(words, mask_word, mask_percent, args):
+    """Replaces spans of words with a single mask word (see get_mask_word_ids). This is the same poisson span masking as in the text based batch generators but it operates on lists of token id arrays. Returns the masked token ids."""
+    masked_words = mask_spans_in_batch([words], [mask_percent], mask_word, args)[0]
+    if len(masked_words) == 0:
+        return np.zeros(0, dtype=np.int64)
+    return np.concatenate(masked_words)
+
+def pad_id_sequences(sequences, pad_id):
+    """Right pads a list of token id sequences to the length of the longest one and returns a LongTensor just like the tokenizer would."""
+    max_len = max(len(sequence) for sequence in sequences)
+    padded = np.full((len(sequences), max_len), pad_id, dtype=np.int64)
+    for idx, sequence in enumerate(sequences):
+        padded[idx, :len(sequence)] = sequence
+    return torch.from_numpy(padded)
+
+def get_padding_efficiency(input_ids, labels, pad_id):
+    """Returns the fraction of real (non padding) tokens in the encoder and decoder sides of a batch. Call this on the cpu tensors before they are moved to the gpu so that it does not cause a synchronization."""
+    real_tokens = (input_ids != pad_id).sum().item() + (labels != pad_id).sum().item()
+    return real_tokens/(input_ids.numel() + labels.numel())
 
 def sub_sample_and_permute_document(sentence, document_level_sentence_delimiter, max_length):
     """Here we start at a particular random index and select the rest of the sentences. This is to make sure that we dont always see only the initial part of each document all the time."""
@@ -517,9 +1065,100 @@ def sub_sample_and_permute_document(sentence, document_level_sentence_delimiter,
     return sentence_split_shuffled, sentence, sent_len
 
     
+class LanguageSampler(object):
+    """Samples language indices according to the (temperature scaled) sampling probabilities. Instead of calling random.choices for every sentence, the indices are drawn in blocks with numpy from an alias table (Vose's method) so that each draw costs O(1) no matter how many languages there are. With language homogeneous batches, each sampled language is used for run_length consecutive sentences so that the batches built from them contain one (or at most two) languages. This does not change how often each language is seen on average."""
+    def __init__(self, probs, block_size=4096, run_length=1):
+        probs = np.asarray(probs, dtype=np.float64)
+        self.num_langs = len(probs)
+        self.block_size = block_size
+        self.run_length = max(run_length, 1)
+        self.accept_probs, self.aliases = self.build_alias_table(probs/probs.sum())
+        self.block = []
+        self.block_position = 0
+    
+    @staticmethod
+    def build_alias_table(probs):
+        """Builds the alias table for the given probabilities. Column i is accepted with probability accept_probs[i] and otherwise its alias is used."""
+        num_langs = len(probs)
+        scaled_probs = probs*num_langs
+        accept_probs = np.ones(num_langs, dtype=np.float64)
+        aliases = np.arange(num_langs)
+        small = [idx for idx in range(num_langs) if scaled_probs[idx] < 1.0]
+        large = [idx for idx in range(num_langs) if scaled_probs[idx] >= 1.0]
+        while len(small) > 0 and len(large) > 0:
+            small_idx = small.pop()
+            large_idx = large.pop()
+            accept_probs[small_idx] = scaled_probs[small_idx]
+            aliases[small_idx] = large_idx
+            scaled_probs[large_idx] -= 1.0 - scaled_probs[small_idx]
+            if scaled_probs[large_idx] < 1.0:
+                small.append(large_idx)
+            else:
+                large.append(large_idx)
+        return accept_probs, aliases ## Whatever remains in small or large is left with an acceptance probability of 1 which takes care of rounding errors.
+    
+    def sample_block(self):
+        """Draws a block of language indices at once."""
+        num_draws = math.ceil(self.block_size/self.run_length)
+        columns = np.random.randint(0, self.num_langs, num_draws)
+        indices = np.where(np.random.random_sample(num_draws) < self.accept_probs[columns], columns, self.aliases[columns])
+        return np.repeat(indices, self.run_length).tolist() ## A python list since indexing it is much faster than indexing a numpy array one element at a time.
+    
+    def __iter__(self):
+        return self
+    
+    def __next__(self):
+        if self.block_position == len(self.block):
+            self.block = self.sample_block()
+            self.block_position = 0
+        language_index = self.block[self.block_position]
+        self.block_position += 1
+        return language_index
+
+def get_language_sampler(probs, args):
+    """Returns a LanguageSampler for the given sampling probabilities based on the language homogeneous batching settings."""
+    return LanguageSampler(probs, run_length=args.language_run_length if args.language_homogeneous_batches else 1)
+
+def yield_masked_sentences_mono(language_file_dict, language_list, probs, mp_val_or_range, mask_tok, args, block_size=256):
+    """Samples monolingual sentences and masks them in blocks of sentences with mask_spans_in_batch instead of one sentence at a time. Yields tuples of the language, the (truncated) sentence and the masked sentence."""
+    language_sampler = get_language_sampler(probs, args)
+    while True:
+        languages = []
+        sentences = []
+        sentence_splits = []
+        mask_percents = []
+        for _ in range(block_size):
+            language_index = next(language_sampler)
+            sentence = next(language_file_dict[language_index]).strip()
+            if type(mp_val_or_range) is float:
+                mask_percent = mp_val_or_range
+            else:
+                mask_percent = random.uniform(mp_val_or_range[0], mp_val_or_range[1])
+            if args.is_document:
+                sentence_split, sentence, sent_len = sub_sample_and_permute_document(sentence, args.document_level_sentence_delimiter, args.max_length)
+            else:
+                sentence_split = sentence.split(" ")
+                sent_len = len(sentence_split)
+                if sent_len > args.max_length: ## Initial truncation
+                    sentence_split = sentence_split[:args.max_length]
+                    sentence = " ".join(sentence_split)
+                    sent_len = args.max_length
+            languages.append(language_list[language_index])
+            sentences.append(sentence)
+            sentence_splits.append(sentence_split)
+            mask_percents.append(mask_percent)
+        masked_sentence_splits = mask_spans_in_batch(sentence_splits, mask_percents, mask_tok, args, protected_word=args.document_level_sentence_delimiter if args.is_document else None) ## We never mask the document level sentence delimiters.
+        for language, sentence, masked_sentence_split in zip(languages, sentences, masked_sentence_splits):
+            yield language, sentence, " ".join(masked_sentence_split)
+
 def generate_batches_monolingual_masked(tok, args, files, rank):
     """Generates the source, target and source attention masks for denoising. Long sequences are truncated and short sequences are ignored."""
     
+    if args.use_binarized_corpora or args.tokenize_once: ## The corpora have been tokenized offline via binarize_corpus.py or we tokenize each sentence exactly once so we batch directly from token ids.
+        yield from generate_batches_monolingual_masked_from_ids(tok, args, files, rank)
+        return
+    assert not (args.bucketed_batching or args.pack_examples), "Bucketed batching and packing need exact token lengths. Use them with --tokenize_once or --use_binarized_corpora."
+    
     if args.tokenization_sampling:
         print("Stochastic tokenizer will be used.")
         if "mbart" in args.tokenizer_name_or_path:
@@ -541,19 +1180,19 @@ def generate_batches_monolingual_masked(tok, args, files, rank):
     print("Training for:", language_list)
     language_file_dict = []
     probs = []
-    language_indices = [i for i in range(len(language_list))]
     for lang, file_details in files:
-        file_content = open(file_details[0]+"."+"%02d" % rank).readlines() if args.num_domains_for_domain_classifier > 1 else open(file_details+"."+"%02d" % rank).readlines()
-        probs.append(len(file_content))
-        language_file_dict.append(yield_corpus_indefinitely_mono(file_content, lang, args.sorted_batching))
+        path = file_details[0] if args.num_domains_for_domain_classifier > 1 else file_details
+        probs.append(get_shard_num_lines(path, rank, args)) ## From the manifest so that we dont have to read the corpus before training starts.
+        print_corpus_stats(path, rank, lang, args)
+        language_file_dict.append(yield_corpus_indefinitely_mono(iterate_shard_lines(path, rank, args), lang, args.sorted_batching))
     probs_temp = [probval/sum(probs) for probval in probs]
     probs = probs_temp
     probs_temp = [probsval**(1.0/args.data_sampling_temperature) for probsval in probs] ## Temperature sampling probabilities.
     probs = probs_temp
     probs_temp = [probsval/sum(probs) for probsval in probs]
     probs = probs_temp
-    dropped_sentence = "" ## We will save the sentence to be dropped this batch and add it to the next batch.
-    dropped_language = "" ## We will save the language to be dropped this batch and add it to the next batch.
+    masked_sentences = yield_masked_sentences_mono(language_file_dict, language_list, probs, mp_val_or_range, mask_tok, args)
+    dropped_example = None ## We will save the example to be dropped this batch and add it to the next batch.
     while batch_count != args.num_batches:
         curr_batch_count = 0
         encoder_input_batch = []
@@ -567,55 +1206,17 @@ def generate_batches_monolingual_masked(tok, args, files, rank):
         if args.num_domains_for_domain_classifier > 1:
             domain_classifier_labels = []
         while True:
-            if dropped_sentence != "":
-                language = dropped_language # Reuse the previous language
-                sentence = dropped_sentence # Reuse the previous sentence
-                dropped_sentence = ""
-                dropped_language = ""
+            if dropped_example is not None:
+                language, sentence, masked_sentence = dropped_example # Reuse the previous example
+                dropped_example = None
             else:
-                language_index = random.choices(language_indices, probs)[0]
-                language = language_list[language_index]
-                sentence = next(language_file_dict[language_index]).strip()
+                language, sentence, masked_sentence = next(masked_sentences)
             if args.num_domains_for_domain_classifier > 1: ## Careful when handling domains for monolingual corpora.
                 lang = language.strip().split("-")[0]
                 lang = lang if args.use_official_pretrained else "<2"+lang+">"
             else:
                 lang = language if args.use_official_pretrained else "<2"+language+">"
-            if type(mp_val_or_range) is float:
-                mask_percent = mp_val_or_range
-            else:
-                mask_percent = random.uniform(mp_val_or_range[0], mp_val_or_range[1])
-            if args.is_document:
-                sentence_split, sentence, sent_len = sub_sample_and_permute_document(sentence, args.document_level_sentence_delimiter, args.max_length)
-            else:
-                sentence_split = sentence.split(" ")
-                sent_len = len(sentence_split)
-                if sent_len < 1: 
-                    continue
-                if sent_len > args.max_length: ## Initial truncation
-                    sentence_split = sentence_split[:args.max_length]
-                    sentence = " ".join(sentence_split)
-                    sent_len = args.max_length
-            mask_count = 0
-            max_mask_count = int(mask_percent*sent_len)
-            spans_to_mask = list(np.random.poisson(args.token_masking_lambda, 1000))
-            curr_sent_len = sent_len
-            while mask_count < max_mask_count:
-                try:
-                    span_to_mask = spans_to_mask[0]
-                    del spans_to_mask[0]
-                    if span_to_mask > (max_mask_count-mask_count): ## Cant mask more than the allowable number of tokens.
-                        continue
-                    idx_to_mask = random.randint(sent_len//2 if args.future_prediction else 0, (curr_sent_len-1)-(span_to_mask-1)) ## We mask only the remaining half of the sentence to encourage the model to learn representations that can make do without most of the future tokens.
-                    if mask_tok not in sentence_split[idx_to_mask:idx_to_mask+span_to_mask] and args.document_level_sentence_delimiter not in sentence_split[idx_to_mask:idx_to_mask+span_to_mask]:
-                        actually_masked_length = len(sentence_split[idx_to_mask:idx_to_mask+span_to_mask]) ## If at the end of the sentence then we have likely masked fewer tokens.
-                        sentence_split[idx_to_mask:idx_to_mask+span_to_mask] = [mask_tok]
-                        mask_count += actually_masked_length # We assume that with a low probability there are mask insertions when span lengths are 0 which may cause more mask tokens than planned. I have decided not to count these insersions towards the maximum maskable limit. This means that the total number of mask tokens will be a bit higher than what it should be. 
-                        curr_sent_len -= (actually_masked_length-1)
-                except:
-                    break ## If we cannot get a properly masked sentence despite all our efforts then we just give up and continue with what we have so far.
-            
-            masked_sentence = " ".join(sentence_split)
+            example = (language, sentence, masked_sentence)
             if args.span_prediction or args.span_to_sentence_prediction: ## We only predict the masked spans and not other tokens.
                 masked_sentence_split = masked_sentence.split(mask_tok)
                 final_sentence = ""
@@ -686,11 +1287,9 @@ def generate_batches_monolingual_masked(tok, args, files, rank):
                 potential_batch_count = max(max_src_sent_len, max_tgt_sent_len)*(sents_in_batch+1) ## Note that this will be unreliable when we do stochastic subword segmentation.
                 if potential_batch_count > args.batch_size: ## We will drop this sentence for now because we may go over the limit of what the GPU can handle. It may be used in a future iteration. Note that this will be unreliable when we do stochastic subword segmentation.
                     if curr_src_sent_len > args.batch_size or curr_tgt_sent_len > args.batch_size:
-                        dropped_sentence = "" ## Dangerous sentence detected. Exterminate with extreme prejudice!
-                        dropped_language = ""
+                        dropped_example = None ## Dangerous sentence detected. Exterminate with extreme prejudice!
                     else:
-                        dropped_sentence = sentence
-                        dropped_language = language
+                        dropped_example = example
                     break
                 if args.use_official_pretrained and ("bart" in args.pretrained_model or "barthez" in args.pretrained_model) and "mbart" not in args.pretrained_model: ## The bart tokenizer is wacky so we need to tweak the inputs a bit
                     encoder_input_batch.append(masked_sentence)
@@ -749,17 +1348,16 @@ def generate_batches_lm(tok, args, rank, files): ## Address compatibilities of t
     language_file_dict = {}
     probs = {}
     for l in language_list:
-        file_content = open(files[l]+"."+"%02d" % rank).readlines()
-        probs[l] = len(file_content)
-        language_file_dict[l] = yield_corpus_indefinitely_mono(file_content, l, args.sorted_batching)
+        probs[l] = get_shard_num_lines(files[l], rank, args) ## From the manifest so that we dont have to read the corpus before training starts.
+        print_corpus_stats(files[l], rank, l, args)
+        language_file_dict[l] = yield_corpus_indefinitely_mono(iterate_shard_lines(files[l], rank, args), l, args.sorted_batching)
     probs_temp = {lang: probs[lang]/sum(probs.values()) for lang in probs}
     probs = probs_temp
     probs_temp = {lang: probs[lang]**(1.0/args.data_sampling_temperature) for lang in probs} ## Temperature sampling probabilities.
     probs = probs_temp
     probs_temp = {lang: probs[lang]/sum(probs.values()) for lang in probs}
     probs = [probs_temp[lang] for lang in language_list]
-    num_langs = len(language_list)
-    language_indices = list(range(num_langs))
+    language_sampler = get_language_sampler(probs, args)
     has_rem=False
     while batch_count != args.num_batches:
         curr_batch_count = 0
@@ -771,7 +1369,7 @@ def generate_batches_lm(tok, args, rank, files): ## Address compatibilities of t
         sents_in_batch = 0
         while True:
             if not has_rem:
-                language_idx = random.choices(language_indices, probs)[0]
+                language_idx = next(language_sampler)
                 sentence = next(language_file_dict[language_list[language_idx]]).strip()
                 lang = "<2"+language_list[language_idx]+">"
                 sentence_split = sentence.split(" ")
@@ -857,6 +1455,173 @@ def freeze_embeds(model):
         for d in [model.encoder, model.decoder]:
             freeze_params(d.embed_tokens)
 
+class Int8Linear(nn.Module):
+    """A frozen linear layer whose weights are stored as int8 with one scale per output feature. The weights are dequantized on the fly in the forward pass so the layer needs about a quarter of the memory of a float32 layer. Works on the GPU unlike the dynamic quantization of pytorch."""
+    def __init__(self, linear):
+        super().__init__()
+        weight = linear.weight.data.float()
+        scale = weight.abs().max(dim=1, keepdim=True)[0].clamp(min=1e-8)/127.0
+        self.in_features = linear.in_features
+        self.out_features = linear.out_features
+        self.register_buffer("weight_int8", torch.round(weight/scale).to(torch.int8))
+        self.register_buffer("scale", scale.to(linear.weight.dtype))
+        self.register_buffer("bias", linear.bias.data if linear.bias is not None else None)
+    
+    def forward(self, x):
+        return F.linear(x, self.weight_int8.to(x.dtype)*self.scale.to(x.dtype), self.bias.to(x.dtype) if self.bias is not None else None)
+
+def quantize_linear_layers_to_int8(module, exception=["lm_head", "shared_proj"]):
+    """Replaces the linear layers of a module with Int8Linear layers. The layers in the exception list are kept since their weights are used directly (the LM head is tied to the embeddings)."""
+    for name, child in module.named_children():
+        if name in exception:
+            continue
+        if isinstance(child, nn.Linear):
+            setattr(module, name, Int8Linear(child))
+        else:
+            quantize_linear_layers_to_int8(child, exception)
+    return module
+
+def prepare_frozen_parent(parent_model, args):
+    """Turns the parent model into an inference only teacher for distillation. Its parameters are frozen, it is put in eval mode unless dropout is asked for and it is cast to half precision or its linear layers are quantized to int8 if asked. Call this after loading the parent weights."""
+    freeze_params(parent_model)
+    if args.parent_precision == "fp16":
+        parent_model.half()
+    elif args.parent_precision == "int8":
+        quantize_linear_layers_to_int8(parent_model)
+    parent_model.train(args.frozen_parent_dropout)
+    print("Memory consumed by the frozen parent model", round(sum(tensor.numel()*tensor.element_size() for tensor in list(parent_model.parameters())+list(parent_model.buffers()))/(1024**3), 2), "GB")
+    return parent_model
+
+def get_parent_output_flags(args):
+    """Returns whether the parent model should output its hidden states and its attentions. Only what the distillation styles need is asked for."""
+    distillation_styles = args.distillation_styles.split(",")
+    return "hidden_layer_regression" in distillation_styles, "attention_distillation" in distillation_styles
+
+class MetricAggregator(object):
+    """Keeps running sums of the training metrics on the device so that logging a metric does not make us wait for the device. The sums and counts are brought to the CPU in one transfer every time the metrics are flushed and their averages since the last flush are written to tensorboard. Metrics can be added on every process and can optionally be averaged over all the processes at flush time in which case every process must flush at the same steps."""
+    def __init__(self, writer, device, reduce_across_ranks=False):
+        self.writer = writer ## None for the processes that dont write logs.
+        self.device = device
+        self.reduce_across_ranks = reduce_across_ranks
+        self.names = []
+        self.name_to_index = {}
+        self.counts = []
+        self.sums = torch.zeros(0, dtype=torch.float32, device=device)
+    
+    def add(self, name, value):
+        """Adds a tensor (or a number) to the running sum of a metric. Tensors are detached and never synchronized here."""
+        if name not in self.name_to_index:
+            self.name_to_index[name] = len(self.names)
+            self.names.append(name)
+            self.counts.append(0)
+            self.sums = torch.cat([self.sums, torch.zeros(1, dtype=torch.float32, device=self.device)])
+        index = self.name_to_index[name]
+        self.sums[index] += value.detach().float().mean() if torch.is_tensor(value) else value
+        self.counts[index] += 1
+    
+    def flush(self, ctr):
+        """Writes the averages of the metrics since the last flush and resets them."""
+        names = self.names
+        sums = self.sums
+        counts = torch.tensor(self.counts, dtype=torch.float32, device=self.device)
+        if self.reduce_across_ranks: ## The processes may have seen different metrics so we first agree on the names.
+            all_names = [None for _ in range(dist.get_world_size())]
+            dist.all_gather_object(all_names, names)
+            names = sorted(set(name for rank_names in all_names for name in rank_names))
+            sums_and_counts = torch.zeros(2, len(names), dtype=torch.float32, device=self.device)
+            for index, name in enumerate(self.names):
+                sums_and_counts[0, names.index(name)] = sums[index]
+                sums_and_counts[1, names.index(name)] = counts[index]
+            dist.all_reduce(sums_and_counts)
+            sums, counts = sums_and_counts[0], sums_and_counts[1]
+        if len(names) > 0:
+            averages = (sums/counts.clamp(min=1)).tolist() ## The only transfer from the device.
+            counts = counts.tolist()
+            if self.writer is not None:
+                for name, average, count in zip(names, averages, counts):
+                    if count > 0:
+                        self.writer.add_scalar(name, average, ctr)
+        self.sums.zero_()
+        self.counts = [0 for _ in self.counts]
+
+def set_gradient_synchronization(model, synchronize):
+    """Turns the all-reduce of the gradients of a DDP wrapped model in the backward pass on or off. This is what model.no_sync() does but the forward and backward passes of our training loops are too far apart for a context manager. It must be set before the forward pass. When accumulating gradients over several batches only the backward pass of the last batch needs to synchronize since the all-reduce of the summed gradients gives the same result."""
+    model.require_backward_grad_sync = synchronize
+
+def setup_process_device(gpu, rank, args):
+    """Initializes the process group and returns the device of this process. With --device cpu the gloo backend is used, the device is the cpu and the cores of the node are split among its processes (--gpus of them) via torch.set_num_threads. Otherwise the nccl backend is used and the device is the index of the GPU. Either can be passed wherever the scripts use the gpu variable as a device."""
+    if args.device == "cpu":
+        dist.init_process_group(backend='gloo', init_method='env://', world_size=args.world_size, rank=rank)
+        num_threads = args.num_threads_per_process if args.num_threads_per_process > 0 else max(1, os.cpu_count()//args.gpus)
+        torch.set_num_threads(num_threads)
+        print("Using the CPU with", num_threads, "threads on rank", rank)
+        return torch.device("cpu")
+    dist.init_process_group(backend='nccl', init_method='env://', world_size=args.world_size, rank=rank)
+    return gpu
+
+def is_cpu_device(device):
+    return isinstance(device, torch.device) and device.type == "cpu"
+
+def set_device(device):
+    """Makes the GPU the current CUDA device. Does nothing on the CPU."""
+    if not is_cpu_device(device):
+        torch.cuda.set_device(device)
+
+def get_map_location(device):
+    """Returns the map location which loads a checkpoint saved by the first process (on GPU 0) onto the device of this process."""
+    return "cpu" if is_cpu_device(device) else {'cuda:%d' % 0: 'cuda:%d' % device}
+
+def get_memory_allocated(device):
+    """Returns the GPU memory allocated by this process in GB. Always 0 on the CPU."""
+    return 0.0 if is_cpu_device(device) else round(torch.cuda.memory_allocated(device)/(1024**3), 2)
+
+def wrap_in_ddp(model, device):
+    """Wraps a model in DistributedDataParallel for the device of this process."""
+    if is_cpu_device(device):
+        return DistributedDataParallel(model)
+    return DistributedDataParallel(model, device_ids=[device], output_device=device)
+
+class ModelWrapper(nn.Module):
+    """Holds a model as .module like DistributedDataParallel does so that the code written for DDP models (model.module.generate, checkpoints with "module." prefixed keys) works unchanged, but nothing is synchronized between the processes. Used for decoding quantized models which DDP cannot wrap since their packed weights cannot be broadcast."""
+    def __init__(self, module):
+        super().__init__()
+        self.module = module
+    
+    def forward(self, *args, **kwargs):
+        return self.module(*args, **kwargs)
+
+def compute_parameter_checksums(model):
+    """Returns a small tensor with the sum and the sum of absolute values (in float64) of every parameter of the model. Two replicas with the same checksums almost certainly have the same parameters and comparing the checksums costs one pass over the parameters and the communication of a few kilobytes."""
+    return torch.stack([torch.stack([param.detach().double().sum(), param.detach().double().abs().sum()]) for param in model.parameters()])
+
+def reload_from_checkpoint(model, optimizer, scheduler, checkpoint_path, gpu):
+    """Loads the model, optimizer and scheduler states from a checkpoint saved by the prime process."""
+    print("Loading from checkpoint")
+    sys.stdout.flush()
+    checkpoint_dict = torch.load(checkpoint_path, map_location=get_map_location(gpu))
+    model.load_state_dict(checkpoint_dict['model'])
+    optimizer.load_state_dict(checkpoint_dict['optimizer'])
+    scheduler.load_state_dict(checkpoint_dict['scheduler'])
+    del checkpoint_dict
+    torch.cuda.empty_cache()
+
+def synchronize_after_checkpoint(model, optimizer, scheduler, checkpoint_path, checkpoint_writer, gpu, args):
+    """Makes sure that all processes have the same model after the prime process has saved a checkpoint. DDP already keeps the replicas identical since they start from the same parameters and see the same gradients so reloading the checkpoint on every process (the "reload" mode) is not needed and on shared file systems with many processes it is a very slow thundering herd of reads. The "none" mode skips the reload. The "checksum" mode compares the parameter checksums of every process with those of the prime process and only reloads the checkpoint (on all processes) if any of them differ. The checkpoint writer is that of the prime process (None for the others) which may still be writing the checkpoint in the background so it has to finish before the checkpoint is reloaded."""
+    if args.checkpoint_sync_mode == "reload":
+        reload_from_checkpoint(model, optimizer, scheduler, checkpoint_path, gpu)
+    elif args.checkpoint_sync_mode == "checksum":
+        local_checksums = compute_parameter_checksums(model)
+        prime_checksums = local_checksums.clone()
+        dist.broadcast(prime_checksums, 0)
+        mismatch = torch.tensor([0 if torch.equal(local_checksums, prime_checksums) else 1], device=local_checksums.device)
+        dist.all_reduce(mismatch, op=dist.ReduceOp.MAX)
+        if mismatch.item() == 1:
+            print("The parameters of the processes have diverged. Reloading the checkpoint.")
+            if checkpoint_writer is not None:
+                checkpoint_writer.wait()
+            dist.barrier() ## The other processes must not read the checkpoint before it is written.
+            reload_from_checkpoint(model, optimizer, scheduler, checkpoint_path, gpu)
+
 def generate_batches_eval_bilingual(tok, args, file, slang):
     """Generates the source sentences for the dev set. This ensures that long sentences are truncated and then batched. The batch size is the number of sentences and not the number of tokens."""
     src_file = file
@@ -971,8 +1736,46 @@ def generate_batches_eval_bilingual(tok, args, file, slang):
             yield input_ids, input_masks
 
 
+def build_sorted_eval_batches(tok, args, file, slang):
+    """Tokenizes the source sentences of a dev set once (with the same truncation as generate_batches_eval_bilingual) and batches them after sorting them by length so that there is very little padding. With args.dev_batch_tokens > 0 a batch has at most that many tokens post padding and otherwise it has args.dev_batch_size sentences. The batches can be decoded as often as needed. Returns the list of batches in the same format as generate_batches_eval_bilingual and the inverse permutation which restores the original order of the hypotheses: hypotheses[i] = sorted_hypotheses[inverse_permutation[i]]."""
+    sentences = []
+    sentences_parent = []
+    for input_ids, input_masks in generate_batches_eval_bilingual(tok, args, file, slang):
+        if args.multi_source:
+            input_ids, input_ids_parent = input_ids
+            input_masks, input_masks_parent = input_masks
+            sentences_parent.extend(row[mask.bool()] for row, mask in zip(input_ids_parent, input_masks_parent))
+        sentences.extend(row[mask.bool()] for row, mask in zip(input_ids, input_masks)) ## Remove the padding.
+    permutation = sorted(range(len(sentences)), key=lambda idx: len(sentences[idx]), reverse=True) ## Longest first so that we run out of memory (if at all) in the first batch.
+    batches = []
+    batch = []
+    for idx in permutation:
+        curr_max_sent_len = len(sentences[batch[0]]) if len(batch) > 0 else len(sentences[idx]) ## The first sentence of a batch is the longest.
+        if len(batch) > 0 and ((args.dev_batch_tokens > 0 and curr_max_sent_len*(len(batch)+1) > args.dev_batch_tokens) or (args.dev_batch_tokens <= 0 and len(batch) == args.dev_batch_size)):
+            batches.append(batch)
+            batch = []
+        batch.append(idx)
+    if len(batch) > 0:
+        batches.append(batch)
+    for batch_idx, batch in enumerate(batches):
+        input_ids = pad_id_sequences([sentences[idx] for idx in batch], tok.pad_token_id)
+        input_masks = (input_ids != tok.pad_token_id).int()
+        if args.multi_source:
+            input_ids_parent = pad_id_sequences([sentences_parent[idx] for idx in batch], tok.pad_token_id)
+            input_masks_parent = (input_ids_parent != tok.pad_token_id).int()
+            batches[batch_idx] = ([input_ids, input_ids_parent], [input_masks, input_masks_parent])
+        else:
+            batches[batch_idx] = (input_ids, input_masks)
+    inverse_permutation = np.argsort(np.array(permutation, dtype=np.int64)).tolist()
+    return batches, inverse_permutation
+
 def generate_batches_bilingual(tok, args, files, rank):
     """Generates the source, target and source attention masks for the training set. The source and target sentences are ignored if empty and are truncated if longer than a threshold. The batch size in this context is the maximum number of tokens in the batch post padding."""
+    if args.use_binarized_corpora or args.tokenize_once: ## The corpora have been tokenized offline via binarize_corpus.py or we tokenize each sentence exactly once so we batch directly from token ids.
+        yield from generate_batches_bilingual_from_ids(tok, args, files, rank)
+        return
+    assert not (args.bucketed_batching or args.pack_examples), "Bucketed batching and packing need exact token lengths. Use them with --tokenize_once or --use_binarized_corpora."
+    
     if args.tokenization_sampling:
         print("Stochastic tokenizer will be used.")
         if "mbart" in args.tokenizer_name_or_path:
@@ -997,12 +1800,10 @@ def generate_batches_bilingual(tok, args, files, rank):
     print("Training for:", language_list)
     language_file_dict = []
     probs = []
-    language_indices = [i for i in range(len(language_list))]
     for lang, file_details in files:
-        src_file_content = open(file_details[0]+"."+"%02d" % rank).readlines()
-        tgt_file_content = open(file_details[1]+"."+"%02d" % rank).readlines()
-        probs.append(len(src_file_content))
-        file_content = list(zip(src_file_content, tgt_file_content))
+        probs.append(get_shard_num_lines(file_details[0], rank, args)) ## From the manifest so that we dont have to read the corpus before training starts.
+        print_corpus_stats(file_details[1], rank, lang, args)
+        file_content = (iterate_shard_lines(file_details[0], rank, args), iterate_shard_lines(file_details[1], rank, args))
         language_file_dict.append(yield_corpus_indefinitely_bi(file_content, lang, args.sorted_batching))
     print("Corpora stats:", probs)
     probs_temp = [probval/sum(probs) for probval in probs]
@@ -1011,6 +1812,7 @@ def generate_batches_bilingual(tok, args, files, rank):
     probs = probs_temp
     probs_temp = [probsval/sum(probs) for probsval in probs]
     probs = probs_temp
+    language_sampler = get_language_sampler(probs, args)
     dropped_source_sentence = "" ## We will save the source sentence to be dropped this batch and add it to the next batch.
     dropped_target_sentence = "" ## We will save the target sentence to be dropped this batch and add it to the next batch.
     dropped_language = "" ## We will save the language indicator to be dropped this batch and add it to the next batch.
@@ -1043,7 +1845,7 @@ def generate_batches_bilingual(tok, args, files, rank):
                     src_sent_parent = dropped_source_sentence_parent # Reuse the previous source sentence
                     dropped_source_sentence_parent = ""
             else:
-                language_index = random.choices(language_indices, probs)[0]
+                language_index = next(language_sampler)
                 language = language_list[language_index]
                 src_sent, tgt_sent = next(language_file_dict[language_index])
                 if args.cross_distillation or args.multi_source: ## We assume that we use a N-way corpus of 3 languages X, Y and Z. We want to distill Y-Z behavior into X-Z where the Y-Z pair also has additional larger corpora but X-Z does not. As such the source sentence should be a tab separated sentence consisting of X[tab]Y.
@@ -1096,24 +1898,7 @@ def generate_batches_bilingual(tok, args, files, rank):
                         mask_percent = mp_val_or_range
                     else:
                         mask_percent = random.uniform(mp_val_or_range[0], mp_val_or_range[1])
-                mask_count = 0
-                max_mask_count = int(mask_percent*src_sent_len)
-                spans_to_mask = list(np.random.poisson(args.token_masking_lambda, 1000))
-                curr_sent_len = src_sent_len
-                while mask_count < max_mask_count:
-                    try:
-                        span_to_mask = spans_to_mask[0]
-                        del spans_to_mask[0]
-                        if span_to_mask > (max_mask_count-mask_count): ## Cant mask more than the allowable number of tokens.
-                            continue
-                        idx_to_mask = random.randint(curr_sent_len//2 if args.future_prediction else 0, (curr_sent_len-1)-(span_to_mask-1))
-                        if mask_tok not in src_sent_split[idx_to_mask:idx_to_mask+span_to_mask]:
-                            actually_masked_length = len(src_sent_split[idx_to_mask:idx_to_mask+span_to_mask]) ## If at the end of the sentence then we have likely masked fewer tokens.
-                            src_sent_split[idx_to_mask:idx_to_mask+span_to_mask] = [mask_tok]
-                            mask_count += actually_masked_length # We assume that with a low probability there are mask insertions when span lengths are 0 which may cause more mask tokens than planned. I have decided not to count these insersions towards the maximum maskable limit. This means that the total number of mask tokens will be a bit higher than what it should be. 
-                            curr_sent_len -= (actually_masked_length-1)
-                    except:
-                        break ## If we cannot get a properly masked sentence despite all our efforts then we just give up and continue with what we have so far.
+                src_sent_split = mask_spans_in_batch([src_sent_split], [mask_percent], mask_tok, args)[0]
                 src_sent = " ".join(src_sent_split)
                 if args.span_prediction or args.span_to_sentence_prediction: ## We only predict the masked spans and not other tokens.
                     masked_sentence_split = src_sent.split(mask_tok)
@@ -1299,6 +2084,311 @@ def generate_batches_bilingual(tok, args, files, rank):
                 yield input_ids, input_masks, decoder_input_ids, labels
 
             
+def yield_masked_id_sentences_mono(language_corpora, language_file_dict, probs, mp_val_or_range, mask_word, word_starts, args, block_size=256):
+    """Same as yield_masked_sentences_mono but for TokenIdCorpus objects. The sentences are split into words using the word start flags and masked in blocks with mask_spans_in_batch. Yields tuples of the language index, the (truncated) token ids and the masked token ids."""
+    language_sampler = get_language_sampler(probs, args)
+    while True:
+        language_indices_block = []
+        word_lists = []
+        mask_percents = []
+        for _ in range(block_size):
+            language_index = next(language_sampler)
+            sentence = language_corpora[language_index][next(language_file_dict[language_index])]
+            if len(sentence) < 1:
+                continue
+            if type(mp_val_or_range) is float:
+                mask_percent = mp_val_or_range
+            else:
+                mask_percent = random.uniform(mp_val_or_range[0], mp_val_or_range[1])
+            language_indices_block.append(language_index)
+            word_lists.append(split_words_from_ids(sentence, word_starts)[:args.max_length]) ## Initial truncation
+            mask_percents.append(mask_percent)
+        masked_word_lists = mask_spans_in_batch(word_lists, mask_percents, mask_word, args)
+        for language_index, words, masked_words in zip(language_indices_block, word_lists, masked_word_lists):
+            yield language_index, np.concatenate(words), np.concatenate(masked_words)
+
+def build_id_example(source, target, slang_id, tlang_id, bos_id, eos_id, is_bart, args, unify_encoder=False):
+    """Adds the language indicator tokens and special tokens to the source and target token ids and does the hard truncation the same way as the text based generators do it. Returns the encoder input, decoder input and decoder labels."""
+    if is_bart: ## Mirrors what the bart tokenizer does with the raw text.
+        encoder_input = np.concatenate([[bos_id], source[:args.hard_truncate_length-2], [eos_id]])
+        decoder_full = np.concatenate([[bos_id], target[:args.hard_truncate_length-2], [eos_id]])
+        return encoder_input, decoder_full[:-1], decoder_full[1:]
+    source = source[:args.hard_truncate_length-2]
+    target = target[:args.hard_truncate_length-1]
+    if args.use_official_pretrained and "50" in args.pretrained_model: ## mbart-50 model has a different input representation
+        encoder_input = np.concatenate([[slang_id], source, [eos_id]])
+    else:
+        encoder_input = np.concatenate([source, [eos_id, slang_id]])
+    if unify_encoder:
+        decoder_input = np.concatenate([target, [eos_id, tlang_id]])
+        return encoder_input, decoder_input, decoder_input ## The labels should not be used when we unify encoders.
+    return encoder_input, np.concatenate([[tlang_id], target]), np.concatenate([target, [eos_id]])
+
+def truncate_id_pair(src_sent, tgt_sent, word_starts, args):
+    """Truncates the source and target token ids of a parallel sentence at the word level. Returns the source words, which are needed for source masking, and the truncated source and target ids."""
+    src_words = split_words_from_ids(src_sent, word_starts)[:args.max_src_length] ## Initial truncation
+    return src_words, np.concatenate(src_words), np.concatenate(split_words_from_ids(tgt_sent, word_starts)[:args.max_tgt_length])
+
+def yield_id_examples_bi(tok, args, language_list, language_corpora, language_file_dict, probs, mp_val_or_range, word_starts, is_bart):
+    """Samples parallel sentences from TokenIdCorpus pairs, truncates them at the word level, masks the source for the copying task and adds the special tokens. Yields tuples of the language index, encoder input, decoder input and decoder labels."""
+    mask_word = get_mask_word_ids(tok, args)
+    bos_id = tok.convert_tokens_to_ids("<s>")
+    eos_id = tok.convert_tokens_to_ids("</s>")
+    language_sampler = get_language_sampler(probs, args)
+    while True:
+        language_index = next(language_sampler)
+        language = language_list[language_index]
+        src_corpus, tgt_corpus = language_corpora[language_index]
+        line_idx = next(language_file_dict[language_index])
+        src_sent = src_corpus[line_idx]
+        tgt_sent = tgt_corpus[line_idx]
+        if len(src_sent) < 1 or len(tgt_sent) < 1:
+            continue
+        slangtlang = language.strip().split("-")
+        slang = slangtlang[0] if args.use_official_pretrained else "<2"+slangtlang[0]+">"
+        tlang = slangtlang[1] if args.use_official_pretrained else "<2"+slangtlang[1]+">"
+        src_words, src_sent, tgt_sent = truncate_id_pair(src_sent, tgt_sent, word_starts, args)
+        if (slang == tlang and not args.is_summarization) or args.source_masking_for_bilingual: ## Copying task should DEFINITELY use source masking unless we are doing summarization.
+            if args.source_masking_for_bilingual:
+                mask_percent = random.uniform(0.0, mp_val_or_range[0]) ## Do less masking
+            else:
+                if type(mp_val_or_range) is float:
+                    mask_percent = mp_val_or_range
+                else:
+                    mask_percent = random.uniform(mp_val_or_range[0], mp_val_or_range[1])
+            src_sent = mask_words_from_ids(src_words, mask_word, mask_percent, args)
+        yield (language_index,) + build_id_example(src_sent, tgt_sent, tok.convert_tokens_to_ids(slang), tok.convert_tokens_to_ids(tlang), bos_id, eos_id, is_bart, args, unify_encoder=args.unify_encoder)
+
+def yield_token_budget_batches(sized_examples, args):
+    """Groups a stream of (source length, target length, example) tuples into batches in the order in which they arrive. The batch size is either the number of examples or the maximum number of tokens in the batch post padding. An example that would exceed the token budget is kept for the next batch unless it can never fit in a batch in which case it is dropped."""
+    dropped_example = None ## We will save the example to be dropped this batch and add it to the next batch.
+    while True:
+        batch = []
+        max_src_sent_len = 0
+        max_tgt_sent_len = 0
+        while True:
+            if dropped_example is not None:
+                curr_src_sent_len, curr_tgt_sent_len, example = dropped_example # Reuse the previous example
+                dropped_example = None
+            else:
+                curr_src_sent_len, curr_tgt_sent_len, example = next(sized_examples)
+            max_src_sent_len = max(max_src_sent_len, curr_src_sent_len)
+            max_tgt_sent_len = max(max_tgt_sent_len, curr_tgt_sent_len)
+            if not args.batch_size_indicates_lines:
+                potential_batch_count = max(max_src_sent_len, max_tgt_sent_len)*(len(batch)+1) ## We limit ourselves based on the maximum of either source or target.
+                if potential_batch_count > args.batch_size: ## We will drop this example for now. It may be used in a future iteration.
+                    if curr_src_sent_len > args.batch_size or curr_tgt_sent_len > args.batch_size: ## Dangerous sentences. Drop them no matter what.
+                        dropped_example = None
+                    else:
+                        dropped_example = (curr_src_sent_len, curr_tgt_sent_len, example)
+                    break
+            batch.append(example)
+            if args.batch_size_indicates_lines and len(batch) == args.batch_size: ## Batch a fixed number of sentences.
+                break
+        yield batch
+
+def yield_bucketed_batches(sized_examples, args):
+    """Groups a stream of (source length, target length, example) tuples into batches using length buckets. A pool of examples is read and every example goes to the bucket of its (source length, target length) pair where the buckets are args.bucket_width tokens wide. Each bucket is cut into batches in the order in which its examples arrived and a batch is closed as soon as the next example would exceed the batch size (number of examples or the maximum number of tokens post padding). The leftover examples of each bucket are carried over to the next pool and the batches of a pool are shuffled globally so that consecutive batches do not have similar lengths. Since all the examples in a batch have similar lengths there is very little padding. With language homogeneous batches, the language is part of the bucket."""
+    leftovers = {}
+    while True:
+        buckets = leftovers
+        leftovers = {}
+        for curr_src_sent_len, curr_tgt_sent_len, example in islice(sized_examples, args.bucketing_pool_size):
+            if not args.batch_size_indicates_lines and (curr_src_sent_len > args.batch_size or curr_tgt_sent_len > args.batch_size): ## Dangerous sentences. Drop them no matter what.
+                continue
+            bucket = (curr_src_sent_len//args.bucket_width, curr_tgt_sent_len//args.bucket_width)
+            if args.language_homogeneous_batches: ## Each batch will have only one language.
+                bucket = (example[0],) + bucket
+            if bucket not in buckets:
+                buckets[bucket] = []
+            buckets[bucket].append((curr_src_sent_len, curr_tgt_sent_len, example))
+        batches = []
+        for bucket, bucket_examples in buckets.items():
+            batch = []
+            max_sent_len = 0
+            for curr_src_sent_len, curr_tgt_sent_len, example in bucket_examples:
+                curr_max_sent_len = max(max_sent_len, curr_src_sent_len, curr_tgt_sent_len)
+                if (args.batch_size_indicates_lines and len(batch) == args.batch_size) or (not args.batch_size_indicates_lines and curr_max_sent_len*(len(batch)+1) > args.batch_size):
+                    batches.append(batch)
+                    batch = []
+                    curr_max_sent_len = max(curr_src_sent_len, curr_tgt_sent_len)
+                batch.append(example)
+                max_sent_len = curr_max_sent_len
+            leftovers[bucket] = bucket_examples[len(bucket_examples)-len(batch):] ## The last partial batch of each bucket waits for more examples.
+        random.shuffle(batches)
+        for batch in batches:
+            yield batch
+
+def pack_id_examples(examples):
+    """Concatenates (language index, encoder input, decoder input, decoder labels) token id examples into one packed example. The segment ids number the packed examples starting from 1 on the encoder and decoder sides so that 0 can be used for padding. The language index of the first example is kept."""
+    encoder_inputs = [example[1] for example in examples]
+    decoder_inputs = [example[2] for example in examples]
+    segments = np.arange(1, len(examples)+1)
+    encoder_segment_ids = np.repeat(segments, [len(encoder_input) for encoder_input in encoder_inputs])
+    decoder_segment_ids = np.repeat(segments, [len(decoder_input) for decoder_input in decoder_inputs])
+    return examples[0][0], np.concatenate(encoder_inputs), np.concatenate(decoder_inputs), np.concatenate([example[3] for example in examples]), encoder_segment_ids, decoder_segment_ids
+
+def yield_packed_examples(sized_examples, args):
+    """Packs consecutive (source length, target length, example) tuples into rows of at most args.pack_length tokens on the source and target sides so that batches of short sentences are not mostly padding. An example longer than args.pack_length gets a row of its own. Yields (source length, target length, packed example) tuples which can be batched like normal examples."""
+    packed = []
+    packed_src_len = 0
+    packed_tgt_len = 0
+    for curr_src_sent_len, curr_tgt_sent_len, example in sized_examples:
+        if len(packed) > 0 and (packed_src_len + curr_src_sent_len > args.pack_length or packed_tgt_len + curr_tgt_sent_len > args.pack_length):
+            yield packed_src_len, packed_tgt_len, pack_id_examples(packed)
+            packed = []
+            packed_src_len = 0
+            packed_tgt_len = 0
+        packed.append(example)
+        packed_src_len += curr_src_sent_len
+        packed_tgt_len += curr_tgt_sent_len
+
+def batch_id_examples(examples, tok, args, is_bart, domain_labels=None):
+    """Pads the (language index, encoder input, decoder input, decoder labels) token id examples into batches. The examples are packed into longer rows if args.pack_examples is set. They are grouped by the length bucketed scheduler if args.bucketed_batching is set and in their original order otherwise. Domain labels for the domain classifier are looked up via the language index when they are given."""
+    sized_examples = ((len(example[1]), len(example[2])+1 if is_bart else len(example[2]), example) for example in examples) ## For bart the text based generator counts the target length before shifting.
+    if args.pack_examples:
+        assert not (is_bart or domain_labels is not None or args.unify_encoder), "Packing needs an MBart model and cant be used with domain classifiers or encoder unification."
+        sized_examples = yield_packed_examples(sized_examples, args)
+    if args.bucketed_batching:
+        batches = yield_bucketed_batches(sized_examples, args)
+    else:
+        batches = yield_token_budget_batches(sized_examples, args)
+    batch_count = 0
+    while batch_count != args.num_batches:
+        batch = next(batches)
+        batch_count += 1
+        if len(batch) == 0:
+            print("Zero size batch due to an abnormal example. Skipping empty batch.")
+            continue
+        input_ids = pad_id_sequences([example[1] for example in batch], tok.pad_token_id)
+        input_masks = (input_ids != tok.pad_token_id).int()
+        decoder_input_ids = pad_id_sequences([example[2] for example in batch], tok.pad_token_id)
+        labels = pad_id_sequences([example[3] for example in batch], tok.pad_token_id)
+        if args.pack_examples: ## Like with multi source training the input masks are a list. It contains the attention masks and the segment ids of the packed examples which are needed for the block diagonal attention masks.
+            input_masks = [input_masks, pad_id_sequences([example[4] for example in batch], 0), pad_id_sequences([example[5] for example in batch], 0)]
+        if domain_labels is not None:
+            yield input_ids, input_masks, decoder_input_ids, [labels, [domain_labels[example[0]] for example in batch]] ## We are going to pass the domain indicator batch along with the labels
+        else:
+            yield input_ids, input_masks, decoder_input_ids, labels
+
+def generate_batches_monolingual_masked_from_ids(tok, args, files, rank):
+    """Generates the source, target and source attention masks for denoising from token ids. The ids come from memory mapped corpus shards created by binarize_corpus.py or from tokenizing each sentence exactly once. Sentences are truncated and masked at the word level, language indicator tokens are added and the sequences are padded without going back to text."""
+    assert not (args.is_document or args.span_prediction or args.span_to_sentence_prediction or args.tokenization_sampling), "Document level denoising, span prediction and stochastic tokenization need the raw text. Dont use binarized corpora or tokenize once with these."
+    is_bart = args.use_official_pretrained and ("bart" in args.pretrained_model or "barthez" in args.pretrained_model) and "mbart" not in args.pretrained_model
+    mask_word = get_mask_word_ids(tok, args)
+    bos_id = tok.convert_tokens_to_ids("<s>")
+    eos_id = tok.convert_tokens_to_ids("</s>")
+    word_starts = get_word_start_flags(tok)
+    if len(args.token_masking_probs_range) == 1:
+        mp_val_or_range = args.token_masking_probs_range[0]
+    elif len(args.token_masking_probs_range) == 2:
+        mp_val_or_range = args.token_masking_probs_range
+    print("Masking ratio:", mp_val_or_range)
+    language_list = [lang for lang, _ in files]
+    print("Training for:", language_list)
+    language_corpora = []
+    language_file_dict = []
+    lang_ids = []
+    probs = []
+    for lang, file_details in files:
+        path = file_details[0] if args.num_domains_for_domain_classifier > 1 else file_details
+        corpus = TokenIdCorpus(path, rank, tok, args)
+        probs.append(get_shard_num_lines(path, rank, args)) ## From the manifest or the offsets so that we dont have to read the corpus before training starts.
+        print_corpus_stats(path, rank, lang, args)
+        language_corpora.append(corpus)
+        language_file_dict.append(yield_corpus_line_indices_indefinitely(corpus, lang, args.sorted_batching))
+        if args.num_domains_for_domain_classifier > 1: ## Careful when handling domains for monolingual corpora.
+            lang = lang.strip().split("-")[0]
+        lang_ids.append(tok.convert_tokens_to_ids(lang if args.use_official_pretrained else "<2"+lang+">"))
+    probs_temp = [probval/sum(probs) for probval in probs]
+    probs = probs_temp
+    probs_temp = [probsval**(1.0/args.data_sampling_temperature) for probsval in probs] ## Temperature sampling probabilities.
+    probs = probs_temp
+    probs_temp = [probsval/sum(probs) for probsval in probs]
+    probs = probs_temp
+    masked_sentences = yield_masked_id_sentences_mono(language_corpora, language_file_dict, probs, mp_val_or_range, mask_word, word_starts, args)
+    examples = ((language_index,) + build_id_example(masked_sentence, sentence, lang_ids[language_index], lang_ids[language_index], bos_id, eos_id, is_bart, args) for language_index, sentence, masked_sentence in masked_sentences)
+    yield from batch_id_examples(examples, tok, args, is_bart, [file_details[1] for _, file_details in files] if args.num_domains_for_domain_classifier > 1 else None)
+
+def generate_batches_bilingual_from_ids(tok, args, files, rank):
+    """Generates the source, target and source attention masks for the training set from token ids. The ids come from memory mapped corpus shards created by binarize_corpus.py or from tokenizing each sentence exactly once. Truncation, language indicator tokens, decoder input shifting and padding are done on the ids. The batch size in this context is the maximum number of tokens in the batch post padding."""
+    assert not (args.cross_distillation or args.multi_source or args.span_prediction or args.span_to_sentence_prediction or args.tokenization_sampling), "Multi source training, cross distillation, span prediction and stochastic tokenization need the raw text. Dont use binarized corpora or tokenize once with these."
+    is_bart = args.use_official_pretrained and ("bart" in args.pretrained_model or "barthez" in args.pretrained_model) and "mbart" not in args.pretrained_model
+    word_starts = get_word_start_flags(tok)
+    if len(args.token_masking_probs_range) == 1:
+        mp_val_or_range = args.token_masking_probs_range[0]
+    elif len(args.token_masking_probs_range) == 2:
+        mp_val_or_range = args.token_masking_probs_range
+    if not args.is_summarization or args.source_masking_for_bilingual:
+        print("Masking ratio:", mp_val_or_range)
+
+    language_list = [lang for lang, _ in files]
+    print("Training for:", language_list)
+    language_corpora = []
+    language_file_dict = []
+    probs = []
+    for lang, file_details in files:
+        src_corpus = TokenIdCorpus(file_details[0], rank, tok, args)
+        tgt_corpus = TokenIdCorpus(file_details[1], rank, tok, args)
+        num_src_lines, num_tgt_lines = get_shard_num_lines(file_details[0], rank, args), get_shard_num_lines(file_details[1], rank, args)
+        assert num_src_lines == num_tgt_lines, "The source and target shards for "+lang+" have a different number of lines."
+        probs.append(num_src_lines)
+        print_corpus_stats(file_details[1], rank, lang, args)
+        language_corpora.append((src_corpus, tgt_corpus))
+        language_file_dict.append(yield_corpus_line_indices_indefinitely(tgt_corpus, lang, args.sorted_batching)) ## Sort on the target side like the text based generator.
+    print("Corpora stats:", probs)
+    probs_temp = [probval/sum(probs) for probval in probs]
+    probs = probs_temp
+    probs_temp = [probsval**(1.0/args.data_sampling_temperature) for probsval in probs] ## Temperature sampling probabilities.
+    probs = probs_temp
+    probs_temp = [probsval/sum(probs) for probsval in probs]
+    probs = probs_temp
+    examples = yield_id_examples_bi(tok, args, language_list, language_corpora, language_file_dict, probs, mp_val_or_range, word_starts, is_bart)
+    yield from batch_id_examples(examples, tok, args, is_bart, [file_details[2] for _, file_details in files] if args.num_domains_for_domain_classifier > 1 else None)
+
+def generate_batches_for_teacher_cache(tok, args, files, rank):
+    """Goes over all the lines of the training shards of this process once, in order, and yields padded batches of the token id examples exactly as generate_batches_bilingual_from_ids would create them. Used to build a teacher output cache. The training script rejects copying task pairs since their sources are masked randomly so they could never be looked up."""
+    is_bart = args.use_official_pretrained and ("bart" in args.pretrained_model or "barthez" in args.pretrained_model) and "mbart" not in args.pretrained_model
+    word_starts = get_word_start_flags(tok)
+    bos_id = tok.convert_tokens_to_ids("<s>")
+    eos_id = tok.convert_tokens_to_ids("</s>")
+    batch = []
+    max_src_sent_len = 0
+    max_tgt_sent_len = 0
+    for lang, file_details in files:
+        slangtlang = lang.strip().split("-")
+        slang = slangtlang[0] if args.use_official_pretrained else "<2"+slangtlang[0]+">"
+        tlang = slangtlang[1] if args.use_official_pretrained else "<2"+slangtlang[1]+">"
+        src_corpus = TokenIdCorpus(file_details[0], rank, tok, args)
+        tgt_corpus = TokenIdCorpus(file_details[1], rank, tok, args)
+        print("Caching the teacher outputs for", len(tgt_corpus), "lines of", lang)
+        for line_idx in range(len(tgt_corpus)):
+            src_sent = src_corpus[line_idx]
+            tgt_sent = tgt_corpus[line_idx]
+            if len(src_sent) < 1 or len(tgt_sent) < 1:
+                continue
+            _, src_sent, tgt_sent = truncate_id_pair(src_sent, tgt_sent, word_starts, args)
+            example = build_id_example(src_sent, tgt_sent, tok.convert_tokens_to_ids(slang), tok.convert_tokens_to_ids(tlang), bos_id, eos_id, is_bart, args)
+            curr_src_sent_len, curr_tgt_sent_len = len(example[0]), len(example[1])
+            if len(batch) > 0 and max(max_src_sent_len, curr_src_sent_len, max_tgt_sent_len, curr_tgt_sent_len)*(len(batch)+1) > args.batch_size: ## The examples only need to fit in memory so we always batch by tokens.
+                yield pad_teacher_cache_batch(batch, tok)
+                batch = []
+                max_src_sent_len = 0
+                max_tgt_sent_len = 0
+            batch.append(example)
+            max_src_sent_len = max(max_src_sent_len, curr_src_sent_len)
+            max_tgt_sent_len = max(max_tgt_sent_len, curr_tgt_sent_len)
+    if len(batch) > 0:
+        yield pad_teacher_cache_batch(batch, tok)
+
+def pad_teacher_cache_batch(batch, tok):
+    """Pads the (encoder input, decoder input, decoder labels) examples of a teacher output cache batch."""
+    input_ids = pad_id_sequences([example[0] for example in batch], tok.pad_token_id)
+    input_masks = (input_ids != tok.pad_token_id).int()
+    decoder_input_ids = pad_id_sequences([example[1] for example in batch], tok.pad_token_id)
+    labels = pad_id_sequences([example[2] for example in batch], tok.pad_token_id)
+    return input_ids, input_masks, decoder_input_ids, labels
+
 def generate_batches_pair(tok, args): ## TODO: Fix for mbart and bart variants
     """Generates the source, target and source attention masks for the training set."""
     src_file = open(args.test_src)
@@ -1435,8 +2525,40 @@ def generate_batches_pair_masked(tok, args): ## TODO: Implement hard truncation
             
 
 
-def generate_batches_for_decoding(tok, args):
-    """Generates the source sentences for the test set."""
+def yield_decoding_source_sentences(src_file, mp_val_or_range, mask_tok, args):
+    """Reads the test set source sentences a batch at a time, does the initial truncation and, if needed, masks the whole batch at once with mask_spans_in_batch. Yields the source sentence and the additional source sentence which is None unless we do multi source decoding."""
+    while True:
+        src_lines = list(islice(src_file, args.batch_size))
+        if len(src_lines) == 0:
+            break
+        src_sents = []
+        src_sents_parent = []
+        src_sent_splits = []
+        for src_line in src_lines:
+            src_sent = src_line.strip()
+            src_sent_parent = None
+            if args.multi_source: ## We assume that we use a N-way corpus of 3 languages X, Y and Z. We want to distill Y-Z behavior into X-Z where the Y-Z pair also has additional larger corpora but X-Z does not. As such the source sentence should be a tab separated sentence consisting of X[tab]Y.
+                src_sent = src_sent.split("\t")
+                src_sent_parent = src_sent[0].strip() ## This is the sentence for Y
+                src_sent = src_sent[1] ## This is the sentence for X
+            src_sent_split = src_sent.split(" ")
+            if len(src_sent_split) > args.max_src_length: ## Initial truncation
+                src_sent_split = src_sent_split[:args.max_src_length]
+                src_sent = " ".join(src_sent_split)
+            src_sents.append(src_sent)
+            src_sents_parent.append(src_sent_parent)
+            src_sent_splits.append(src_sent_split)
+        if args.mask_input:
+            if type(mp_val_or_range) is float:
+                mask_percents = [mp_val_or_range]*len(src_sent_splits)
+            else:
+                mask_percents = [random.uniform(mp_val_or_range[0], mp_val_or_range[1]) for _ in src_sent_splits]
+            src_sents = [" ".join(src_sent_split) for src_sent_split in mask_spans_in_batch(src_sent_splits, mask_percents, mask_tok, args)]
+        for src_sent, src_sent_parent in zip(src_sents, src_sents_parent):
+            yield src_sent, src_sent_parent
+
+def generate_batches_for_decoding(tok, args, line_range=None):
+    """Generates the source sentences for the test set. If a [start, end) line range is given then only those lines are used."""
     if args.tokenization_sampling:
         print("Stochastic tokenizer will be used.")
         if "mbart" in args.tokenizer_name_or_path:
@@ -1449,6 +2571,8 @@ def generate_batches_for_decoding(tok, args):
     else:
         mask_tok = "[MASK]"
     src_file = open(args.test_src)
+    if line_range is not None:
+        src_file = islice(src_file, line_range[0], line_range[1])
     slang = args.slang
     curr_batch_count = 0
     encoder_input_batch = []
@@ -1466,45 +2590,8 @@ def generate_batches_for_decoding(tok, args):
         mp_val_or_range = args.token_masking_probs_range
     print("Masking ratio:", mp_val_or_range)
 
-    for src_line in src_file:
+    for src_sent, src_sent_parent in yield_decoding_source_sentences(src_file, mp_val_or_range, mask_tok, args):
         start = time.time()
-        src_sent = src_line.strip()
-        if args.multi_source: ## We assume that we use a N-way corpus of 3 languages X, Y and Z. We want to distill Y-Z behavior into X-Z where the Y-Z pair also has additional larger corpora but X-Z does not. As such the source sentence should be a tab separated sentence consisting of X[tab]Y.
-            src_sent = src_sent.split("\t")
-            src_sent_parent = src_sent[0].strip() ## This is the sentence for Y
-            src_sent = src_sent[1] ## This is the sentence for X
-        src_sent_split = src_sent.split(" ")
-        sent_len = len(src_sent_split)
-        if sent_len > args.max_src_length: ## Initial truncation
-            src_sent_split = src_sent_split[:args.max_src_length]
-            src_sent = " ".join(src_sent_split)
-            sent_len = args.max_src_length
-        
-        if args.mask_input:
-            if type(mp_val_or_range) is float:
-                mask_percent = mp_val_or_range
-            else:
-                mask_percent = random.uniform(mp_val_or_range[0], mp_val_or_range[1])
-            mask_count = 0
-            max_mask_count = int(mask_percent*sent_len)
-            spans_to_mask = list(np.random.poisson(args.token_masking_lambda, 1000))
-            curr_sent_len = sent_len
-            while mask_count < max_mask_count:
-                try:
-                    span_to_mask = spans_to_mask[0]
-                    del spans_to_mask[0]
-                    if span_to_mask > (max_mask_count-mask_count): ## Cant mask more than the allowable number of tokens.
-                        continue
-                    idx_to_mask = random.randint(sent_len//2 if args.future_prediction else 0, (curr_sent_len-1)-(span_to_mask-1))
-                    if mask_tok not in src_sent_split[idx_to_mask:idx_to_mask+span_to_mask]:
-                        actually_masked_length = len(src_sent_split[idx_to_mask:idx_to_mask+span_to_mask]) ## If at the end of the sentence then we have likely masked fewer tokens.
-                        src_sent_split[idx_to_mask:idx_to_mask+span_to_mask] = [mask_tok]
-                        mask_count += actually_masked_length # We assume that with a low probability there are mask insertions when span lengths are 0 which may cause more mask tokens than planned. I have decided not to count these insersions towards the maximum maskable limit. This means that the total number of mask tokens will be a bit higher than what it should be. 
-                        curr_sent_len -= (actually_masked_length-1)
-                except:
-                    break ## If we cannot get a properly masked sentence despite all our efforts then we just give up and continue with what we have so far.
-            src_sent = " ".join(src_sent_split)
-        
         if args.use_official_pretrained and ("bart" in args.model_path or "barthez" in args.model_path) and "mbart" not in args.model_path: ## The bart tokenizer is wacky so we need to tweak the inputs a bit
             iids = tok(src_sent, return_tensors="pt").input_ids
             sent_len = len(iids[0])
@@ -1592,6 +2679,41 @@ def generate_batches_for_decoding(tok, args):
         else:
             yield input_ids, input_masks
 
+def generate_sorted_batches_for_decoding(tok, args, line_range=None):
+    """Reads the test set args.decode_sort_pool_size sentences at a time, sorts each pool by the tokenized source length (longest first) and cuts it into batches of at most args.decode_max_tokens source tokens including padding. The sentences are truncated and tokenized exactly like generate_batches_for_decoding does it. Yields the input ids, the input masks and the (zero indexed) line numbers of the sentences in the batch so that the translations can be written in the original order. The line numbers are relative to the start of the line range if one is given."""
+    sentence_args = argparse.Namespace(**vars(args))
+    sentence_args.batch_size = 1 ## Batches of one sentence have no padding so we get the token ids of each sentence.
+    sentences = generate_batches_for_decoding(tok, sentence_args, line_range)
+    num_lines = 0
+    while True:
+        pool = list(islice(sentences, args.decode_sort_pool_size))
+        if len(pool) == 0:
+            break
+        pool = [(num_lines+idx, [sides[0].numpy() for sides in (input_ids if args.multi_source else [input_ids])]) for idx, (input_ids, _) in enumerate(pool)] ## The main source comes first followed by the additional source if any.
+        num_lines += len(pool)
+        pool.sort(key=lambda example: -len(example[1][0]))
+        batch = []
+        max_sent_len = 0
+        for example in pool + [None]: ## None flushes the last batch.
+            if example is not None:
+                curr_sent_len = max(len(ids) for ids in example[1])
+                if len(batch) == 0 or max(max_sent_len, curr_sent_len)*(len(batch)+1) <= args.decode_max_tokens:
+                    batch.append(example)
+                    max_sent_len = max(max_sent_len, curr_sent_len)
+                    continue
+            line_indices = [line_idx for line_idx, _ in batch]
+            input_ids = pad_id_sequences([ids[0] for _, ids in batch], tok.pad_token_id)
+            input_masks = input_ids != tok.pad_token_id
+            if args.multi_source:
+                input_ids_parent = pad_id_sequences([ids[1] for _, ids in batch], tok.pad_token_id)
+                input_masks_parent = (input_ids_parent != tok.pad_token_id).int()
+                yield [input_ids, input_ids_parent], [input_masks, input_masks_parent], line_indices
+            else:
+                yield input_ids, input_masks, line_indices
+            if example is not None:
+                batch = [example]
+                max_sent_len = max(len(ids) for ids in example[1])
+
 def generate_batches_for_decoding_lm(tok, args):
     """Generates the source sentences for the test set."""
     src_file = open(args.test_src)
@@ -1655,6 +2777,189 @@ def plot_attention(data, X_label=None, Y_label=None, num_layers=None, num_heads=
     plt.close(fig)  # close the figure
 
 
+def pin_batch(batch):
+    """Recursively pins the tensors in a batch (which may be a nested tuple or list) so that the host to device copies can be asynchronous."""
+    if isinstance(batch, torch.Tensor):
+        return batch.pin_memory()
+    elif isinstance(batch, (list, tuple)):
+        return type(batch)(pin_batch(item) for item in batch)
+    return batch
+
+def batch_producer_worker(generator_function, generator_kwargs, worker_id, num_workers, seed, batch_queue):
+    """Runs a batch generator in a worker process and puts its batches in the shared queue. The generator only sees the worker's part of the corpora. When the generator is exhausted None is put in the queue and if it crashes then the traceback is put instead."""
+    global data_worker_split
+    data_worker_split = (worker_id, num_workers)
+    random.seed(seed)
+    np.random.seed(seed % (2**32))
+    torch.manual_seed(seed)
+    torch.set_num_threads(1) ## Batch creation is mostly python so we dont want the workers to fight with the main process for cores.
+    try:
+        for batch in generator_function(**generator_kwargs):
+            batch_queue.put(batch)
+        batch_queue.put(None)
+    except Exception:
+        batch_queue.put("Batch producer worker "+str(worker_id)+" crashed:\n"+traceback.format_exc())
+
+class BatchPrefetcher(object):
+    """Wraps a batch generator such as generate_batches_bilingual so that batches are created by N background worker processes while the model is busy with the forward and backward passes. Each worker runs its own copy of the generator with a different seed on its own part of the lines of the corpora and creates its own share of the batches. The workers are spawned rather than forked since the training process has already initialized CUDA and the process group. Batches go into a bounded queue (so workers cannot run too far ahead) and are pinned by a background thread so that they can be moved to the GPU asynchronously (not when training on the CPU). With 0 workers the generator is simply run in the main process as before. The time the training loop had to wait for the last batch is available as last_wait_time so that we can check if data loading keeps up."""
+    def __init__(self, generator_function, generator_kwargs, rank, device, num_workers, queue_depth):
+        self.generator_function = generator_function
+        self.generator_kwargs = generator_kwargs
+        self.num_workers = num_workers
+        self.last_wait_time = 0.0
+        self.workers = []
+        if self.num_workers > 0:
+            args = generator_kwargs["args"]
+            ctx = mp.get_context("spawn") ## Forking a process which uses CUDA and NCCL can deadlock. The generator and its arguments are pickled instead and the workers read their corpora themselves.
+            self.batch_queue = ctx.Queue(maxsize=queue_depth)
+            for worker_id in range(num_workers):
+                worker_args = argparse.Namespace(**vars(args)) ## Each worker creates only its share of the batches.
+                if args.num_batches > 0:
+                    worker_args.num_batches = args.num_batches//num_workers + (1 if worker_id < args.num_batches % num_workers else 0)
+                    if worker_args.num_batches == 0:
+                        continue
+                worker_kwargs = dict(generator_kwargs)
+                worker_kwargs["args"] = worker_args
+                worker = ctx.Process(target=batch_producer_worker, args=(generator_function, worker_kwargs, worker_id, num_workers, 621311 + rank*num_workers + worker_id, self.batch_queue), daemon=True)
+                worker.start()
+                self.workers.append(worker)
+            if not is_cpu_device(device): ## Pinned memory only helps copies to the GPU.
+                self.output_queue = queue.Queue(maxsize=queue_depth)
+                self.pinning_thread = threading.Thread(target=self.pin_batches, daemon=True)
+                self.pinning_thread.start()
+            else:
+                self.output_queue = self.batch_queue
+            print("Started", len(self.workers), "batch producer workers with a queue depth of", queue_depth)
+    
+    def pin_batches(self):
+        """Moves batches from the worker queue to the output queue after pinning them. Stops once all workers are done or one of them crashes."""
+        num_finished_workers = 0
+        while num_finished_workers < len(self.workers):
+            batch = self.batch_queue.get()
+            if batch is None:
+                num_finished_workers += 1
+            elif isinstance(batch, str):
+                self.output_queue.put(batch)
+                return
+            else:
+                self.output_queue.put(pin_batch(batch))
+                continue
+            self.output_queue.put(None)
+
+    def __iter__(self):
+        if self.num_workers == 0:
+            generator = self.generator_function(**self.generator_kwargs)
+            while True:
+                start = time.time()
+                try:
+                    batch = next(generator)
+                except StopIteration:
+                    return
+                self.last_wait_time = time.time()-start
+                yield batch
+        else:
+            num_finished_workers = 0
+            while num_finished_workers < len(self.workers):
+                start = time.time()
+                batch = self.output_queue.get()
+                self.last_wait_time = time.time()-start
+                if batch is None:
+                    num_finished_workers += 1
+                elif isinstance(batch, str):
+                    self.close()
+                    raise RuntimeError(batch)
+                else:
+                    yield batch
+    
+    def close(self):
+        """Stops the workers. Needed when the training loop ends before the generators do."""
+        for worker in self.workers:
+            if worker.is_alive():
+                worker.terminate()
+        self.workers = []
+
+def snapshot_to_cpu(state):
+    """Recursively copies the tensors in a (nested) state dict to the CPU so that they can be written to disk while training keeps updating the originals. Other values are kept as is."""
+    if isinstance(state, torch.Tensor):
+        return state.detach().to("cpu", copy=True)
+    elif isinstance(state, dict):
+        return type(state)((key, snapshot_to_cpu(value)) for key, value in state.items())
+    elif isinstance(state, (list, tuple)):
+        return type(state)(snapshot_to_cpu(item) for item in state)
+    return state
+
+def atomic_torch_save(obj, path):
+    """Saves an object to a temporary file and then renames it to the given path. Readers never see a partially written file and files hardlinked to an older version of the path are left untouched."""
+    temp_path = path+".tmp."+str(os.getpid())
+    torch.save(obj, temp_path)
+    os.replace(temp_path, path)
+
+def atomic_link(source_path, target_path):
+    """Makes target_path point to the contents of source_path via a hardlink which costs no disk space or time. If hardlinking is not possible (like across file systems) then the file is copied. In both cases the target is replaced atomically."""
+    temp_path = target_path+".tmp."+str(os.getpid())
+    try:
+        os.link(source_path, temp_path)
+    except OSError:
+        shutil.copyfile(source_path, temp_path)
+    os.replace(temp_path, target_path)
+
+class CheckpointWriter(object):
+    """Saves training checkpoints in a background thread so that training continues while the bytes go to disk. The model, optimizer and scheduler states are snapshot to the CPU once and the pure model (without the ddp prefixes) is derived from the same snapshot. Each checkpoint is written once to its main path (atomically) and the additional copies (best models for each pair, intermediate checkpoints and the deploy model) are hardlinks to it instead of being saved again or copied with cp. Only one checkpoint is written at a time and a new save waits for the previous one so at most one extra snapshot is kept in memory. Without asynchronous saving, the same thing is done in the calling thread."""
+    def __init__(self, asynchronous):
+        self.asynchronous = asynchronous
+        self.error = None
+        if self.asynchronous:
+            self.save_queue = queue.Queue()
+            self.writing_thread = threading.Thread(target=self.write_checkpoints, daemon=True)
+            self.writing_thread.start()
+    
+    def save(self, model, optimizer, scheduler, ctr, checkpoint_path, additional_paths=[], deploy_path=None):
+        """Saves the checkpoint to checkpoint_path and the pure model to checkpoint_path.pure_model. For every path in additional_paths, path and path.pure_model will be hardlinks to these. If a deploy path is given then it will be a hardlink to the pure model."""
+        self.wait() ## Only one checkpoint is written at a time.
+        start = time.time()
+        checkpoint_dict = snapshot_to_cpu({'model': model.state_dict(), 'optimizer': optimizer.state_dict(), 'scheduler': scheduler.state_dict(), 'ctr': ctr})
+        print("Took", round(time.time()-start, 2), "seconds to snapshot the checkpoint.")
+        save_job = (checkpoint_dict, checkpoint_path, list(additional_paths), deploy_path)
+        if self.asynchronous:
+            self.save_queue.put(save_job)
+        else:
+            self.write_checkpoint(*save_job)
+    
+    def write_checkpoint(self, checkpoint_dict, checkpoint_path, additional_paths, deploy_path):
+        """Writes a checkpoint snapshot and makes its hardlinks."""
+        start = time.time()
+        pure_model_dict = type(checkpoint_dict['model'])((key[len("module."):] if key.startswith("module.") else key, value) for key, value in checkpoint_dict['model'].items()) ## Same as model.module.state_dict() but the tensors are shared with the snapshot.
+        atomic_torch_save(checkpoint_dict, checkpoint_path)
+        atomic_torch_save(pure_model_dict, checkpoint_path+".pure_model")
+        for additional_path in additional_paths:
+            atomic_link(checkpoint_path, additional_path)
+            atomic_link(checkpoint_path+".pure_model", additional_path+".pure_model")
+        if deploy_path is not None:
+            atomic_link(checkpoint_path+".pure_model", deploy_path)
+        print("Took", round(time.time()-start, 2), "seconds to write the checkpoint to", checkpoint_path)
+        sys.stdout.flush()
+    
+    def write_checkpoints(self):
+        """Writes the queued checkpoints one by one. An error is kept so that it can be raised in the training loop."""
+        while True:
+            save_job = self.save_queue.get()
+            try:
+                self.write_checkpoint(*save_job)
+            except Exception:
+                self.error = "Checkpoint writer crashed:\n"+traceback.format_exc()
+            finally:
+                self.save_queue.task_done()
+    
+    def raise_error(self):
+        if self.error is not None:
+            raise RuntimeError(self.error)
+    
+    def wait(self):
+        """Waits till all the queued checkpoints have been written. Needed before other processes read the checkpoint and before exiting."""
+        if self.asynchronous:
+            self.save_queue.join()
+        self.raise_error()
+
 def generate_batches_monolingual_masked_or_bilingual(tok, args, rank, files, train_files):
     """This will return masked monolingual or bilingual batches according to a fixed ratio."""
     bilingual_generator = generate_batches_bilingual(tok, args, train_files, rank)
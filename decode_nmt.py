@@ -70,10 +70,248 @@ rcParams['font.sans-serif'] = ['Source Han Sans TW',
 ##
 
 
+def number_decoding_batches(tok, args, line_range=None):
+    """Yields the batches of the test set (or only of the lines in the [start, end) line range) along with the indices of their lines relative to the start of the range so that the translations can be written in order no matter when they are ready."""
+    if args.decode_max_tokens > 0: ## Length sorted batches which are translated out of order.
+        yield from generate_sorted_batches_for_decoding(tok, args, line_range)
+        return
+    next_line = 0
+    for input_ids, input_masks in generate_batches_for_decoding(tok, args, line_range):
+        batch_size = len(input_ids[0]) if args.multi_source else len(input_ids) ## For multi source the inputs are a pair of batches.
+        yield input_ids, input_masks, list(range(next_line, next_line+batch_size))
+        next_line += batch_size
+
+def translate_batch(model, tok, args, input_ids, input_masks, gpu):
+    """Runs beam search on a batch and returns the ids of the translations on the CPU."""
+    if args.prompt_tuning:
+        input_shape = input_masks.size()
+        encoder_pad = torch.ones(input_shape[0], args.num_prompts).clone().detach()
+        input_masks = torch.cat([encoder_pad, input_masks], dim=1)
+    if args.multi_source:
+        input_ids_parent = input_ids[1]
+        input_ids = input_ids[0]
+        input_masks_parent = input_masks[1]
+        input_masks = input_masks[0]
+    with torch.no_grad():
+        translations = model.module.generate(input_ids.to(gpu, non_blocking=True), use_cache=True, num_beams=args.beam_size, max_length=int((len(input_ids[0])*args.max_decode_length_multiplier) if args.max_decode_length_multiplier > 0 else -args.max_decode_length_multiplier), min_length=int((len(input_ids[0])*args.min_decode_length_multiplier) if args.min_decode_length_multiplier > 0 else -args.min_decode_length_multiplier), early_stopping=True, attention_mask=input_masks.to(gpu, non_blocking=True), pad_token_id=tok.pad_token_id, eos_token_id=tok(["</s>"], add_special_tokens=False).input_ids[0][0], decoder_start_token_id=tok([args.tlang if args.use_official_pretrained else "<2"+args.tlang+">"], add_special_tokens=False).input_ids[0][0], bos_token_id=tok(["<s>"], add_special_tokens=False).input_ids[0][0], length_penalty=args.length_penalty, repetition_penalty=args.repetition_penalty, encoder_no_repeat_ngram_size=args.encoder_no_repeat_ngram_size, no_repeat_ngram_size=args.no_repeat_ngram_size, num_return_sequences=args.beam_size if args.return_all_sequences else 1, additional_input_ids=input_ids_parent.to(gpu, non_blocking=True) if args.multi_source else None, additional_input_ids_mask=input_masks_parent.to(gpu, non_blocking=True) if args.multi_source else None) ## We translate the batch.
+    print(len(input_ids), "in and", len(translations), "out")
+    return translations.cpu() ## Detokenizing ids on the GPU would copy them one by one.
+
+class TranslationWriter(object):
+    """Detokenizes the translations of batches and writes them to outf in the order of the lines. Translations of lines which come before lines that are not translated yet are kept in a buffer till they can be written. With flush_every_line the file is flushed after every line so that the translations can be followed as they come, otherwise the writes are buffered by the file object. The translations written so far are in hyp."""
+    def __init__(self, tok, args, outf, flush_every_line=True):
+        self.tok = tok
+        self.args = args
+        self.outf = outf
+        self.flush_every_line = flush_every_line
+        self.pending_translations = {} ## Translations of lines which have to wait till the translations of all earlier lines are written.
+        self.next_line = 0
+        self.hyp = []
+    
+    def add(self, translations, line_indices):
+        """Detokenizes the translation ids of a batch whose lines have the given indices and writes all the translations which are ready."""
+        translations = [self.tok.decode(translation, skip_special_tokens=self.args.no_skip_special_tokens, clean_up_tokenization_spaces=False) for translation in translations]
+        num_sequences = len(translations)//len(line_indices) ## More than 1 when returning all sequences. The sequences of a sentence are consecutive.
+        for idx, line_idx in enumerate(line_indices):
+            self.pending_translations[line_idx] = translations[idx*num_sequences:(idx+1)*num_sequences]
+        while self.next_line in self.pending_translations:
+            for translation in self.pending_translations.pop(self.next_line):
+                self.outf.write(translation+"\n")
+                if self.flush_every_line:
+                    self.outf.flush()
+                self.hyp.append(translation)
+            self.next_line += 1
+
+def put_unless_stopped(item_queue, item, stop_event):
+    """Puts an item in a bounded queue unless the stop event is set while waiting for a free slot. Returns False if it was stopped."""
+    while not stop_event.is_set():
+        try:
+            item_queue.put(item, timeout=1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def tokenization_stage(batches, batch_queue, pin_memory, stage_times, stop_event):
+    """The first stage of the pipelined decoding which runs in a background thread. Creates the batches, pins them if they will go to a GPU and puts them in the bounded batch queue. None is put in the queue at the end and the traceback if something crashes. Stops as soon as the stop event is set, which the model stage does when it crashes, so that it never stays blocked on a full queue."""
+    try:
+        while not stop_event.is_set():
+            start = time.time()
+            batch = next(batches, None)
+            if batch is None:
+                break
+            if pin_memory:
+                batch = pin_batch(batch)
+            stage_times["tokenization"] += time.time()-start
+            if not put_unless_stopped(batch_queue, batch, stop_event):
+                return
+        put_unless_stopped(batch_queue, None, stop_event)
+    except Exception:
+        put_unless_stopped(batch_queue, "The tokenization stage crashed:\n"+traceback.format_exc(), stop_event)
+
+def detokenization_stage(translation_queue, writer, stage_times, errors):
+    """The last stage of the pipelined decoding which runs in a background thread. Passes the translations from the bounded translation queue to the writer till it gets None. If the writer crashes then the traceback is added to errors and the remaining translations are thrown away so that the model stage never blocks on a full queue."""
+    while True:
+        item = translation_queue.get()
+        if item is None:
+            return
+        if errors:
+            continue
+        start = time.time()
+        try:
+            writer.add(*item)
+        except Exception:
+            errors.append("The detokenization stage crashed:\n"+traceback.format_exc())
+        stage_times["detokenization and writing"] += time.time()-start
+
+def translate_lines(model, tok, args, outf, gpu, line_range=None, heartbeat_path=None):
+    """Translates the lines of the test set (or only those in the [start, end) line range) and writes the translations to outf in the order of the lines. Returns the translations. If a heartbeat path is given then the file is touched after every batch to show that this process is alive. With --pipelined_decoding the tokenization of the next batches and the detokenization and writing of the previous ones are done by background threads connected to the model by bounded queues so that the model does not wait for python string processing. Prints how much time each stage took."""
+    batches = number_decoding_batches(tok, args, line_range)
+    writer = TranslationWriter(tok, args, outf, flush_every_line=not args.pipelined_decoding)
+    stage_times = {"tokenization": 0.0, "waiting for batches": 0.0, "model": 0.0, "detokenization and writing": 0.0}
+    decoding_start = time.time()
+    if args.pipelined_decoding:
+        batch_queue = queue.Queue(maxsize=args.decode_queue_depth)
+        translation_queue = queue.Queue(maxsize=args.decode_queue_depth)
+        errors = []
+        stop_event = threading.Event()
+        tokenization_thread = threading.Thread(target=tokenization_stage, args=(batches, batch_queue, not is_cpu_device(gpu), stage_times, stop_event), daemon=True)
+        detokenization_thread = threading.Thread(target=detokenization_stage, args=(translation_queue, writer, stage_times, errors), daemon=True)
+        tokenization_thread.start()
+        detokenization_thread.start()
+        ctr = 0
+        try:
+            while True:
+                start = time.time()
+                batch = batch_queue.get()
+                stage_times["waiting for batches"] += time.time()-start
+                if batch is None:
+                    break
+                if isinstance(batch, str):
+                    raise RuntimeError(batch)
+                input_ids, input_masks, line_indices = batch
+                print("Processing batch:", ctr)
+                start = time.time()
+                translations = translate_batch(model, tok, args, input_ids, input_masks, gpu)
+                stage_times["model"] += time.time()-start
+                translation_queue.put((translations, line_indices))
+                if errors: ## The writer crashed so there is no point in translating the rest.
+                    break
+                touch_heartbeat(heartbeat_path)
+                ctr += 1
+        finally: ## Whether we are done or something crashed, the background threads must not stay blocked on the queues.
+            stop_event.set()
+            translation_queue.put(None) ## The detokenization stage always drains the queue so this never blocks for long.
+            detokenization_thread.join()
+            tokenization_thread.join()
+        if errors:
+            raise RuntimeError(errors[0])
+        outf.flush()
+    else:
+        ctr = 0
+        while True:
+            start = time.time()
+            batch = next(batches, None)
+            stage_times["tokenization"] += time.time()-start
+            if batch is None:
+                break
+            input_ids, input_masks, line_indices = batch
+            print("Processing batch:", ctr)
+            start = time.time()
+            translations = translate_batch(model, tok, args, input_ids, input_masks, gpu)
+            stage_times["model"] += time.time()-start
+            start = time.time()
+            writer.add(translations, line_indices)
+            stage_times["detokenization and writing"] += time.time()-start
+            touch_heartbeat(heartbeat_path)
+            ctr += 1
+    print("Translated", len(writer.hyp), "lines in", round(time.time()-decoding_start, 2), "seconds. Time per stage in seconds:", ", ".join(stage+" "+str(round(stage_time, 2)) for stage, stage_time in stage_times.items())+(" (the stages overlap)" if args.pipelined_decoding else ""))
+    return writer.hyp
+
+def decoding_heartbeat_path(args, rank):
+    """Returns the path of the file which a process touches after every batch it translates with --shard_decoding."""
+    return args.test_tgt+".heartbeat."+"%03d" % rank
+
+def touch_heartbeat(heartbeat_path):
+    """Updates the modification time of a heartbeat file (if any)."""
+    if heartbeat_path is not None:
+        with open(heartbeat_path, "a"):
+            os.utime(heartbeat_path)
+
+def decoding_shard_path(args, shard_id):
+    """Returns the path of the translations of a decoding shard. The file only exists once the shard is fully translated."""
+    return args.test_tgt+".shard."+"%03d" % shard_id
+
+def get_decoding_shard_info(args, num_shards, start, end):
+    """Returns what a decoding shard was translated from: the number of shards, its line range and the path, size and modification time of the test set. It is saved next to the shard so that shards left behind by a run with other settings or another test set are not mistaken for finished ones."""
+    source_stat = os.stat(args.test_src)
+    return {"num_shards": num_shards, "start": start, "end": end, "test_src": os.path.abspath(args.test_src), "source_size": source_stat.st_size, "source_mtime": source_stat.st_mtime}
+
+def is_decoding_shard_done(shard_path, shard_info):
+    """Checks if a shard has been fully translated with the same settings and test set."""
+    if not os.path.exists(shard_path) or not os.path.exists(shard_path+".json"):
+        return False
+    with open(shard_path+".json") as f:
+        return json.load(f) == shard_info
+
+def decode_shards(model, tok, args, rank, gpu):
+    """Splits the test set into args.decode_num_shards (or world size) disjoint line ranges which are translated by the processes in a round robin fashion. Each shard is written to a temporary file which is renamed once the shard is done so that the shards which are already translated are skipped when decoding is resumed after a crash. What each shard was translated from is saved next to it and stale shards from runs with other settings or another test set are translated again. The first process waits for all the shards and merges them in order into the test set translation file. Every process touches its heartbeat file after each batch and if a process which still has shards to translate has not done so for --decode_shard_timeout seconds then the first process assumes that it died and raises an error. Returns the translations for the first process if there is a reference to compute BLEU with and None otherwise."""
+    num_shards = args.decode_num_shards if args.decode_num_shards > 0 else args.world_size
+    num_lines = count_lines(args.test_src)
+    shard_infos = [get_decoding_shard_info(args, num_shards, *get_shard_line_range(num_lines, shard_id, num_shards)) for shard_id in range(num_shards)]
+    heartbeat_path = decoding_heartbeat_path(args, rank)
+    touch_heartbeat(heartbeat_path)
+    for shard_id in range(rank, num_shards, args.world_size):
+        shard_path = decoding_shard_path(args, shard_id)
+        shard_info = shard_infos[shard_id]
+        if is_decoding_shard_done(shard_path, shard_info):
+            print("Shard", shard_id, "is already translated. Skipping it.")
+            continue
+        if os.path.exists(shard_path): ## Left behind by a run with other settings. Removed before the new info is written so that it is never merged.
+            print("Shard", shard_id, "was translated with other settings or from another test set. Translating it again.")
+            os.remove(shard_path)
+        start, end = shard_info["start"], shard_info["end"]
+        print("Translating lines", start, "to", end, "as shard", shard_id, "on rank", rank)
+        with open(shard_path+".tmp", "w") as outf:
+            translate_lines(model, tok, args, outf, gpu, (start, end), heartbeat_path)
+        with open(shard_path+".json.tmp", "w") as f:
+            json.dump(shard_info, f)
+        os.replace(shard_path+".json.tmp", shard_path+".json")
+        os.replace(shard_path+".tmp", shard_path)
+    if rank != 0:
+        return None
+    shard_paths = [decoding_shard_path(args, shard_id) for shard_id in range(num_shards)]
+    heartbeat_paths = [decoding_heartbeat_path(args, process_rank) for process_rank in range(args.world_size)]
+    waiting_start = time.time() ## Heartbeats left behind by an earlier run must not count so a process is given the timeout from now to show up.
+    while True: ## We poll instead of using a barrier which could time out while the other processes translate large shards.
+        missing_shards = [shard_id for shard_id, (shard_path, shard_info) in enumerate(zip(shard_paths, shard_infos)) if not is_decoding_shard_done(shard_path, shard_info)]
+        if len(missing_shards) == 0:
+            break
+        for process_rank in sorted(set(shard_id % args.world_size for shard_id in missing_shards)): ## The processes which still have shards to translate.
+            last_heartbeat = os.path.getmtime(heartbeat_paths[process_rank]) if os.path.exists(heartbeat_paths[process_rank]) else 0
+            if time.time()-max(last_heartbeat, waiting_start) > args.decode_shard_timeout:
+                raise RuntimeError("Process "+str(process_rank)+" has not translated a batch in the last "+str(args.decode_shard_timeout)+" seconds so it probably died. Missing shards: "+", ".join(str(shard_id) for shard_id in missing_shards)+". Rerun the same command to translate only the missing shards.")
+        time.sleep(10)
+    with open(args.test_tgt+".tmp", "w") as outf:
+        for shard_path in shard_paths:
+            with open(shard_path) as shard_file:
+                shutil.copyfileobj(shard_file, outf)
+    os.replace(args.test_tgt+".tmp", args.test_tgt)
+    for shard_path in shard_paths:
+        os.remove(shard_path)
+        os.remove(shard_path+".json")
+    for heartbeat_path in heartbeat_paths:
+        if os.path.exists(heartbeat_path):
+            os.remove(heartbeat_path)
+    print("Merged", num_shards, "shards into", args.test_tgt)
+    if args.test_ref is None: ## The translations are only needed for BLEU so the merged file is not read again.
+        return None
+    return [line.rstrip("\n") for line in open(args.test_tgt)]
+
 def model_create_load_decode(gpu, args):
     """The main function which does the overall decoding, visualization etc. Should be split into multiple parts in the future. Currently monolithc intentionally."""
     rank = args.nr * args.gpus + gpu ## The rank of the current process out of the total number of processes indicated by world_size. This need not be done using DDP but I am leaving it as is for consistency with my other code. In the future, I plan to support sharding the decoding data into multiple shards which will then be decoded in a distributed fashion.
-    dist.init_process_group(backend='nccl', init_method='env://', world_size=args.world_size, rank=rank)
+    gpu = setup_process_device(gpu, rank, args) ## From here on gpu is the device of this process which is the cpu with --device cpu.
     
     if args.use_official_pretrained_tokenizer or args.use_official_pretrained: # If we use an official model then we are using its tokenizer by default.
         if "mbart" in args.model_path or "IndicBART" in args.model_path:
@@ -140,13 +378,21 @@ def model_create_load_decode(gpu, args):
         config = MBartConfig(vocab_size=len(tok), encoder_layers=args.encoder_layers, decoder_layers=args.decoder_layers,  encoder_attention_heads=args.encoder_attention_heads, decoder_attention_heads=args.decoder_attention_heads, encoder_ffn_dim=args.encoder_ffn_dim, decoder_ffn_dim=args.decoder_ffn_dim, d_model=args.d_model, embed_low_rank_dim=args.embed_low_rank_dim, no_embed_norm=args.no_embed_norm, scale_embedding=args.scale_embedding, pad_token_id=tok.pad_token_id, eos_token_id=tok(["</s>"], add_special_tokens=False).input_ids[0][0], bos_token_id=tok(["<s>"], add_special_tokens=False).input_ids[0][0], encoder_tying_config=args.encoder_tying_config, decoder_tying_config=args.decoder_tying_config, multilayer_softmaxing=args.multilayer_softmaxing, wait_k=args.wait_k, additional_source_wait_k=args.additional_source_wait_k, unidirectional_encoder=args.unidirectional_encoder, multi_source=args.multi_source, multi_source_method=args.multi_source_method, mid_fusion_layers=args.mid_fusion_layers, bottleneck_mid_fusion_tokens=args.bottleneck_mid_fusion_tokens, softmax_temperature=args.softmax_temperature, temperature_calibration=args.temperature_calibration, no_scale_attention_embedding=args.no_scale_attention_embedding, positional_encodings=args.positional_encodings, activation_function=args.activation_function, no_positional_encoding_encoder=args.no_positional_encoding_encoder, no_positional_encoding_decoder=args.no_positional_encoding_decoder, use_moe=args.use_moe, num_experts=args.num_experts, expert_ffn_size=args.expert_ffn_size, prompt_tuning=args.prompt_tuning, num_prompts=args.num_prompts, prompt_projection_hidden_size=args.prompt_projection_hidden_size, layernorm_prompt_projection=args.layernorm_prompt_projection, no_projection_prompt=args.no_projection_prompt, use_tanh_activation_prompt=args.use_tanh_activation_prompt, residual_connection_prompt=args.residual_connection_prompt, recurrent_projections=args.recurrent_projections, adaptor_tuning=args.adaptor_tuning, deep_adaptor_tuning=args.deep_adaptor_tuning, deep_adaptor_tuning_ffn_only=args.deep_adaptor_tuning_ffn_only, parallel_adaptors = args.parallel_adaptors, layernorm_adaptor_input = args.layernorm_adaptor_input, adaptor_scaling_factor = args.adaptor_scaling_factor, residual_connection_adaptor = args.residual_connection_adaptor, encoder_adaptor_tying_config=args.encoder_adaptor_tying_config, decoder_adaptor_tying_config=args.decoder_adaptor_tying_config, adaptor_hidden_size=args.adaptor_hidden_size, moe_adaptors=args.moe_adaptors, num_moe_adaptor_experts=args.num_moe_adaptor_experts, hypercomplex=args.hypercomplex, hypercomplex_n=args.hypercomplex_n, ia3_adaptors=args.ia3_adaptors, softmax_bias_tuning=args.softmax_bias_tuning) ## Configuration.
         model = MBartForConditionalGeneration(config)
     model.eval()
-    torch.cuda.set_device(gpu)
+    set_device(gpu)
     
-    model.cuda(gpu)
-    model = DistributedDataParallel(model, device_ids=[gpu])
+    model.to(gpu)
+    if args.quantize != "none": ## DDP cannot wrap quantized models and decoding does not need any synchronization anyway.
+        model = ModelWrapper(model)
+    else:
+        model = wrap_in_ddp(model, gpu)
     
     
-    if args.use_official_pretrained and args.locally_fine_tuned_model_path is None: ## If we want to directly decode an official model.
+    quantized_model_exists = args.quantized_model_path is not None and os.path.exists(args.quantized_model_path)
+    if quantized_model_exists: ## The quantized deploy model replaces the float model so there is nothing else to load.
+        print("Loading the quantized model from", args.quantized_model_path)
+        model.module = quantize_model_dynamic_int8(model.module)
+        model.module.load_state_dict(torch.load(args.quantized_model_path, map_location="cpu"))
+    elif args.use_official_pretrained and args.locally_fine_tuned_model_path is None: ## If we want to directly decode an official model.
         print("Decoding an official model directly. No need to load a locally fine-tuned model.")
         pass
     else:
@@ -154,46 +400,30 @@ def model_create_load_decode(gpu, args):
         if args.use_official_pretrained and args.locally_fine_tuned_model_path is not None: ## If we want to decode a locally fine-tuned version of an official model.
             args.model_path = args.locally_fine_tuned_model_path
             print("The locally fine-tuned model is based on an official model. Hence, we will use the same config as the official model.")
-        map_location = {'cuda:%d' % 0: 'cuda:%d' % gpu}
+        map_location = get_map_location(gpu)
         checkpoint_dict = torch.load(args.model_path, map_location=map_location)
         if type(checkpoint_dict) == dict:
             model.load_state_dict(prune_weights(remap_embeddings_eliminate_components_and_eliminate_mismatches(model.state_dict(), remap_layers(checkpoint_dict['model'], 4, args), args), args.prune_ratio), strict=True if (args.remap_encoder == "" and args.remap_decoder == "" and not args.eliminate_encoder_before_initialization and not args.eliminate_decoder_before_initialization and not args.eliminate_embeddings_before_initialization and not args.prompt_tuning and not args.adaptor_tuning and not args.deep_adaptor_tuning and not args.ia3_adaptors and not args.deep_adaptor_tuning_ffn_only and not args.softmax_bias_tuning) else False) ## Modification needed if we want to load a partial model trained using multilayer softmaxing.
         else:
             model.module.load_state_dict(prune_weights(remap_embeddings_eliminate_components_and_eliminate_mismatches(model.state_dict(), remap_layers(checkpoint_dict, 3, args), args), args.prune_ratio), strict=True if (args.remap_encoder == "" and args.remap_decoder == "" and not args.eliminate_encoder_before_initialization and not args.eliminate_decoder_before_initialization and not args.eliminate_embeddings_before_initialization and not args.prompt_tuning and not args.adaptor_tuning and not args.deep_adaptor_tuning and not args.ia3_adaptors and not args.deep_adaptor_tuning_ffn_only and not args.softmax_bias_tuning) else False) ## Modification needed if we want to load a partial model trained using multilayer softmaxing.
+    if args.quantize != "none" and not quantized_model_exists:
+        model.module = quantize_model_dynamic_int8(model.module)
+        if args.quantized_model_path is not None and rank == 0: ## Saved for serving or for the next run. Written to a temporary file first since the other processes may be checking if it exists.
+            torch.save(model.module.state_dict(), args.quantized_model_path+".tmp")
+            os.replace(args.quantized_model_path+".tmp", args.quantized_model_path)
+            print("Saved the quantized model to", args.quantized_model_path)
     model.eval()        
     ctr = 0
-    outf = open(args.test_tgt, 'w')
+    outf = open(args.test_tgt, 'w') if not (args.decode_type == "decode" and args.shard_decoding) else None ## The shards are written to their own files and merged at the end.
     if args.decode_type == "decode": ## Standard NMT decoding.
         print("Decoding file")
-        hyp = []
         if args.test_ref is not None:
             refs = [[refline.strip() for refline in open(args.test_ref)]]
-        for input_ids, input_masks in generate_batches_for_decoding(tok, args): #infinite_same_sentence(10000):
-            start = time.time()
-            if args.prompt_tuning:
-                input_shape = input_masks.size()
-                encoder_pad = torch.ones(input_shape[0], args.num_prompts).clone().detach()
-                input_masks = torch.cat([encoder_pad, input_masks], dim=1)
-            print("Processing batch:", ctr)
-            if args.multi_source:
-                input_ids_parent = input_ids[1]
-                input_ids = input_ids[0]
-                input_masks_parent = input_masks[1]
-                input_masks = input_masks[0]
-            with torch.no_grad():
-                translations = model.module.generate(input_ids.to(gpu), use_cache=True, num_beams=args.beam_size, max_length=int((len(input_ids[0])*args.max_decode_length_multiplier) if args.max_decode_length_multiplier > 0 else -args.max_decode_length_multiplier), min_length=int((len(input_ids[0])*args.min_decode_length_multiplier) if args.min_decode_length_multiplier > 0 else -args.min_decode_length_multiplier), early_stopping=True, attention_mask=input_masks.to(gpu), pad_token_id=tok.pad_token_id, eos_token_id=tok(["</s>"], add_special_tokens=False).input_ids[0][0], decoder_start_token_id=tok([args.tlang if args.use_official_pretrained else "<2"+args.tlang+">"], add_special_tokens=False).input_ids[0][0], bos_token_id=tok(["<s>"], add_special_tokens=False).input_ids[0][0], length_penalty=args.length_penalty, repetition_penalty=args.repetition_penalty, encoder_no_repeat_ngram_size=args.encoder_no_repeat_ngram_size, no_repeat_ngram_size=args.no_repeat_ngram_size, num_return_sequences=args.beam_size if args.return_all_sequences else 1, additional_input_ids=input_ids_parent.to(gpu) if args.multi_source else None, additional_input_ids_mask=input_masks_parent.to(gpu) if args.multi_source else None) ## We translate the batch.
-            print(len(input_ids), "in and", len(translations), "out")
-            if args.return_all_sequences:
-                input_ids = input_ids.repeat(args.beam_size,1)
-            for input_id, translation in zip(input_ids, translations):
-                translation  = tok.decode(translation, skip_special_tokens=args.no_skip_special_tokens, clean_up_tokenization_spaces=False) 
-                input_id  = tok.decode(input_id, skip_special_tokens=args.no_skip_special_tokens, clean_up_tokenization_spaces=False) ### Get the raw sentences.
-#                 print(input_id, " ### ", translation)
-                outf.write(translation+"\n")
-                outf.flush()
-                hyp.append(translation)
-            ctr += 1
-        if args.test_ref is not None:
+        if args.shard_decoding: ## Each process translates its own part of the test set.
+            hyp = decode_shards(model, tok, args, rank, gpu)
+        else:
+            hyp = translate_lines(model, tok, args, outf, gpu)
+        if args.test_ref is not None and hyp is not None:
             sbleu = get_sacrebleu(refs, hyp)
             print("BLEU score is:", sbleu)
     elif args.decode_type == "score" or args.decode_type == "teacher_forced_decoding": ## Here we will either score a sentence and its translation. The score will be the NLL loss. If not scoring then we will use the softmax to generate translations.
@@ -355,7 +585,8 @@ def model_create_load_decode(gpu, args):
                     plot_attention(encdec_info, input_sent_x, tgt_sent_y, model.module.config.encoder_layers, model.module.config.encoder_attention_heads, args.test_tgt+".sentence-"+str(sentence_id)+".enc_dec.png", "Encoder Decoder Attention")
                     sentence_id += 1
                 
-    outf.close()
+    if outf is not None:
+        outf.close()
     
     
     dist.destroy_process_group()
@@ -380,6 +611,28 @@ def run_demo():
                         help='In case you fine-tuned an official model and have a local checkpoint then specifiy it here. If you did not fine-tune an official model but did your own thing then specify it using model_path.')
     parser.add_argument('-m', '--model_path', default='pytorch.bin', type=str, 
                         help='Path to the model to decode')
+    parser.add_argument('--device', default='gpu', type=str, choices=["gpu", "cpu"], 
+                        help='Should we run on GPUs or on CPUs? With cpu, --gpus is the number of processes per node, the processes communicate with the gloo backend and the cores of the node are split among them.')
+    parser.add_argument('--num_threads_per_process', default=0, type=int, 
+                        help='The number of threads each process uses with --device cpu. 0 means the number of cores divided by the number of processes per node.')
+    parser.add_argument('--quantize', default='none', type=str, choices=["none", "dynamic_int8"], 
+                        help='Should the model be quantized for faster CPU inference? With dynamic_int8 the weights of the linear layers (the attention projections, the FFNs and the LM head) are stored as int8 and the activations are quantized on the fly. The model becomes much smaller and usually faster at a small cost in quality which benchmark_quantized_decoding.py measures. Only works with --device cpu.')
+    parser.add_argument('--quantized_model_path', default=None, type=str, 
+                        help='Where the quantized model is saved with --quantize. If the file already exists then the quantized model is loaded from it instead of quantizing the --model_path model. Use the deploy folder of the model, for example model_deploy/pytorch_model.dynamic_int8.bin, so that the interface can load it with its --quantize dynamic_int8 flag. The other model flags such as the number of layers must still be given since the model is created before the quantized weights are loaded.')
+    parser.add_argument('--shard_decoding', action='store_true', 
+                        help='Should the test set be split among the processes? The test set is split into --decode_num_shards disjoint parts which the processes translate in turns. Each part is written to its own file named by --test_tgt followed by ".shard." and the shard number, and the first process merges them in order into --test_tgt at the end. If decoding crashes, rerun the same command and the shards which were already translated are skipped. Only for the "decode" decode type.')
+    parser.add_argument('--decode_num_shards', default=0, type=int, 
+                        help='The number of parts the test set is split into with --shard_decoding. Use more shards than processes to lose less work when resuming after a crash. 0 means one shard per process.')
+    parser.add_argument('--decode_shard_timeout', default=3600, type=int, 
+                        help='With --shard_decoding, how many seconds should the first process wait for a process which still has shards to translate to finish a batch before it assumes that the process died and stops with an error? Every process touches a heartbeat file named by --test_tgt followed by ".heartbeat." and its rank after each batch so this must only be longer than the time it takes to load the model and translate one batch.')
+    parser.add_argument('--pipelined_decoding', action='store_true', 
+                        help='Should decoding be split into 3 stages which run at the same time? A background thread tokenizes and batches the next sentences, the main thread runs the model and another background thread detokenizes and writes the translations. The stages are connected by queues of --decode_queue_depth batches so that the model does not have to wait for the python string processing. The translations are not flushed to the file after every line then. Only for the "decode" decode type.')
+    parser.add_argument('--decode_queue_depth', default=4, type=int, 
+                        help='How many batches can wait between the stages with --pipelined_decoding? Deeper queues smooth out slow batches but keep more batches in memory.')
+    parser.add_argument('--decode_max_tokens', default=0, type=int, 
+                        help='If more than 0 then the test set is read --decode_sort_pool_size sentences at a time, sorted by the tokenized source length and batched so that each batch has at most these many source tokens including padding. Sentences of similar lengths are translated together so that there is little padding and short sentences dont wait for long ones during beam search. The translations are written in the original order. --batch_size is ignored then. Remember that beam search needs memory for beam size times these many tokens.')
+    parser.add_argument('--decode_sort_pool_size', default=100000, type=int, 
+                        help='How many sentences should be read and sorted by length at a time with --decode_max_tokens? Larger pools give less padding but need more memory.')
     parser.add_argument('--batch_size', default=32, type=int, 
                         help='Batch size in terms of number of sentences')
     parser.add_argument('--beam_size', default=4, type=int, 
@@ -537,6 +790,8 @@ def run_demo():
     
     args = parser.parse_args()
     assert len(args.token_masking_probs_range) <= 2
+    assert args.quantize == "none" or args.device == "cpu", "Quantized models can only be run on the CPU."
+    assert args.quantized_model_path is None or args.quantize != "none", "Specify the quantization with --quantize."
     print("IP address is", args.ipaddr)
     #########################################################
     args.world_size = args.gpus * args.nodes                #
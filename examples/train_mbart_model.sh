@@ -50,6 +50,15 @@ python pretrain_nmt.py -n 1  -nr 0 -g 1 --model_path examples/models/mbart_model
 # Note 6: Look at the --save_every and --long_save_every arguments to choose how often and which major checkpoints are to be saved, respectively.
 
 
+## Train a very small MBART model on a single GPU using pre-tokenized corpora. The corpora are tokenized and sharded once and then memory mapped during training. The number of shards should be the number of GPUs times the number of nodes.
+
+# python binarize_corpus.py --tokenizer_name_or_path examples/tokenizers/albert-vienhi16k --files examples/data/train.hi,examples/data/train.en,examples/data/train.vi --num_shards 1 --num_workers 4
+
+# export CUDA_VISIBLE_DEVICES=0 # Change to the GPU ID corresponding to a GPU that is free.
+
+# python pretrain_nmt.py -n 1  -nr 0 -g 1 --model_path examples/models/mbart_model --tokenizer_name_or_path examples/tokenizers/albert-vienhi16k --langs hi,en,vi --mono_src examples/data/train.hi,examples/data/train.en,examples/data/train.vi --encoder_layers 1 --decoder_layers 1 --encoder_attention_heads=1 --decoder_attention_heads=1 --encoder_ffn_dim=128 --decoder_ffn_dim=128 --d_model=64 --use_binarized_corpora
+
+
 ## Train a very small MBART model on a single GPU but simulate a 8-gpu setup. The argument --multistep_optimizer_steps is to be used.
 
 # export CUDA_VISIBLE_DEVICES=0 # Change to the GPU ID corresponding to a GPU that is free.
@@ -6,6 +6,7 @@ import sys
 from flask import Flask, jsonify, make_response
 from flask_cors import CORS
 from flask_swagger_ui import get_swaggerui_blueprint
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) ## The span masking and the quantization are shared with the training and decoding scripts.
 from routes import request_api
 
 APP = Flask(__name__)
@@ -60,7 +61,12 @@ if __name__ == '__main__':
                         help="Use flask debug/dev mode with file change reloading")
     PARSER.add_argument('--port', type=int,
                         help="specify port for the application.")
+    PARSER.add_argument('--quantize', default='none', choices=['none', 'dynamic_int8'],
+                        help="Quantize the linear layers of the models to int8 for faster CPU inference. The models run on the CPU then.")
     ARGS = PARSER.parse_args()
+    if ARGS.quantize != "none":
+        request_api.quantize = ARGS.quantize
+        request_api.device = "cpu" ## Quantized models only run on the CPU.
     if(ARGS.port):
         PORT = int(os.environ.get('PORT', ARGS.port))
     else:
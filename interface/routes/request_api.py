@@ -5,13 +5,16 @@ from flask import jsonify, abort, request, Blueprint, render_template
 from bertviz.bertviz import model_view
 from config import MODELS_PATH
 from transformers import  MBartForConditionalGeneration, AutoModelForSeq2SeqLM, MBart50TokenizerFast, MBartTokenizer
-from transformers import AlbertTokenizer, AutoTokenizer
+from transformers import AlbertTokenizer, AutoTokenizer, AutoConfig
 import json
+import argparse
 import torch
 import random
 import os
 import numpy as np
 from validate_email import validate_email
+from span_masking import mask_spans_in_batch ## From the root of the repository. See app.py.
+from model_quantization import quantize_model_dynamic_int8 ## From the root of the repository. See app.py.
 REQUEST_API = Blueprint('request_api', __name__)
 
 from werkzeug.utils import secure_filename
@@ -22,6 +25,7 @@ from tensorboard.plugins import projector
 tokenizer = ''
 model = ''
 device = "cuda:0" if torch.cuda.is_available() else "cpu"
+quantize = "none" ## Set by app.py. With dynamic_int8 the models are quantized for faster CPU inference.
 langidLangs = ["af", "am", "ar", "az", "be", "bg", "bn", "br", "bs", "ca", "cs", "cy", "da", "de", "el", "en", "es", "et", "fa", "fi", "fr", "ga", "gl", "gu", "he", "hi", "hr", "ht", "hu", "hy", "id", "is", "it", "ja", "jv", "ka", "kk", "km", "kn", "ko", "lb", "lo", "lt", "lv", "mg", "mk", "ml", "mn", "mr", "ms", "ne", "nl", "no", "oc", "or", "pa", "pl", "ps", "pt", "ro", "ru", "si", "sk", "sl", "sq", "sr", "sv", "sw", "ta", "th", "tl", "tr", "uk", "ur", "vi", "xh", "zh", "zu"]
 
 languages = ["Afrikaans", "Amharic", "Arabic", "Asturian", "Azerbaijani", "Bashkir", "Belarusian", "Bulgarian", "Bengali", "Breton", "Bosnian", "Valencian", "Cebuano", "Czech", "Welsh", "Danish", "German", "Greeek", "English", "Spanish", "Estonian", "Persian", "Fulah", "Finnish", "French", "Irish", "Scottish Gaelic", "Galician", "Gujarati", "Hausa", "Hebrew", "Hindi", "Croatian", "Haitian Creole", "Hungarian", "Armenian", "Indonesian", "Igbo", "Iloko", "Icelandic", "Italian", "Japanese", "Javanese", "Georgian", "Kazakh", "Central Khmer", "Kannada", "Korean", "Letzeburgesch", "Ganda", "Lingala", "Lao", "Lithuanian", "Latvian", "Malagasy", "Macedonian", "Malayalam", "Mongolian", "Marathi", "Malay", "Burmese", "Nepali", "Flemish", "Norwegian", "Northern Sotho", "Occitan", "Oriya", "Punjabi", "Polish", "Pashto", "Portuguese", "Moldovan", "Russian", "Sindhi", "Sinhalese", "Slovak", "Slovenian", "Somali", "Albanian", "Serbian", "Swati", "Sundanese", "Swedish", "Swahili", "Tamil", "Thai", "Tagalog", "Tswana", "Turkish", "Ukrainian", "Urdu", "Uzbek", "Vietnamese", "Wolof", "Xhosa", "Yiddish", "Yoruba", "Chinese", "Zulu"]
@@ -44,61 +48,33 @@ mBARTLangDictPrunedToSend = dict(zip(mBARTLanguagesCCTF,mBARTLangCodesCCTF))
 # mBARTLangDict = {'arabic': 'ar_AR', 'czech': 'cs_CZ', 'german': 'de_DE', 'english': 'en_XX', 'spanish': 'es_XX', 'estonian': 'et_EE', 'finnish': 'fi_FI', 'french': 'fr_XX', 'gujarati': 'gu_IN', 'hindi': 'hi_IN', 'italian': 'it_IT', 'japanese': 'ja_XX', 'kazakh': 'kk_KZ', 'korean': 'ko_KR', 'lithuanian': 'lt_LT', 'latvian': 'lv_LV', 'burmese': 'my_MM', 'nepali': 'ne_NP', 'dutch': 'nl_XX', 'romanian': 'ro_RO', 'russian': 'ru_RU', 'sinhala': 'si_LK', 'turkish': 'tr_TR', 'vietnamese': 'vi_VN', 'chinese': 'zh_CN', 'afrikaans': 'af_ZA', 'azerbaijani': 'az_AZ', 'bengali': 'bn_IN', 'persian': 'fa_IR', 'hebrew': 'he_IL', 'croatian': 'hr_HR', 'indonesian': 'id_ID', 'georgian': 'ka_GE', 'khmer': 'km_KH', 'macedonian': 'mk_MK', 'malayalam': 'ml_IN', 'mongolian': 'mn_MN', 'marathi': 'mr_IN', 'polish': 'pl_PL', 'pashto': 'ps_AF', 'portuguese': 'pt_XX', 'swedish': 'sv_SE', 'swahili': 'sw_KE', 'tamil': 'ta_IN', 'telugu': 'te_IN', 'thai': 'th_TH', 'tagalog': 'tl_XX', 'ukrainian': 'uk_UA', 'urdu': 'ur_PK', 'xhosa': 'xh_ZA', 'galician': 'gl_ES', 'slovene': 'sl_SI'}
 # mBARTLangDictPruned = {'arabic': 'ar_AR', 'czech': 'cs_CZ', 'german': 'de_DE', 'english': 'en_XX', 'spanish': 'es_XX', 'estonian': 'et_EE', 'finnish': 'fi_FI', 'french': 'fr_XX', 'gujarati': 'gu_IN', 'hindi': 'hi_IN', 'italian': 'it_IT', 'japanese': 'ja_XX', 'kazakh': 'kk_KZ', 'korean': 'ko_KR', 'lithuanian': 'lt_LT', 'latvian': 'lv_LV', 'burmese': 'my_MM', 'nepali': 'ne_NP', 'dutch': 'nl_XX', 'romanian': 'ro_RO', 'russian': 'ru_RU', 'sinhala': 'si_LK', 'turkish': 'tr_TR', 'vietnamese': 'vi_VN', 'chinese': 'zh_CN'}
 
+def mask_spans_with_token(sentence, mask_tok, mask_percent=0.35, token_masking_lambda=3.5):
+    """Mask the spans in the text the same way as the training scripts do."""
+    masking_args = argparse.Namespace(token_masking_lambda=token_masking_lambda, future_prediction=False)
+    return " ".join(mask_spans_in_batch([sentence.split(" ")], [mask_percent], mask_tok, masking_args)[0])
+
 def mask_spans(sentence):
     """Mask the spans in the text"""
-    mask_count = 0
-    mask_percent = 0.35
-    mask_tok = "[MASK]"
-    token_masking_lambda = 3.5
-    sentence_split = sentence.split(" ")
-    sent_len = len(sentence_split)
-    max_mask_count = int(mask_percent*sent_len)
-    spans_to_mask = list(np.random.poisson(token_masking_lambda, 1000))
-    curr_sent_len = sent_len
-    while mask_count < max_mask_count:
-        try:
-            span_to_mask = spans_to_mask[0]
-            del spans_to_mask[0]
-            if span_to_mask > (max_mask_count-mask_count): ## Cant mask more than the allowable number of tokens.
-                continue
-            idx_to_mask = random.randint(0, (curr_sent_len-1)-(span_to_mask-1)) ## We mask only the remaining half of the sentence to encourage the model to learn representations that can make do without most of the future tokens.
-            if mask_tok not in sentence_split[idx_to_mask:idx_to_mask+span_to_mask]:
-                actually_masked_length = len(sentence_split[idx_to_mask:idx_to_mask+span_to_mask]) ## If at the end of the sentence then we have likely masked fewer tokens.
-                sentence_split[idx_to_mask:idx_to_mask+span_to_mask] = [mask_tok]
-                mask_count += actually_masked_length # We assume that with a low probability there are mask insertions when span lengths are 0 which may cause more mask tokens than planned. I have decided not to count these insersions towards the maximum maskable limit. This means that the total number of mask tokens will be a bit higher than what it should be. 
-                curr_sent_len -= (actually_masked_length-1)
-        except:
-            break ## If we cannot get a properly masked sentence despite all our efforts then we just give up and continue with what we have so far.
-    
-    return " ".join(sentence_split)
+    return mask_spans_with_token(sentence, "[MASK]")
 
 def mask_spans_mbart(sentence):
     """Mask the spans in the text"""
-    mask_count = 0
-    mask_percent = 0.35
-    mask_tok = "<mask>"
-    token_masking_lambda = 3.5
-    sentence_split = sentence.split(" ")
-    sent_len = len(sentence_split)
-    max_mask_count = int(mask_percent*sent_len)
-    spans_to_mask = list(np.random.poisson(token_masking_lambda, 1000))
-    curr_sent_len = sent_len
-    while mask_count < max_mask_count:
-        try:
-            span_to_mask = spans_to_mask[0]
-            del spans_to_mask[0]
-            if span_to_mask > (max_mask_count-mask_count): ## Cant mask more than the allowable number of tokens.
-                continue
-            idx_to_mask = random.randint(0, (curr_sent_len-1)-(span_to_mask-1)) ## We mask only the remaining half of the sentence to encourage the model to learn representations that can make do without most of the future tokens.
-            if mask_tok not in sentence_split[idx_to_mask:idx_to_mask+span_to_mask]:
-                actually_masked_length = len(sentence_split[idx_to_mask:idx_to_mask+span_to_mask]) ## If at the end of the sentence then we have likely masked fewer tokens.
-                sentence_split[idx_to_mask:idx_to_mask+span_to_mask] = [mask_tok]
-                mask_count += actually_masked_length # We assume that with a low probability there are mask insertions when span lengths are 0 which may cause more mask tokens than planned. I have decided not to count these insersions towards the maximum maskable limit. This means that the total number of mask tokens will be a bit higher than what it should be. 
-                curr_sent_len -= (actually_masked_length-1)
-        except:
-            break ## If we cannot get a properly masked sentence despite all our efforts then we just give up and continue with what we have so far.
-    
-    return " ".join(sentence_split)
+    return mask_spans_with_token(sentence, "<mask>")
+
+def quantize_model(model):
+    """Quantizes the linear layers of the model to int8 with the same dynamic quantization as decode_nmt.py if the app was started with --quantize dynamic_int8."""
+    if quantize == "none":
+        return model
+    return quantize_model_dynamic_int8(model)
+
+def load_deploy_model(path):
+    """Loads a model from a deploy folder. When quantizing, the quantized model which decode_nmt.py saves next to pytorch_model.bin (pytorch_model.dynamic_int8.bin) is loaded if it exists, otherwise the model is quantized after loading."""
+    quantized_model_path = os.path.join(path, "pytorch_model."+quantize+".bin")
+    if quantize != "none" and os.path.exists(quantized_model_path):
+        model = quantize_model(AutoModelForSeq2SeqLM.from_config(AutoConfig.from_pretrained(path)))
+        model.load_state_dict(torch.load(quantized_model_path, map_location="cpu"))
+        return model.eval()
+    return quantize_model(AutoModelForSeq2SeqLM.from_pretrained(path, local_files_only=False)).to(device)
 
 def get_blueprint():
     """Return the blueprint for the main app module"""
@@ -135,7 +111,7 @@ def load_model():
                 targetLangDict[lineSplit[2]] = lineSplit[3].replace('2', '')
         
             tokenizer = AutoTokenizer.from_pretrained(path, local_files_only=False, do_lower_case=False, use_fast=False, keep_accents=True)
-            model = AutoModelForSeq2SeqLM.from_pretrained(path, local_files_only=False).to(device)
+            model = quantize_model(AutoModelForSeq2SeqLM.from_pretrained(path, local_files_only=False)).to(device)
             return jsonify({"message": "success", "sourceLangDict": sourceLangDict, "targetLangDict": targetLangDict})
 
         elif  model_name == "ai4bharat/indicbartss":
@@ -148,19 +124,19 @@ def load_model():
                 targetLangDict[lineSplit[2]] = lineSplit[3].replace('2', '')
         
             tokenizer = AutoTokenizer.from_pretrained(path, local_files_only=False, do_lower_case=False, use_fast=False, keep_accents=True)
-            model = AutoModelForSeq2SeqLM.from_pretrained(path, local_files_only=False).to(device)
+            model = quantize_model(AutoModelForSeq2SeqLM.from_pretrained(path, local_files_only=False)).to(device)
             return jsonify({"message": "success", "sourceLangDict": sourceLangDict, "targetLangDict": targetLangDict})
 
         elif model_name == "facebook/mbart-large-cc25":
             path = "facebook/mbart-large-cc25"
-            model = MBartForConditionalGeneration.from_pretrained(path, local_files_only=False).to(device)
+            model = quantize_model(MBartForConditionalGeneration.from_pretrained(path, local_files_only=False)).to(device)
             sourceLangDict=mBARTLangDictPrunedToSend
             targetLangDict=mBARTLangDictPrunedToSend
             return jsonify({"message": "success", "sourceLangDict": sourceLangDict, "targetLangDict": targetLangDict})    
 
         elif model_name == "facebook/mbart-large-50":
             path = "facebook/mbart-large-50"
-            model = MBartForConditionalGeneration.from_pretrained(path, local_files_only=False).to(device)
+            model = quantize_model(MBartForConditionalGeneration.from_pretrained(path, local_files_only=False)).to(device)
             sourceLangDict=mBARTLangDictToSend
             targetLangDict=mBARTLangDictToSend
             return jsonify({"message": "success", "sourceLangDict": sourceLangDict, "targetLangDict": targetLangDict})
@@ -175,7 +151,7 @@ def load_model():
                 targetLangDict[lineSplit[2]] = lineSplit[3].replace('2', '')
         
             tokenizer = AutoTokenizer.from_pretrained(path, local_files_only=False, do_lower_case=False, use_fast=False, keep_accents=True)
-            model = AutoModelForSeq2SeqLM.from_pretrained(path, local_files_only=False).to(device)
+            model = load_deploy_model(path)
             return jsonify({"message": "success", "sourceLangDict": sourceLangDict, "targetLangDict": targetLangDict})
     except:
         return jsonify({"message": "fail"})
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021 National Institute of Information and Communication Technology (Raj Dabre)
+# 
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the
+# Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute,
+# sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+# The above copyright notice and this permission notice shall
+# be included in all copies or substantial portions of the
+# Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY
+# KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+# WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+# PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS
+# OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+## Dynamic int8 quantization shared by decode_nmt.py (through common_utils.py) and the demo interface. It only depends on torch so that the interface does not need the training dependencies.
+
+## Other imports
+import torch
+import torch.nn as nn
+##
+
+def quantize_model_dynamic_int8(model, exception=["shared_proj"]):
+    """Quantizes the linear layers of a model (the attention projections, the FFNs and the LM head) with the dynamic int8 quantization of pytorch for fast CPU inference. The weights are stored as int8 and the activations are quantized on the fly so no calibration data is needed. The layers in the exception list are kept since their weights are used directly. Only works on the CPU. Returns the quantized model."""
+    linear_layer_names = {name for name, module in model.named_modules() if isinstance(module, nn.Linear) and name.split(".")[-1] not in exception}
+    print("Quantizing", len(linear_layer_names), "linear layers to int8.")
+    return torch.quantization.quantize_dynamic(model, linear_layer_names, dtype=torch.qint8)
@@ -74,7 +74,7 @@ torch.manual_seed(621313)
 def model_create_load_run_save(gpu, args, files, train_files):
     """The main function which does the overall training. Should be split into multiple parts in the future. Currently monolithc intentionally."""
     rank = args.nr * args.gpus + gpu ## The rank of the current process out of the total number of processes indicated by world_size.
-    dist.init_process_group(backend='nccl', init_method='env://', world_size=args.world_size, rank=rank)
+    gpu = setup_process_device(gpu, rank, args) ## From here on gpu is the device of this process which is the cpu with --device cpu.
     
     if args.shard_files and rank == 0: ## First shard the data using process 0 aka the prime process or master process. Other processes will wait.
         shard_files_mono(files, args)
@@ -98,6 +98,10 @@ def model_create_load_run_save(gpu, args, files, train_files):
         elif "mbart" in args.tokenizer_name_or_path:
             tok = MBartTokenizer.from_pretrained(args.tokenizer_name_or_path, do_lower_case=False, use_fast=False, keep_accents=True)
         ## Fast tokenizers are not good because their behavior is weird. Accents should be kept or else the segmentation will be messed up on languages with accented characters. No lower case obviously because we want to train on the original case. Set to false if you are ok with the model not dealing with cases.
+    
+    if rank == 0: ## The prime process builds the missing corpus manifests so that the other processes never scan the corpora to get the line counts and length statistics.
+        prepare_corpus_manifests(get_corpus_paths(files + train_files), tok, args)
+    dist.barrier() ## Stop other processes from proceeding till the manifests are built.
     tok.save_pretrained(args.model_path+"_deploy") ## Save the tokenizer for future use.
     print("Tokenizer is:", tok)
 
@@ -132,8 +136,10 @@ def model_create_load_run_save(gpu, args, files, train_files):
     if args.unidirectional_encoder:
         print("Using unidirectional encoder.")
     
+    checkpoint_writer = None ## Only the prime process saves checkpoints.
     if rank == 0:
         writer = SummaryWriter(args.model_path+".tflogs")
+        checkpoint_writer = CheckpointWriter(args.async_checkpointing) ## Checkpoints are written in the background if requested.
     
     if args.use_official_pretrained:
         if "mbart" in args.pretrained_model or "IndicBART" in args.pretrained_model:
@@ -192,14 +198,15 @@ def model_create_load_run_save(gpu, args, files, train_files):
         config.architectures = ["MBartForConditionalGeneration"]
         config.save_pretrained(args.model_path+"_deploy") ## Save the config as a json file to ensure easy loading during future fine tuning of the model.
         model = MBartForConditionalGeneration(config)
-    torch.cuda.set_device(gpu)
+    set_device(gpu)
     torch.cuda.empty_cache()
 
-    model.cuda(gpu)
+    model.to(gpu)
     model.train()
     
     if args.distillation: ## When distilling we need a parent model. The creation of the model is in the same way as the child. This model is immediately loaded with some pretrained params and then loaded into the GPU.
         print("We will do distillation from a parent model.")
+        parent_output_hidden_states, parent_output_attentions = get_parent_output_flags(args) ## The parent only computes what the distillation styles need.
         if args.use_official_parent_pretrained:
             if "mbart" in args.parent_pretrained_model or "IndicBART" in args.pretrained_model:
                 parent_config = MBartConfig.from_pretrained(args.parent_pretrained_model)
@@ -220,28 +227,34 @@ def model_create_load_run_save(gpu, args, files, train_files):
         else: ## We are going to manually specify our own parent model config.
             parent_config = MBartConfig(vocab_size=len(tok), encoder_layers=args.parent_encoder_layers, decoder_layers=args.parent_decoder_layers, dropout=args.parent_dropout, attention_dropout=args.parent_attention_dropout, activation_dropout=args.parent_activation_dropout, encoder_attention_heads=args.parent_encoder_attention_heads, decoder_attention_heads=args.parent_decoder_attention_heads, encoder_ffn_dim=args.parent_encoder_ffn_dim, decoder_ffn_dim=args.parent_decoder_ffn_dim, d_model=args.parent_d_model, no_embed_norm=args.no_embed_norm, scale_embedding=args.scale_embedding, pad_token_id=tok.pad_token_id, eos_token_id=tok(["</s>"], add_special_tokens=False).input_ids[0][0], bos_token_id=tok(["<s>"], add_special_tokens=False).input_ids[0][0], encoder_tying_config=args.encoder_tying_config, decoder_tying_config=args.decoder_tying_config, multilayer_softmaxing=args.multilayer_softmaxing, wait_k=args.wait_k, unidirectional_encoder=args.unidirectional_encoder, softmax_temperature=args.softmax_temperature, temperature_calibration=args.temperature_calibration, encoder_layerdrop=args.layerdrop, decoder_layerdrop=args.layerdrop, no_scale_attention_embedding=args.no_scale_attention_embedding, positional_encodings=args.positional_encodings, activation_function=args.activation_function, no_positional_encoding_encoder=args.no_positional_encoding_encoder, no_positional_encoding_decoder=args.no_positional_encoding_decoder, use_moe=args.use_moe, num_experts=args.num_experts, expert_ffn_size=args.expert_ffn_size)
             parent_model = MBartForConditionalGeneration(config)
-        parent_model.cuda(gpu)
+        parent_model.to(gpu)
         parent_model.train() ## We do this to enable dropout but we wont have an optimizer for this so we wont train this model. For now. Future implementations should ask if we want to do co-distill or not. By co-distillation I mean, the parent will learn together with the child.
-        parent_model = DistributedDataParallel(parent_model, device_ids=[gpu], output_device=gpu)
+        if not args.frozen_parent: ## A frozen parent is never trained so it does not need the DDP wrapper.
+            parent_model = wrap_in_ddp(parent_model, gpu)
         print("Loading a parent model from which distillation will be done.")
         dist.barrier()
         # configure map_location properly
-        map_location = {'cuda:%d' % 0: 'cuda:%d' % gpu}
+        map_location = get_map_location(gpu)
         if not args.use_official_parent_pretrained:
             parent_checkpoint_dict = torch.load(args.parent_pretrained_model, map_location=map_location)
             if type(parent_checkpoint_dict) == dict:
-                parent_model.load_state_dict(parent_checkpoint_dict['model']) # We never do any remapping of the parent. We always reuse it as it is.
+                if args.frozen_parent: ## The checkpoint was saved from a DDP wrapped model.
+                    parent_model.load_state_dict({key[len("module."):] if key.startswith("module.") else key: value for key, value in parent_checkpoint_dict['model'].items()}) # We never do any remapping of the parent. We always reuse it as it is.
+                else:
+                    parent_model.load_state_dict(parent_checkpoint_dict['model']) # We never do any remapping of the parent. We always reuse it as it is.
             else:
-                parent_model.module.load_state_dict(parent_checkpoint_dict) # We never do any remapping of the parent. We always reuse it as it is.
+                (parent_model if args.frozen_parent else parent_model.module).load_state_dict(parent_checkpoint_dict) # We never do any remapping of the parent. We always reuse it as it is.
             del parent_checkpoint_dict
+        if args.frozen_parent:
+            parent_model = prepare_frozen_parent(parent_model, args)
     freeze_params(model, args.freeze_exception_list)
 
     ### NOTE: Please freeze params before wrapping the model in DDP. Mandem almost had a stoke trying to figure this out.
 
-    model.cuda(gpu) ## Move the model to the GPU.
-    print("Memory consumed after moving model to GPU", round(torch.cuda.memory_allocated(gpu)/(1024**3), 2), "GB")
-    model = DistributedDataParallel(model, device_ids=[gpu], output_device=gpu) ## This wrapper around the model will enable distributed training.
-    print("Memory consumed after wrapping model in DDP", round(torch.cuda.memory_allocated(gpu)/(1024**3), 2), "GB")
+    model.to(gpu) ## Move the model to the GPU.
+    print("Memory consumed after moving model to GPU", get_memory_allocated(gpu), "GB")
+    model = wrap_in_ddp(model, gpu) ## This wrapper around the model will enable distributed training.
+    print("Memory consumed after wrapping model in DDP", get_memory_allocated(gpu), "GB")
     no_decay = ["bias", "LayerNorm.weight"]
     optimizer_grouped_parameters = [
         {
@@ -282,7 +295,7 @@ def model_create_load_run_save(gpu, args, files, train_files):
     if args.pretrained_model != "" and (not args.use_official_pretrained or args.locally_fine_tuned_model_path is not None): ## Here we load a previous checkpoint in case training crashed. Note the args.locally_fine_tuned_model_path. This is in case we were tuning an official mbart or indicbart or bart model but want to further tine tune it or it crashed and we want to resume training it.
         print("Loading from checkpoint. Strict loading by default but if there are missing or non matching keys or if we use prompt or adaptor tuning, they will be ignored when layer remapping or component selection is done. In case of prompt and adaptor tuning, new params are added to the model and hence strict matching of keys is not possible.")
         dist.barrier()
-        map_location = {'cuda:%d' % 0: 'cuda:%d' % gpu}
+        map_location = get_map_location(gpu)
         sys.stdout.flush()
         if args.locally_fine_tuned_model_path is not None: ## Now that the pretrained_model argument was used to instantiate the model, it can be replaced with the local model path. Remember to specify pure model or the model with the optimizer and scheduler states depending on your requirement by relying on the flag --no_reload_optimizer_ctr_and_scheduler.
             args.pretrained_model = args.locally_fine_tuned_model_path
@@ -318,11 +331,10 @@ def model_create_load_run_save(gpu, args, files, train_files):
             print("Training from scratch")
         CHECKPOINT_PATH = args.model_path
         if rank == 0:
-            checkpoint_dict = {'model': model.state_dict(), 'optimizer': optimizer.state_dict(), 'scheduler': scheduler.state_dict(), 'ctr': 0}
-            torch.save(checkpoint_dict, CHECKPOINT_PATH) ## Save a model by default every eval_every steps. This model will be saved with the same file name each time.
-            torch.save(model.module.state_dict(), CHECKPOINT_PATH+".pure_model")
+            checkpoint_writer.save(model, optimizer, scheduler, 0, CHECKPOINT_PATH) ## Save a model by default every eval_every steps. This model will be saved with the same file name each time.
+            checkpoint_writer.wait()
         dist.barrier()
-        map_location = {'cuda:%d' % 0: 'cuda:%d' % gpu}
+        map_location = get_map_location(gpu)
         checkpoint_dict = torch.load(CHECKPOINT_PATH, map_location=map_location)
         model.load_state_dict(checkpoint_dict['model'])
         optimizer.load_state_dict(checkpoint_dict['optimizer'])
@@ -346,16 +358,26 @@ def model_create_load_run_save(gpu, args, files, train_files):
         num_batches_tmp = args.num_batches
         args.num_batches = args.ewc_samples
         print("Learning Fisher coefficients.")
-        ewc_loss = EWC(model, generate_batches_monolingual_masked(tok, args, files, rank), gpu, args.label_smoothing, ignore_index=tok.pad_token_id)
+        ewc_loss = EWC(model, generate_batches_monolingual_masked(tok, args, files, rank), gpu, args.label_smoothing, ignore_index=tok.pad_token_id, fisher_cache_path=get_fisher_cache_path(model, files, args))
         args.num_batches = num_batches_tmp
         print("Fisher coefficients learned.")
 
+    assert not (args.chunked_loss and (args.temperature_calibration or args.distillation)), "The chunked loss never materializes the logits so it cant be used with temperature calibration or distillation."
+    if args.chunked_loss and not isinstance(model.module, MBartForConditionalGeneration):
+        raise RuntimeError("--chunked_loss needs the MBart model of this repository which returns the decoder outputs fed to its LM head but the model is a "+type(model.module).__name__+". Train without --chunked_loss.")
     num_batches_this_optimizer_step = 0
     losses = 0
+    metrics = MetricAggregator(writer if rank == 0 else None, gpu, args.reduce_metrics_across_ranks) ## The losses are summed on the GPU and written every metrics_flush_every steps.
     start = time.time()
-    for (input_ids, input_masks, decoder_input_ids, labels), is_bilingual in generate_batches_monolingual_masked_or_bilingual(tok, args, rank, files, train_files): #Batches are generated from here. The argument (0.30, 0.40) is a range which indicates the percentage of the source sentence to be masked in case we want masking during training just like we did during BART pretraining. The argument 3.5 is the lambda to the poisson length sampler which indicates the average length of a word sequence that will be masked. Since this is pretraining we do not do any evaluations even if we train on parallel corpora.
+    assert not (args.pack_examples and args.contrastive_decoder_training), "Contrastive decoder training shuffles the decoder inputs which breaks packed examples."
+    batch_prefetcher = BatchPrefetcher(generate_batches_monolingual_masked_or_bilingual, {"tok": tok, "args": args, "rank": rank, "files": files, "train_files": train_files}, rank, gpu, args.num_data_workers, args.data_queue_depth) ## Batches are created by background workers if requested.
+    data_wait_time = 0.0
+    for (input_ids, input_masks, decoder_input_ids, labels), is_bilingual in batch_prefetcher: #Batches are generated from here. The argument (0.30, 0.40) is a range which indicates the percentage of the source sentence to be masked in case we want masking during training just like we did during BART pretraining. The argument 3.5 is the lambda to the poisson length sampler which indicates the average length of a word sequence that will be masked. Since this is pretraining we do not do any evaluations even if we train on parallel corpora.
+        data_wait_time += batch_prefetcher.last_wait_time
+        metrics.add("data wait time", batch_prefetcher.last_wait_time) ## If this is not close to 0 then increase --num_data_workers.
         if num_batches_this_optimizer_step == 0: ## This is the first batch of this optimizer step.
             optimizer.zero_grad(set_to_none=True) ## Empty the gradients before any computation.
+        set_gradient_synchronization(model, num_batches_this_optimizer_step == args.multistep_optimizer_steps - 1) ## With gradient accumulation only the last batch of the optimizer step all-reduces the gradients.
         
         if ctr % args.save_every == 0 and num_batches_this_optimizer_step == 0: ## We have to evaluate our model every save_every steps. Since there is no evaluation data during pretraining this means our model is saved every save_every steps.
             CHECKPOINT_PATH = args.model_path
@@ -365,29 +387,18 @@ def model_create_load_run_save(gpu, args, files, train_files):
                 # All processes should see same parameters as they all start from same
                 # random parameters and gradients are synchronized in backward passes.
                 # Therefore, saving it in one process is sufficient.
-                checkpoint_dict = {'model': model.state_dict(), 'optimizer': optimizer.state_dict(), 'scheduler': scheduler.state_dict(), 'ctr': ctr}
-                torch.save(checkpoint_dict, CHECKPOINT_PATH) ## Save a model by default every save_every steps. This model will be saved with the same file name each time.
-                torch.save(model.module.state_dict(), CHECKPOINT_PATH+".pure_model")
                 if ctr % args.long_save_every == 0 and args.save_intermediate_checkpoints: ## If no evaluation will be done then I consider it prudent to save the model every 10000 checkpoints by default. Change this to whatever value you want.
                     print("Saving an intermediate checkpoint")
-                    torch.save(checkpoint_dict, CHECKPOINT_PATH + "."+str(ctr)) 
-                    torch.save(model.module.state_dict(), CHECKPOINT_PATH+ "."+str(ctr)+".pure_model")
-                    ## Copy the long saved model deploy folder.
-                    os.system("cp "+CHECKPOINT_PATH+"."+str(ctr)+".pure_model "+CHECKPOINT_PATH+"_deploy/pytorch_model.bin")
+                    checkpoint_writer.save(model, optimizer, scheduler, ctr, CHECKPOINT_PATH, [CHECKPOINT_PATH+"."+str(ctr)], CHECKPOINT_PATH+"_deploy/pytorch_model.bin") ## The intermediate checkpoint and the deploy model are hardlinks to the saved checkpoint.
                     start = time.time()
+                else:
+                    checkpoint_writer.save(model, optimizer, scheduler, ctr, CHECKPOINT_PATH) ## Save a model by default every save_every steps. This model will be saved with the same file name each time.
+                if args.checkpoint_sync_mode == "reload": ## The other processes will read the checkpoint after the barrier.
+                    checkpoint_writer.wait()
             # Use a barrier() to make sure that process 1 loads the model after process
             # 0 saves it.
             dist.barrier()
-            # configure map_location properly
-            print("Loading from checkpoint")
-            map_location = {'cuda:%d' % 0: 'cuda:%d' % gpu}
-            sys.stdout.flush()
-            checkpoint_dict = torch.load(CHECKPOINT_PATH, map_location=map_location)
-            model.load_state_dict(checkpoint_dict['model'])
-            optimizer.load_state_dict(checkpoint_dict['optimizer'])
-            scheduler.load_state_dict(checkpoint_dict['scheduler'])
-            del checkpoint_dict
-            torch.cuda.empty_cache()
+            synchronize_after_checkpoint(model, optimizer, scheduler, CHECKPOINT_PATH, checkpoint_writer, gpu, args) ## By default every process reloads the checkpoint but this can be skipped or replaced by a cheap consistency check.
             
         if args.num_domains_for_domain_classifier > 1: ## The label will contain the label as well as the domain indicator
             domain_classifier_labels=labels[1] ## This is not a tensor yet
@@ -395,10 +406,16 @@ def model_create_load_run_save(gpu, args, files, train_files):
             domain_classifier_labels = torch.tensor(domain_classifier_labels, dtype=torch.int64).to(gpu) ## Move to gpu
             labels=labels[0]
             label_mask = labels.eq(tok.pad_token_id).unsqueeze(-1).to(gpu)
-        input_ids=input_ids.to(gpu) ## Move to gpu
-        input_masks=input_masks.to(gpu) ## Move to gpu
-        decoder_input_ids=decoder_input_ids.to(gpu) ## Move to gpu
-        labels=labels.to(gpu) ## Move to gpu
+        if args.pack_examples: ## The input masks are actually a list of the attention masks and the segment ids of the packed examples on the encoder and decoder sides.
+            input_masks, encoder_segment_ids, decoder_segment_ids = input_masks
+            segment_kwargs = {"encoder_segment_ids": encoder_segment_ids.to(gpu, non_blocking=True), "decoder_segment_ids": decoder_segment_ids.to(gpu, non_blocking=True)} ## The model uses these for block diagonal attention masks and to restart the positions for every packed example.
+        else:
+            segment_kwargs = {}
+        metrics.add("padding efficiency", get_padding_efficiency(input_ids, labels, tok.pad_token_id)) ## Real tokens divided by padded tokens. Use this to tune --bucket_width and --bucketing_pool_size.
+        input_ids=input_ids.to(gpu, non_blocking=True) ## Move to gpu. Non blocking because the batch is pinned when prefetched.
+        input_masks=input_masks.to(gpu, non_blocking=True) ## Move to gpu. Non blocking because the batch is pinned when prefetched.
+        decoder_input_ids=decoder_input_ids.to(gpu, non_blocking=True) ## Move to gpu. Non blocking because the batch is pinned when prefetched.
+        labels=labels.to(gpu, non_blocking=True) ## Move to gpu. Non blocking because the batch is pinned when prefetched.
         
         if args.mixed_wait_k:
             model.module.config.wait_k = random.randint(1, args.wait_k)
@@ -422,28 +439,21 @@ def model_create_load_run_save(gpu, args, files, train_files):
                     target_hidden_state_encoder.masked_fill_(pad_mask, 0.0)
                     target_hidden_state_encoder = target_hidden_state_encoder.mean(dim=1)
                     loss = -cosine_similarity(source_hidden_state_encoder, target_hidden_state_encoder)
-                    if rank == 0:
-                        writer.add_scalar("encoder unification loss", loss.detach().cpu().numpy(), ctr)
+                    metrics.add("encoder unification loss", loss)
                 else:
-                    mod_compute = model(input_ids=input_ids, attention_mask=input_masks, decoder_input_ids=decoder_input_ids, output_hidden_states=args.distillation, output_attentions=args.distillation, label_mask=label_mask if args.num_domains_for_domain_classifier > 1 else None) ## Run the model and get logits.
+                    mod_compute = model(input_ids=input_ids, attention_mask=input_masks, decoder_input_ids=decoder_input_ids, output_hidden_states=args.distillation, output_attentions=args.distillation, label_mask=label_mask if args.num_domains_for_domain_classifier > 1 else None, return_lm_hidden_states=args.chunked_loss, **segment_kwargs) ## Run the model and get logits.
                     logits = mod_compute.logits
-                    lprobs = torch.nn.functional.log_softmax(logits, dim=-1) ## Softmax tempering of logits if needed.
-                    loss = label_smoothed_nll_loss(
-                        lprobs, labels, args.label_smoothing, ignore_index=tok.pad_token_id
-                    ) ## Label smoothed cross entropy loss.
+                    loss, entropy = compute_lm_loss(model, mod_compute.lm_hidden_states if args.chunked_loss else logits, labels, tok.pad_token_id, args) ## Label smoothed cross entropy loss. With --chunked_loss the logits are computed in chunks and never materialized and the entropy is computed along with the loss if needed.
                     loss = loss*args.softmax_temperature ## Up scale loss in case of non unitary temperatures. Note that in case of self calibrating temperature, the softmax temperature must be set to 1.
-                    if rank == 0:
-                        writer.add_scalar("pure cross entropy loss", loss.detach().cpu().numpy(), ctr)
+                    metrics.add("pure cross entropy loss", loss)
                     if args.ewc_importance != 0: ## Update the model with the EWC loss.
                         ewc_loss_current = args.ewc_importance * ewc_loss.penalty(model)
-                        if rank == 0:
-                            writer.add_scalar("EWC loss", ewc_loss_current.detach().cpu().numpy(), ctr)
+                        metrics.add("EWC loss", ewc_loss_current)
                         loss = loss + ewc_loss_current
                     if args.temperature_calibration: 
                         loss = loss*mod_compute.softmax_temperature
-                        if rank == 0:
-                            writer.add_scalar("calibrated temperature", mod_compute.softmax_temperature.detach().cpu().numpy(), ctr)
-                            writer.add_scalar("calibrated temperature loss", loss.detach().cpu().numpy(), ctr)
+                        metrics.add("calibrated temperature", mod_compute.softmax_temperature)
+                        metrics.add("calibrated temperature loss", loss)
                     if args.num_domains_for_domain_classifier > 1: ## We augment the main loss with the domain classifier loss
                         domain_classifier_logits = mod_compute.domain_classifier_logits
                         domain_classifier_lprobs = torch.nn.functional.log_softmax(domain_classifier_logits, dim=-1) ## Softmax tempering of logits if needed.
@@ -451,10 +461,14 @@ def model_create_load_run_save(gpu, args, files, train_files):
                             domain_classifier_lprobs.view(-1,args.num_domains_for_domain_classifier), domain_classifier_labels.view(-1,1), args.label_smoothing
                         ) ## Label smoothed cross entropy loss. We are not going to do any temperature related stuff to this.
                         loss = domain_classifier_loss*args.domain_classifier_loss_weight + loss * (1.0-args.domain_classifier_loss_weight)
-                        if rank == 0:
-                            writer.add_scalar("domain classifier loss", domain_classifier_loss.detach().cpu().numpy(), ctr)
-                            writer.add_scalar("loss with domain classifier loss", loss.detach().cpu().numpy(), ctr)
+                        metrics.add("domain classifier loss", domain_classifier_loss)
+                        metrics.add("loss with domain classifier loss", loss)
                     ## We will do multilayer softmaxing without any consideration for distillation or domain classification.
+                    if args.chunked_loss and mod_compute.additional_lm_hidden_states is not None:
+                        for additional_hidden_states in mod_compute.additional_lm_hidden_states:
+                            loss_extra, entropy_extra = compute_lm_loss(model, additional_hidden_states, labels, tok.pad_token_id, args)
+                            loss += loss_extra*args.softmax_temperature ## Up scale loss in case of non unitary temperatures.
+                            entropy += entropy_extra
                     if mod_compute.additional_lm_logits is not None:
                         for additional_logits in mod_compute.additional_lm_logits:
                             lprobs = torch.nn.functional.log_softmax(additional_logits, dim=-1) ## Softmax tempering of logits if needed.
@@ -467,36 +481,35 @@ def model_create_load_run_save(gpu, args, files, train_files):
                             loss += loss_extra ## Up scale loss in case of non unitary temperatures. TODO: Perhaps log this too.
                     if args.max_ent_weight != -1: ## This deals with softmax entropy maximization. The logic is that we compute the softmax entropy of the predictions via -(P(Y/X)*log(P(Y/X))). We then add it to the cross entropy loss with a negative sign as we wish to maximize entropy. This should penalize overconfident predictions. 
                         assert (args.max_ent_weight >= 0 and args.max_ent_weight <= 1)
-                        logits = logits*args.softmax_temperature ## We have to undo the tempered logits else our entropy estimate will be wrong.
-                        if args.temperature_calibration: 
-                            logits = logits*mod_compute.softmax_temperature
-                        lprobs = torch.nn.functional.log_softmax(logits, dim=-1) ## No tempering here
-                        entropy = -(torch.exp(lprobs)*lprobs).mean()
-                        if rank == 0:
-                            writer.add_scalar("softmax entropy", entropy.detach().cpu().numpy(), ctr)
-                        if mod_compute.additional_lm_logits is not None:
-                            for additional_logits in mod_compute.additional_lm_logits: ## Compute entropy for each layer as well
-                                additional_logits = additional_logits*args.softmax_temperature ## We have to undo the tempered logits else our entropy estimate will be wrong.
-                                if args.temperature_calibration: 
-                                    additional_logits = additional_logits*mod_compute.softmax_temperature
-                                lprobs = torch.nn.functional.log_softmax(additional_logits, dim=-1) ## No tempering here
-                                entropy_extra = -(torch.exp(lprobs)*lprobs).mean()
-                                entropy += entropy_extra
+                        if args.chunked_loss: ## The entropy was computed along with the loss.
+                            metrics.add("softmax entropy", entropy)
+                        else:
+                            logits = logits*args.softmax_temperature ## We have to undo the tempered logits else our entropy estimate will be wrong.
+                            if args.temperature_calibration: 
+                                logits = logits*mod_compute.softmax_temperature
+                            lprobs = torch.nn.functional.log_softmax(logits, dim=-1) ## No tempering here
+                            entropy = -(torch.exp(lprobs)*lprobs).mean()
+                            metrics.add("softmax entropy", entropy)
+                            if mod_compute.additional_lm_logits is not None:
+                                for additional_logits in mod_compute.additional_lm_logits: ## Compute entropy for each layer as well
+                                    additional_logits = additional_logits*args.softmax_temperature ## We have to undo the tempered logits else our entropy estimate will be wrong.
+                                    if args.temperature_calibration: 
+                                        additional_logits = additional_logits*mod_compute.softmax_temperature
+                                    lprobs = torch.nn.functional.log_softmax(additional_logits, dim=-1) ## No tempering here
+                                    entropy_extra = -(torch.exp(lprobs)*lprobs).mean()
+                                    entropy += entropy_extra
                         loss = loss*(1-args.max_ent_weight) - entropy*args.max_ent_weight ## Maximize the entropy so a minus is needed. Weigh and add losses as required.
-                        if rank == 0:
-                            writer.add_scalar("loss with entropy loss", loss.detach().cpu().numpy(), ctr)
+                        metrics.add("loss with entropy loss", loss)
                     if args.distillation: ## Time to distill.
                         with torch.no_grad(): ## No gradient to avoid memory allocation.
-                            parent_mod_compute = parent_model(input_ids=input_ids, attention_mask=input_masks ,decoder_input_ids=decoder_input_ids, output_hidden_states=args.distillation, output_attentions=args.distillation)
+                            parent_mod_compute = parent_model(input_ids=input_ids, attention_mask=input_masks ,decoder_input_ids=decoder_input_ids, output_hidden_states=parent_output_hidden_states, output_attentions=parent_output_attentions, **segment_kwargs)
                         distillation_loss = compute_distillation_losses(mod_compute, parent_mod_compute, labels, tok.pad_token_id, args) ## Get the parent model's computations.
                         loss = args.distillation_loss_weight*distillation_loss + (1.0 - args.distillation_loss_weight)*loss ## Update the main loss with weighing and adding.
-                        if rank == 0:
-                            writer.add_scalar("distillation loss", distillation_loss.detach().cpu().numpy(), ctr)
-                            writer.add_scalar("final loss", loss.detach().cpu().numpy(), ctr)
+                        metrics.add("distillation loss", distillation_loss)
+                        metrics.add("final loss", loss)
                     if args.use_moe or args.moe_adaptors: ## add MOE losses too.
                         moe_loss = torch.sum(torch.stack(mod_compute.encoder_moe_losses)) + torch.sum(torch.stack(mod_compute.decoder_moe_losses))
-                        if rank == 0:
-                            writer.add_scalar("moe loss", moe_loss.detach().cpu().numpy(), ctr)
+                        metrics.add("moe loss", moe_loss)
                         loss += moe_loss
                         
                     if args.contrastive_decoder_training: ## Shuffle the decoder input and label batches and compute loss. This should be negated and added to the overall loss.
@@ -504,12 +517,8 @@ def model_create_load_run_save(gpu, args, files, train_files):
                         shuffle_indices = torch.randperm(batch_size)
                         decoder_input_ids = decoder_input_ids[shuffle_indices]
                         labels = labels[shuffle_indices]
-                        mod_compute = model(input_ids=input_ids, attention_mask=input_masks, decoder_input_ids=decoder_input_ids) ## Run the model and get logits.
-                        logits = mod_compute.logits
-                        lprobs = torch.nn.functional.log_softmax(logits, dim=-1)
-                        contrastive_loss = label_smoothed_nll_loss(
-                            lprobs, labels, args.label_smoothing, ignore_index=tok.pad_token_id
-                        ) ## Label smoothed cross entropy loss.
+                        mod_compute = model(input_ids=input_ids, attention_mask=input_masks, decoder_input_ids=decoder_input_ids, return_lm_hidden_states=args.chunked_loss) ## Run the model and get logits.
+                        contrastive_loss, _ = compute_lm_loss(model, mod_compute.lm_hidden_states if args.chunked_loss else mod_compute.logits, labels, tok.pad_token_id, args, compute_entropy=False) ## Label smoothed cross entropy loss.
                         loss -= contrastive_loss
         else:
             if is_bilingual and args.unify_encoder:
@@ -524,28 +533,21 @@ def model_create_load_run_save(gpu, args, files, train_files):
                 target_hidden_state_encoder.masked_fill_(pad_mask, 0.0)
                 target_hidden_state_encoder = target_hidden_state_encoder.mean(dim=1)
                 loss = -cosine_similarity(source_hidden_state_encoder, target_hidden_state_encoder)
-                if rank == 0:
-                    writer.add_scalar("encoder unification loss", loss.detach().cpu().numpy(), ctr)
+                metrics.add("encoder unification loss", loss)
             else:
-                mod_compute = model(input_ids=input_ids, attention_mask=input_masks, decoder_input_ids=decoder_input_ids, output_hidden_states=args.distillation, output_attentions=args.distillation, label_mask=label_mask if args.num_domains_for_domain_classifier > 1 else None) ## Run the model and get logits.
+                mod_compute = model(input_ids=input_ids, attention_mask=input_masks, decoder_input_ids=decoder_input_ids, output_hidden_states=args.distillation, output_attentions=args.distillation, label_mask=label_mask if args.num_domains_for_domain_classifier > 1 else None, return_lm_hidden_states=args.chunked_loss, **segment_kwargs) ## Run the model and get logits.
                 logits = mod_compute.logits
-                lprobs = torch.nn.functional.log_softmax(logits, dim=-1) ## Softmax tempering of logits if needed.
-                loss = label_smoothed_nll_loss(
-                    lprobs, labels, args.label_smoothing, ignore_index=tok.pad_token_id
-                ) ## Label smoothed cross entropy loss.
+                loss, entropy = compute_lm_loss(model, mod_compute.lm_hidden_states if args.chunked_loss else logits, labels, tok.pad_token_id, args) ## Label smoothed cross entropy loss. With --chunked_loss the logits are computed in chunks and never materialized and the entropy is computed along with the loss if needed.
                 loss = loss*args.softmax_temperature ## Up scale loss in case of non unitary temperatures.
-                if rank == 0:
-                    writer.add_scalar("pure cross entropy loss", loss.detach().cpu().numpy(), ctr)
+                metrics.add("pure cross entropy loss", loss)
                 if args.ewc_importance != 0: ## Update the model with the EWC loss.
                     ewc_loss_current = args.ewc_importance * ewc_loss.penalty(model)
-                    if rank == 0:
-                        writer.add_scalar("EWC loss", ewc_loss_current.detach().cpu().numpy(), ctr)
+                    metrics.add("EWC loss", ewc_loss_current)
                     loss = loss + ewc_loss_current
                 if args.temperature_calibration: 
                     loss = loss*mod_compute.softmax_temperature
-                    if rank == 0:
-                        writer.add_scalar("calibrated temperature", mod_compute.softmax_temperature.detach().cpu().numpy(), ctr)
-                        writer.add_scalar("calibrated temperature loss", loss.detach().cpu().numpy(), ctr)
+                    metrics.add("calibrated temperature", mod_compute.softmax_temperature)
+                    metrics.add("calibrated temperature loss", loss)
                 if args.num_domains_for_domain_classifier > 1: ## We augment the main loss with the domain classifier loss
                     domain_classifier_logits = mod_compute.domain_classifier_logits
                     domain_classifier_lprobs = torch.nn.functional.log_softmax(domain_classifier_logits, dim=-1) ## Softmax tempering of logits if needed.
@@ -554,10 +556,14 @@ def model_create_load_run_save(gpu, args, files, train_files):
                         domain_classifier_lprobs.view(-1,args.num_domains_for_domain_classifier), domain_classifier_labels.view(-1,1), args.label_smoothing
                     ) ## Label smoothed cross entropy loss. We are not going to do any temperature related stuff to this.
                     loss = domain_classifier_loss*args.domain_classifier_loss_weight + loss * (1.0-args.domain_classifier_loss_weight)
-                    if rank == 0:
-                        writer.add_scalar("domain classifier loss", domain_classifier_loss.detach().cpu().numpy(), ctr)
-                        writer.add_scalar("loss with domain classifier loss", loss.detach().cpu().numpy(), ctr)
+                    metrics.add("domain classifier loss", domain_classifier_loss)
+                    metrics.add("loss with domain classifier loss", loss)
                 ## We will do multilayer softmaxing without any consideration for entropy maximization or distillation.
+                if args.chunked_loss and mod_compute.additional_lm_hidden_states is not None:
+                    for additional_hidden_states in mod_compute.additional_lm_hidden_states:
+                        loss_extra, entropy_extra = compute_lm_loss(model, additional_hidden_states, labels, tok.pad_token_id, args)
+                        loss += loss_extra*args.softmax_temperature ## Up scale loss in case of non unitary temperatures.
+                        entropy += entropy_extra
                 if mod_compute.additional_lm_logits is not None:
                     for additional_logits in mod_compute.additional_lm_logits:
                         lprobs = torch.nn.functional.log_softmax(additional_logits, dim=-1) ## Softmax tempering of logits if needed.
@@ -570,48 +576,43 @@ def model_create_load_run_save(gpu, args, files, train_files):
                         loss += loss_extra ## Up scale loss in case of non unitary temperatures. TODO: Perhaps log this too.
                 if args.max_ent_weight != -1: ## This deals with softmax entropy maximization. The logic is that we compute the softmax entropy of the predictions via -(P(Y/X)*log(P(Y/X))). We then add it to the cross entropy loss with a negative sign as we wish to maximize entropy. This should penalize overconfident predictions. 
                     assert (args.max_ent_weight >= 0 and args.max_ent_weight <= 1)
-                    logits = logits*args.softmax_temperature ## We have to undo the tempered logits else our entropy estimate will be wrong.
-                    if args.temperature_calibration: 
-                        logits = logits*mod_compute.softmax_temperature
-                    lprobs = torch.nn.functional.log_softmax(logits, dim=-1) ## No tempering here
-                    entropy = -(torch.exp(lprobs)*lprobs).mean()
-                    if rank == 0:
-                        writer.add_scalar("softmax entropy", entropy.detach().cpu().numpy(), ctr)
-                    if mod_compute.additional_lm_logits is not None:
-                        for additional_logits in mod_compute.additional_lm_logits: ## Compute entropy for each layer as well
-                            additional_logits = additional_logits*args.softmax_temperature ## We have to undo the tempered logits else our entropy estimate will be wrong.
-                            if args.temperature_calibration: 
-                                additional_logits = additional_logits*mod_compute.softmax_temperature
-                            lprobs = torch.nn.functional.log_softmax(additional_logits, dim=-1) ## No tempering here
-                            entropy_extra = -(torch.exp(lprobs)*lprobs).mean()
-                            entropy += entropy_extra
+                    if args.chunked_loss: ## The entropy was computed along with the loss.
+                        metrics.add("softmax entropy", entropy)
+                    else:
+                        logits = logits*args.softmax_temperature ## We have to undo the tempered logits else our entropy estimate will be wrong.
+                        if args.temperature_calibration: 
+                            logits = logits*mod_compute.softmax_temperature
+                        lprobs = torch.nn.functional.log_softmax(logits, dim=-1) ## No tempering here
+                        entropy = -(torch.exp(lprobs)*lprobs).mean()
+                        metrics.add("softmax entropy", entropy)
+                        if mod_compute.additional_lm_logits is not None:
+                            for additional_logits in mod_compute.additional_lm_logits: ## Compute entropy for each layer as well
+                                additional_logits = additional_logits*args.softmax_temperature ## We have to undo the tempered logits else our entropy estimate will be wrong.
+                                if args.temperature_calibration: 
+                                    additional_logits = additional_logits*mod_compute.softmax_temperature
+                                lprobs = torch.nn.functional.log_softmax(additional_logits, dim=-1) ## No tempering here
+                                entropy_extra = -(torch.exp(lprobs)*lprobs).mean()
+                                entropy += entropy_extra
                     loss = loss*(1-args.max_ent_weight) - entropy*args.max_ent_weight ## Maximize the entropy so a minus is needed. Weigh and add losses as required.
-                    if rank == 0:
-                        writer.add_scalar("loss with entropy loss", loss.detach().cpu().numpy(), ctr)
+                    metrics.add("loss with entropy loss", loss)
                 if args.distillation: ## Time to distill.
                     with torch.no_grad(): ## No gradient to avoid memory allocation.
-                        parent_mod_compute = parent_model(input_ids=input_ids, attention_mask=input_masks, decoder_input_ids=decoder_input_ids, output_hidden_states=args.distillation, output_attentions=args.distillation) ## Get the parent model's computations.
+                        parent_mod_compute = parent_model(input_ids=input_ids, attention_mask=input_masks, decoder_input_ids=decoder_input_ids, output_hidden_states=parent_output_hidden_states, output_attentions=parent_output_attentions, **segment_kwargs) ## Get the parent model's computations.
                     distillation_loss = compute_distillation_losses(mod_compute, parent_mod_compute, labels, tok.pad_token_id, args) ## Compute distillation losses.
                     loss = args.distillation_loss_weight*distillation_loss + (1.0 - args.distillation_loss_weight)*loss ## Update the main loss with weighing and adding.
-                    if rank == 0:
-                        writer.add_scalar("distillation loss", distillation_loss.detach().cpu().numpy(), ctr)
-                        writer.add_scalar("final loss", loss.detach().cpu().numpy(), ctr)
+                    metrics.add("distillation loss", distillation_loss)
+                    metrics.add("final loss", loss)
                 if args.use_moe or args.moe_adaptors: ## add MOE losses too.
                     moe_loss = torch.sum(torch.stack(mod_compute.encoder_moe_losses)) + torch.sum(torch.stack(mod_compute.decoder_moe_losses))
-                    if rank == 0:
-                        writer.add_scalar("moe loss", moe_loss.detach().cpu().numpy(), ctr)
+                    metrics.add("moe loss", moe_loss)
                     loss += moe_loss
                 if args.contrastive_decoder_training: ## Shuffle the decoder input and label batches and compute loss. This should be negated and added to the overall loss.
                     batch_size = decoder_input_ids.size()[0]
                     shuffle_indices = torch.randperm(batch_size)
                     decoder_input_ids = decoder_input_ids[shuffle_indices]
                     labels = labels[shuffle_indices]
-                    mod_compute = model(input_ids=input_ids, attention_mask=input_masks, decoder_input_ids=decoder_input_ids) ## Run the model and get logits.
-                    logits = mod_compute.logits
-                    lprobs = torch.nn.functional.log_softmax(logits, dim=-1)
-                    contrastive_loss = label_smoothed_nll_loss(
-                        lprobs, labels, args.label_smoothing, ignore_index=tok.pad_token_id
-                    ) ## Label smoothed cross entropy loss.
+                    mod_compute = model(input_ids=input_ids, attention_mask=input_masks, decoder_input_ids=decoder_input_ids, return_lm_hidden_states=args.chunked_loss) ## Run the model and get logits.
+                    contrastive_loss, _ = compute_lm_loss(model, mod_compute.lm_hidden_states if args.chunked_loss else mod_compute.logits, labels, tok.pad_token_id, args, compute_entropy=False) ## Label smoothed cross entropy loss.
                     loss -= contrastive_loss
 
         del input_ids ## Delete to avoid retention.
@@ -623,14 +624,14 @@ def model_create_load_run_save(gpu, args, files, train_files):
             del label_mask
         
         if ctr % 100 == 0 and rank  % 8 == 0:
-            fwd_memory = round(torch.cuda.memory_allocated(gpu)/(1024**3), 2)
+            fwd_memory = get_memory_allocated(gpu)
 
         ## Optimization part of the model from this point forward.
         if args.fp16: ## The gradient scaler needs to be invoked with FP16/AMP computation. ## With FP16/AMP computation we need to unscale gradients before clipping them. We then optimize and update the scaler.
             loss = loss/args.multistep_optimizer_steps
             scaler.scale(loss).backward()
             num_batches_this_optimizer_step += 1
-            losses += loss.detach().cpu().numpy()
+            losses += loss.detach() ## Stays on the device till it is printed.
             if num_batches_this_optimizer_step < args.multistep_optimizer_steps:
                 continue
             if args.max_gradient_clip_value != 0.0:
@@ -647,7 +648,7 @@ def model_create_load_run_save(gpu, args, files, train_files):
             loss = loss/args.multistep_optimizer_steps
             loss.backward()
             num_batches_this_optimizer_step += 1
-            losses += loss.detach().cpu().numpy()
+            losses += loss.detach() ## Stays on the device till it is printed.
             if num_batches_this_optimizer_step < args.multistep_optimizer_steps:
                 continue
             if args.max_gradient_clip_value != 0.0:
@@ -658,10 +659,11 @@ def model_create_load_run_save(gpu, args, files, train_files):
         losses = 0
         num_batches_this_optimizer_step = 0
         if ctr % 100 == 0 and rank  % 8 == 0: ## Print the current loss every 10 batches but only for the master/prime process.
-            bwd_memory=round(torch.cuda.memory_allocated(gpu)/(1024**3), 2)
+            bwd_memory=get_memory_allocated(gpu)
             end = time.time()
-            print(ctr, round(lv.item(),2), round(end-start, 2), "seconds for 100 batches. Memory used post forward / backward passes:", fwd_memory, "/", bwd_memory, "GB.")
+            print(ctr, round(lv.item(),2), round(end-start, 2), "seconds for 100 batches. Memory used post forward / backward passes:", fwd_memory, "/", bwd_memory, "GB.", round(data_wait_time, 2), "seconds were spent waiting for batches.")
             start = time.time()
+            data_wait_time = 0.0
             sys.stdout.flush()
 
         if ctr % 1000 == 0 and rank == 0 and args.save_weights_and_gradeint_info: ## Save the model weight and gradient info every time this condition is triggered.
@@ -670,13 +672,14 @@ def model_create_load_run_save(gpu, args, files, train_files):
                     writer.add_histogram("weights."+param_name, param_value.detach().cpu().numpy(), ctr)
                     writer.add_histogram("gradients."+param_name, param_value.grad.detach().cpu().numpy(), ctr)
         end = time.time()
+        if ctr % args.metrics_flush_every == 0:
+            metrics.flush(ctr)
         ctr += 1
     
+    batch_prefetcher.close()
     if rank == 0:
-        checkpoint_dict = {'model': model.state_dict(), 'optimizer': optimizer.state_dict(), 'scheduler': scheduler.state_dict(), 'ctr': ctr}
-        torch.save(checkpoint_dict, CHECKPOINT_PATH) ## Save one last time.
-        torch.save(model.module.state_dict(), CHECKPOINT_PATH+".pure_model") ## We will distribute this model and/or use it for fine tuning.
-        os.system("cp "+CHECKPOINT_PATH+".pure_model "+CHECKPOINT_PATH+"_deploy/pytorch_model.bin") ## Copy the model to the deploy directory.
+        checkpoint_writer.save(model, optimizer, scheduler, ctr, CHECKPOINT_PATH, deploy_path=CHECKPOINT_PATH+"_deploy/pytorch_model.bin") ## Save one last time. We will distribute the pure model and/or use it for fine tuning so it also goes to the deploy directory.
+        checkpoint_writer.wait()
     dist.barrier() ## Wait till all processes reach this point so that the prime process saves the final checkpoint.
     dist.destroy_process_group()
 
@@ -841,6 +844,56 @@ def run_demo():
                         help='Should we do gradient checkpointing during training? If yes, then the encoder and decoder layer activations will be recomputed during backprop.')
     parser.add_argument('--shard_files', action='store_true', 
                         help='Should we shard the training data? Set to true only if the data is not already pre-sharded.')
+    parser.add_argument('--tokenize_once', action='store_true', 
+                        help='Should we tokenize each training sentence exactly once? Truncation, masking, language indicator tokens, shifting and padding are then done on token ids instead of re-tokenizing (and decoding) the text several times per sentence. Sentences are truncated and masked at the word level using the subword word boundary markers, which gives the same words as splitting on spaces except for lines with tabs, non breaking spaces, runs of spaces or zero width joiners. check_tokenize_once.py and tests/test_tokenize_once.py compare the batches with the text based ones. Same restrictions as --use_binarized_corpora which is what you should use if you want to tokenize only once for the whole training.')
+    parser.add_argument('--virtual_sharding', action='store_true', 
+                        help='Should we avoid writing physical shards? If set then --shard_files only builds a byte offset line index next to each training file and each process reads its own range of lines directly from the original file. Saves disk space and sharding time for huge corpora. With --use_binarized_corpora, binarize the whole files without --num_shards and each process uses its own range of the offsets.')
+    parser.add_argument('--num_data_workers', default=0, type=int, 
+                        help='How many background processes per GPU should create batches? Each worker runs its own copy of the batch generator with a different seed and creates its share of the batches. If 0 then batches are created in the main process between optimizer steps. Look at the "data wait time" in tensorboard to decide if you need more workers.')
+    parser.add_argument('--data_queue_depth', default=8, type=int, 
+                        help='How many ready batches can be queued up by the background workers? Higher values smooth out slow batches but cost CPU memory.')
+    parser.add_argument('--bucketed_batching', action='store_true', 
+                        help='Should we batch with length buckets? A pool of examples is grouped into buckets of similar source and target lengths, each bucket is cut into batches which fill the batch size (or token budget) and the batches of the pool are shuffled. This greatly reduces padding compared to batching examples in the order in which they are sampled. Works only with --tokenize_once or --use_binarized_corpora because exact token lengths are needed. Look at the "padding efficiency" in tensorboard to tune it.')
+    parser.add_argument('--bucket_width', default=8, type=int, 
+                        help='How many tokens wide should each length bucket be? Smaller values mean less padding but more leftover examples waiting in half filled buckets.')
+    parser.add_argument('--bucketing_pool_size', default=100000, type=int, 
+                        help='How many examples should be pooled before they are bucketed and batched? Larger pools give fuller buckets and less padding but cost CPU memory.')
+    parser.add_argument('--pack_examples', action='store_true', 
+                        help='Should we pack several short examples into one row of the batch? Consecutive examples are concatenated until --pack_length tokens are reached on the source or target side. The model then uses block diagonal attention masks and restarts the positions for every packed example so that the examples do not attend to each other. For corpora of short sentences this greatly increases the number of useful tokens per batch. Works only with --tokenize_once or --use_binarized_corpora and MBart models. Incompatible with domain classifiers, encoder unification and contrastive decoder training.')
+    parser.add_argument('--pack_length', default=256, type=int, 
+                        help='What is the maximum number of tokens in a row of packed examples? Should not be more than the maximum number of positions of the model.')
+    parser.add_argument('--language_homogeneous_batches', action='store_true', 
+                        help='Should the batches contain sentences from a single language (pair)? Each sampled language is used for --language_run_length consecutive sentences so that a batch uses one set of language indicator tokens and has a similar length distribution. With --bucketed_batching every batch has exactly one language. Otherwise a batch may span the boundary between two runs. The overall language sampling ratios do not change.')
+    parser.add_argument('--language_run_length', default=256, type=int, 
+                        help='How many consecutive sentences should be drawn from a language before sampling a new one when using --language_homogeneous_batches? This should be at least the number of sentences in a batch.')
+    parser.add_argument('--checkpoint_sync_mode', default='reload', type=str, choices=['reload', 'none', 'checksum'], 
+                        help='How should the processes be synchronized after the prime process saves a checkpoint every save_every steps? "reload" makes every process load the saved checkpoint (the old behavior). "none" skips this since DDP already keeps the model replicas identical. "checksum" broadcasts a cheap per parameter checksum from the prime process and reloads the checkpoint only if some process has diverged. The last two avoid reading the (large) checkpoint from every process which can stall training for minutes on shared file systems.')
+    parser.add_argument('--async_checkpointing', action='store_true', 
+                        help='Should checkpoints be written to disk in a background thread? The model, optimizer and scheduler states are copied to the CPU once and training continues while they are written. The pure model, the best/intermediate checkpoints and the deploy model are derived from the same copy and the extra copies are hardlinks. When --checkpoint_sync_mode is reload, the other processes still have to wait for the checkpoint to be written so use this with none or checksum.')
+    parser.add_argument('--chunked_loss', action='store_true', 
+                        help='Should the label smoothed cross entropy loss be computed a chunk of target tokens at a time? The model returns the decoder outputs instead of the logits and the LM head projection, the loss and (if needed) the softmax entropy are computed chunk by chunk with a custom backward pass. The [batch, target length, vocabulary] logits are never materialized which saves a lot of memory for large vocabularies and allows for larger batches. Applies to multilayer softmaxing and entropy maximization as well. Works only with MBart models. Incompatible with temperature calibration and distillation.')
+    parser.add_argument('--loss_chunk_size', default=1024, type=int, 
+                        help='The number of target tokens whose logits are computed at a time when using --chunked_loss. The peak memory for the logits is this times the vocabulary size.')
+    parser.add_argument('--frozen_parent', action='store_true', 
+                        help='Should the parent model for distillation be an inference only teacher? It is not wrapped in DDP, its parameters are frozen and it is run in eval mode so that dropout is disabled. This saves the memory and time of the parent a lot. Look at --frozen_parent_dropout and --parent_precision for more options.')
+    parser.add_argument('--frozen_parent_dropout', action='store_true', 
+                        help='Should the frozen parent model be kept in train mode so that it uses dropout like the default parent?')
+    parser.add_argument('--parent_precision', default='fp32', type=str, choices=["fp32", "fp16", "int8"], 
+                        help='The precision of the frozen parent model weights. fp16 casts the parent to half precision. int8 stores the weights of the linear layers (except for the LM head) as int8 with a scale per output feature and dequantizes them on the fly which saves memory but not time. Only used with --frozen_parent.')
+    parser.add_argument('--distillation_topk', default=0, type=int, 
+                        help='If more than 0 then the cross entropy distillation loss only matches the parent distribution over its top-k tokens at each position, renormalized, instead of the whole vocabulary. The child log probabilities are only gathered for these tokens.')
+    parser.add_argument('--ewc_fisher_cache_dir', default='', type=str, 
+                        help='The directory in which the Fisher coefficients for elastic weight consolidation should be cached. The coefficients are saved under a hash of the initial model parameters and of the data and flags used to compute them, and are loaded instead of being recomputed whenever a later run starts from the same checkpoint with the same setup.')
+    parser.add_argument('--metrics_flush_every', default=100, type=int, 
+                        help='The training losses are summed on the GPU and their averages are written to tensorboard every these many steps. Bringing a loss to the CPU makes us wait for the GPU so doing it for every loss at every step slows down training. Use 1 to log the losses of every step.')
+    parser.add_argument('--reduce_metrics_across_ranks', action='store_true', 
+                        help='Should the logged training losses be averaged over all the processes instead of being those of the first process?')
+    parser.add_argument('--device', default='gpu', type=str, choices=["gpu", "cpu"], 
+                        help='Should we run on GPUs or on CPUs? With cpu, --gpus is the number of processes per node, the processes communicate with the gloo backend and the cores of the node are split among them.')
+    parser.add_argument('--num_threads_per_process', default=0, type=int, 
+                        help='The number of threads each process uses with --device cpu. 0 means the number of cores divided by the number of processes per node.')
+    parser.add_argument('--use_binarized_corpora', action='store_true', 
+                        help='Should we read the training data from memory mapped token id arrays created by binarize_corpus.py instead of tokenizing raw text on the fly? The binarized shards must exist for all training files (use the --num_shards argument of binarize_corpus.py) so dont pass --shard_files. Sentences are truncated and masked at the word level using the subword word boundary markers. Incompatible with stochastic tokenization, span prediction, document level denoising, multi source and cross distillation.')
     parser.add_argument('--multilayer_softmaxing', default=None, 
                         help='Should we apply a softmax for each decoder layer? Unsupported for distillation. Only for vanilla training. You have to specify a comma separated list of indices of the intermediate layers which you want to softmax. These go from 0 for the embedding layer to L-2 for the penultimate layer.')
     parser.add_argument('--remap_encoder', default='', type=str, 
@@ -940,6 +993,8 @@ def run_demo():
     ###
     args = parser.parse_args()
     assert len(args.token_masking_probs_range) <= 2
+    assert not (args.device == "cpu" and args.fp16), "Mixed precision training needs a GPU."
+    assert not args.bucketed_batching or args.tokenize_once or args.use_binarized_corpora, "Bucketed batching needs exact token lengths. Use it with --tokenize_once or --use_binarized_corpora."
     print("IP address is", args.ipaddr)
 
     args.world_size = args.gpus * args.nodes                #
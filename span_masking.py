@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021 National Institute of Information and Communication Technology (Raj Dabre)
+# 
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the
+# Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute,
+# sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+# The above copyright notice and this permission notice shall
+# be included in all copies or substantial portions of the
+# Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY
+# KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+# WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+# PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS
+# OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+## Poisson span masking shared by the batch generators in common_utils.py and the demo interface. It only depends on numpy so that the interface does not need the training dependencies.
+
+## Other imports
+import numpy as np
+##
+
+def sample_span_masks(sent_lens, mask_percents, args, protected=None):
+    """Vectorized poisson span masking for a whole batch of sentences. It keeps the semantics of the old one sentence at a time masking loop: span lengths are drawn in order and a span which is longer than the remaining masking budget (mask percent times sentence length) is skipped and not clipped, spans are accepted until the budget is used up and every span gets its own mask token even if it ends up next to another span. The only difference is the placement. The old loop dropped a span which overlapped an already masked one and moved on to the next draw, which favours short spans in heavily masked sentences. Here the spans are placed by randomly distributing the unmasked words into the gaps between them, so nothing is dropped. The same number of words is masked but there are slightly fewer mask tokens (about 4 percent fewer at a masking ratio of 0.3 and 8 percent fewer at 0.5). With future prediction only the second half of each sentence is masked. Positions marked in the optional protected array (like document level sentence delimiters) are never masked. The old loop re-drew spans which covered a delimiter whereas here the words on both sides of the delimiter are masked and each side gets its own mask token, so documents get slightly more mask tokens and fewer masked words. Returns a boolean array of shape (batch, max_len) marking the masked words and an integer array of shape (batch, max_len+1) with the number of mask tokens to be placed before each position. A span of length 0 inserts a mask token."""
+    sent_lens = np.asarray(sent_lens, dtype=np.int64)
+    batch_size = len(sent_lens)
+    max_len = int(sent_lens.max()) if batch_size > 0 else 0
+    region_starts = sent_lens//2 if args.future_prediction else np.zeros_like(sent_lens)
+    region_lens = sent_lens - region_starts
+    budgets = np.minimum((np.asarray(mask_percents, dtype=np.float64)*sent_lens).astype(np.int64), region_lens) ## Cant mask more than the allowable number of tokens.
+    chunk_size = 2*int(budgets.max(initial=0)) + 8
+    span_chunks, accepted_chunks = [], []
+    used_budgets = np.zeros(batch_size, dtype=np.int64)
+    while (used_budgets < budgets).any() and len(span_chunks)*chunk_size < 1000: ## Like the old loop we give up after 1000 spans and continue with what we have so far.
+        spans = np.random.poisson(args.token_masking_lambda, (batch_size, chunk_size))
+        accepted = np.zeros((batch_size, chunk_size), dtype=bool)
+        for draw in range(chunk_size): ## Skipping depends on the spans accepted so far so we go over the draws in order but over the whole batch at once.
+            accepted[:, draw] = (used_budgets < budgets) & (spans[:, draw] <= budgets - used_budgets)
+            used_budgets += np.where(accepted[:, draw], spans[:, draw], 0)
+        span_chunks.append(spans)
+        accepted_chunks.append(accepted)
+    if len(span_chunks) == 0:
+        return np.zeros((batch_size, max_len), dtype=bool), np.zeros((batch_size, max_len+1), dtype=np.int64)
+    accepted = np.concatenate(accepted_chunks, axis=1)
+    span_lens = np.where(accepted, np.concatenate(span_chunks, axis=1), 0)
+    num_draws = span_lens.shape[1]
+    unmasked_lens = region_lens - used_budgets
+    gaps = np.floor(np.random.random_sample((batch_size, num_draws))*(unmasked_lens[:, None]+1)).astype(np.int64) ## Cumulative number of unmasked words before each span.
+    gaps = np.where(accepted, gaps, unmasked_lens[:, None])
+    order = np.argsort(~accepted, axis=1, kind="stable") ## The accepted spans keep their order and come first.
+    span_lens = np.take_along_axis(span_lens, order, axis=1)
+    accepted = np.take_along_axis(accepted, order, axis=1)
+    gaps.sort(axis=1)
+    span_starts = region_starts[:, None] + gaps + np.cumsum(span_lens, axis=1) - span_lens
+    rows, cols = np.nonzero(accepted)
+    starts = span_starts[rows, cols]
+    lens = span_lens[rows, cols]
+    coverage = np.zeros((batch_size, max_len+1), dtype=np.int64)
+    np.add.at(coverage, (rows, starts), 1)
+    np.add.at(coverage, (rows, starts+lens), -1)
+    covered = np.cumsum(coverage, axis=1)[:, :max_len] > 0
+    masked = covered & ~protected if protected is not None else covered
+    is_insertion = lens == 0
+    insertions = np.zeros((batch_size, max_len+1), dtype=np.int64)
+    np.add.at(insertions, (rows[is_insertion], starts[is_insertion]), 1)
+    span_start_counts = np.zeros((batch_size, max_len+1), dtype=np.int64)
+    np.add.at(span_start_counts, (rows[~is_insertion], starts[~is_insertion]), 1)
+    insertions[:, :max_len] += np.where(masked, span_start_counts[:, :max_len], 0) ## One mask token per span even if it is next to another one.
+    if protected is not None: ## A span continues after a delimiter which it covers.
+        insertions[:, 1:max_len] += masked[:, 1:] & protected[:, :-1] & covered[:, :-1] & (span_start_counts[:, 1:max_len] == 0)
+    return masked, insertions
+
+def mask_spans_in_batch(word_lists, mask_percents, mask_token, args, protected_word=None):
+    """Masks a batch of sentences given as lists of words (strings or arrays of token ids) with sample_span_masks. Words equal to the protected word are never masked. Returns the masked lists of words where each masked span is replaced by the mask token."""
+    sent_lens = [len(words) for words in word_lists]
+    protected = None
+    if protected_word is not None:
+        protected = np.zeros((len(word_lists), max(sent_lens, default=0)), dtype=bool)
+        for idx, words in enumerate(word_lists):
+            protected[idx, :len(words)] = [word == protected_word for word in words]
+    masked, insertions = sample_span_masks(sent_lens, mask_percents, args, protected)
+    masked_word_lists = []
+    for idx, words in enumerate(word_lists):
+        sentence_masked = masked[idx].tolist()
+        sentence_insertions = insertions[idx].tolist()
+        masked_words = []
+        for position, word in enumerate(words):
+            if sentence_insertions[position] > 0:
+                masked_words.extend([mask_token]*sentence_insertions[position])
+            if not sentence_masked[position]:
+                masked_words.append(word)
+        masked_words.extend([mask_token]*sentence_insertions[len(words)])
+        masked_word_lists.append(masked_words)
+    return masked_word_lists
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021 National Institute of Information and Communication Technology (Raj Dabre)
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the
+# Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute,
+# sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+# The above copyright notice and this permission notice shall
+# be included in all copies or substantial portions of the
+# Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY
+# KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+# WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+# PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS
+# OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+## Checks the chunked label smoothed cross entropy and its custom backward pass against a numpy reference. Run with: python -m pytest tests
+
+## Basic imports
+import argparse
+import os
+import sys
+##
+
+## Other imports
+import numpy as np
+import pytest
+##
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+## Our imports
+from common_utils import chunked_label_smoothed_nll_loss, compute_lm_loss, label_smoothed_nll_loss
+##
+
+PAD = 0
+
+def reference_loss(hidden_states, weight, bias, target, epsilon, softmax_temperature, entropy_weight):
+    """Numpy version of log_softmax + label_smoothed_nll_loss with an ignore index plus entropy_weight times the mean softmax entropy of the untempered logits over all the positions (as in the training scripts). Returns the loss and the entropy."""
+    raw_logits = hidden_states.reshape(-1, hidden_states.shape[-1]).dot(weight.T) + bias
+    target = target.reshape(-1)
+    vocab_size = weight.shape[0]
+    logits = raw_logits/softmax_temperature
+    lprobs = logits - np.log(np.exp(logits - logits.max(axis=-1, keepdims=True)).sum(axis=-1, keepdims=True)) - logits.max(axis=-1, keepdims=True)
+    not_pad = target != PAD
+    nll_loss = -lprobs[np.arange(len(target)), target][not_pad].sum()
+    smooth_loss = -lprobs.sum(axis=-1)[not_pad].sum()
+    loss = ((1.0 - epsilon)*nll_loss + (epsilon/vocab_size)*smooth_loss)/not_pad.sum()
+    raw_lprobs = raw_logits - np.log(np.exp(raw_logits - raw_logits.max(axis=-1, keepdims=True)).sum(axis=-1, keepdims=True)) - raw_logits.max(axis=-1, keepdims=True)
+    entropy = -(np.exp(raw_lprobs)*raw_lprobs).mean()
+    return loss - entropy_weight*entropy, entropy
+
+def make_inputs(seed, batch_size=3, target_length=7, hidden_size=5, vocab_size=11):
+    rng = np.random.RandomState(seed)
+    hidden_states = rng.randn(batch_size, target_length, hidden_size)
+    weight = rng.randn(vocab_size, hidden_size)*0.7
+    bias = rng.randn(1, vocab_size)*0.3
+    target = rng.randint(1, vocab_size, (batch_size, target_length))
+    target[0, -3:] = PAD ## Padded target positions.
+    target[1, -1] = PAD
+    return hidden_states, weight, bias, target
+
+def chunked_loss(hidden_states, weight, bias, target, epsilon, softmax_temperature, chunk_size, entropy_weight):
+    loss, entropy = chunked_label_smoothed_nll_loss(hidden_states, weight, bias, target, epsilon, PAD, softmax_temperature, chunk_size, compute_entropy=entropy_weight != 0)
+    return loss - entropy_weight*entropy, entropy
+
+def finite_difference_gradient(function, array, step=1e-6):
+    gradient = np.zeros_like(array)
+    for idx in np.ndindex(*array.shape):
+        original = array[idx]
+        array[idx] = original + step
+        plus = function()
+        array[idx] = original - step
+        minus = function()
+        array[idx] = original
+        gradient[idx] = (plus - minus)/(2*step)
+    return gradient
+
+@pytest.mark.parametrize("chunk_size", [1, 4, 7, 100])
+@pytest.mark.parametrize("epsilon,softmax_temperature,entropy_weight", [(0.0, 1.0, 0.0), (0.1, 1.0, 0.3), (0.1, 2.0, 0.3)])
+def test_forward_matches_reference(chunk_size, epsilon, softmax_temperature, entropy_weight):
+    hidden_states, weight, bias, target = make_inputs(1)
+    expected_loss, expected_entropy = reference_loss(hidden_states, weight, bias, target, epsilon, softmax_temperature, entropy_weight)
+    loss, entropy = chunked_loss(torch.from_numpy(hidden_states), torch.from_numpy(weight), torch.from_numpy(bias), torch.from_numpy(target), epsilon, softmax_temperature, chunk_size, entropy_weight)
+    assert loss.item() == pytest.approx(expected_loss, rel=1e-6) ## The loss is accumulated in float32.
+    if entropy_weight != 0:
+        assert entropy.item() == pytest.approx(expected_entropy, rel=1e-6) ## The loss is accumulated in float32.
+
+@pytest.mark.parametrize("chunk_size", [1, 4, 100])
+@pytest.mark.parametrize("epsilon,softmax_temperature,entropy_weight", [(0.0, 1.0, 0.0), (0.1, 1.0, 0.3), (0.1, 2.0, 0.3)])
+def test_backward_matches_finite_differences(chunk_size, epsilon, softmax_temperature, entropy_weight):
+    hidden_states, weight, bias, target = make_inputs(2)
+    inputs = [torch.from_numpy(array.copy()).requires_grad_() for array in (hidden_states, weight, bias)]
+    loss, _ = chunked_loss(*inputs, torch.from_numpy(target), epsilon, softmax_temperature, chunk_size, entropy_weight)
+    loss.backward()
+    for array, tensor in zip((hidden_states, weight, bias), inputs):
+        expected_gradient = finite_difference_gradient(lambda: reference_loss(hidden_states, weight, bias, target, epsilon, softmax_temperature, entropy_weight)[0], array)
+        np.testing.assert_allclose(tensor.grad.numpy(), expected_gradient, rtol=1e-5, atol=1e-8)
+
+def test_compute_lm_loss_matches_unchunked_loss():
+    hidden_states, weight, bias, target = [torch.from_numpy(array) for array in make_inputs(3)]
+    lm_head = torch.nn.Linear(weight.size(1), weight.size(0), bias=False).double()
+    lm_head.weight.data.copy_(weight)
+    model = argparse.Namespace(module=argparse.Namespace(lm_head=lm_head, final_logits_bias=bias)) ## Stands in for the DDP wrapped model.
+    args = argparse.Namespace(chunked_loss=True, label_smoothing=0.1, softmax_temperature=1.0, loss_chunk_size=4, max_ent_weight=-1)
+    chunked, entropy = compute_lm_loss(model, hidden_states, target, PAD, args)
+    args.chunked_loss = False
+    unchunked, no_entropy = compute_lm_loss(model, lm_head(hidden_states) + bias, target, PAD, args)
+    assert entropy.item() == 0 and no_entropy is None
+    assert chunked.item() == pytest.approx(unchunked.item(), rel=1e-6) ## The loss is accumulated in float32.
+    assert unchunked.item() == pytest.approx(label_smoothed_nll_loss(torch.log_softmax(lm_head(hidden_states) + bias, dim=-1), target, 0.1, ignore_index=PAD).item(), rel=1e-12)
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021 National Institute of Information and Communication Technology (Raj Dabre)
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the
+# Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute,
+# sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+# The above copyright notice and this permission notice shall
+# be included in all copies or substantial portions of the
+# Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY
+# KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+# WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+# PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS
+# OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+## Checks the mask ratio and the mask tokens of the vectorized span masking against the old one sentence at a time loop. Run with: python -m pytest tests
+
+## Basic imports
+import argparse
+import os
+import random
+import sys
+##
+
+## Other imports
+import numpy as np
+import pytest
+##
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+## Our imports
+from span_masking import sample_span_masks, mask_spans_in_batch
+##
+
+MASK = "[MASK]"
+DELIMITER = "</s>"
+
+def get_args(future_prediction=False):
+    return argparse.Namespace(token_masking_lambda=3.5, future_prediction=future_prediction)
+
+def mask_spans_old(sentence_split, mask_percent, args):
+    """The masking loop which the batch generators used before sample_span_masks. Returns the number of masked words and the number of mask tokens."""
+    sentence_split = list(sentence_split)
+    sent_len = len(sentence_split)
+    mask_count = 0
+    max_mask_count = int(mask_percent*sent_len)
+    spans_to_mask = list(np.random.poisson(args.token_masking_lambda, 1000))
+    curr_sent_len = sent_len
+    while mask_count < max_mask_count:
+        try:
+            span_to_mask = spans_to_mask[0]
+            del spans_to_mask[0]
+            if span_to_mask > (max_mask_count-mask_count):
+                continue
+            idx_to_mask = random.randint(sent_len//2 if args.future_prediction else 0, (curr_sent_len-1)-(span_to_mask-1))
+            if MASK not in sentence_split[idx_to_mask:idx_to_mask+span_to_mask] and DELIMITER not in sentence_split[idx_to_mask:idx_to_mask+span_to_mask]:
+                actually_masked_length = len(sentence_split[idx_to_mask:idx_to_mask+span_to_mask])
+                sentence_split[idx_to_mask:idx_to_mask+span_to_mask] = [MASK]
+                mask_count += actually_masked_length
+                curr_sent_len -= (actually_masked_length-1)
+        except:
+            break
+    return mask_count, sentence_split.count(MASK)
+
+def make_sentences(num_sentences, seed):
+    rng = np.random.RandomState(seed)
+    return [["w%d" % idx for idx in range(length)] for length in rng.randint(1, 60, num_sentences)]
+
+@pytest.mark.parametrize("mask_percent", [0.15, 0.3, 0.35, 0.5])
+def test_masks_exactly_the_budget(mask_percent):
+    np.random.seed(1)
+    sentences = make_sentences(500, 2)
+    sent_lens = np.array([len(sentence) for sentence in sentences])
+    masked, insertions = sample_span_masks(sent_lens, [mask_percent]*len(sentences), get_args())
+    assert (masked.sum(axis=1) == (mask_percent*sent_lens).astype(np.int64)).all()
+    for idx, sent_len in enumerate(sent_lens):
+        assert not masked[idx, sent_len:].any()
+        assert insertions[idx, sent_len+1:].sum() == 0
+
+def test_future_prediction_masks_the_second_half():
+    np.random.seed(3)
+    sent_lens = np.array([len(sentence) for sentence in make_sentences(500, 4)])
+    masked, _ = sample_span_masks(sent_lens, [0.35]*len(sent_lens), get_args(future_prediction=True))
+    for idx, sent_len in enumerate(sent_lens):
+        assert not masked[idx, :sent_len//2].any()
+    assert (masked.sum(axis=1) == np.minimum((0.35*sent_lens).astype(np.int64), sent_lens - sent_lens//2)).all()
+
+@pytest.mark.parametrize("mask_percent", [0.3, 0.5])
+def test_mask_ratio_and_mask_tokens_match_old_loop(mask_percent):
+    """The same number of words is masked as with the old loop. The old loop dropped spans which overlapped already masked words, which favours short spans, so it gives a few percent more mask tokens (one per span, including spans of length 0)."""
+    args = get_args()
+    sentences = make_sentences(3000, 5)
+    np.random.seed(6)
+    random.seed(6)
+    old_results = np.array([mask_spans_old(sentence, mask_percent, args) for sentence in sentences])
+    np.random.seed(7)
+    new_sentences = mask_spans_in_batch(sentences, [mask_percent]*len(sentences), MASK, args)
+    new_mask_tokens = np.array([sentence.count(MASK) for sentence in new_sentences])
+    new_masked_words = np.array([len(sentence) - len(new_sentence) + new_sentence.count(MASK) for sentence, new_sentence in zip(sentences, new_sentences)])
+    assert (new_masked_words == old_results[:, 0]).all()
+    assert new_mask_tokens.mean() <= old_results[:, 1].mean()
+    assert new_mask_tokens.mean() == pytest.approx(old_results[:, 1].mean(), rel=0.1)
+
+def test_unmasked_words_keep_their_order():
+    np.random.seed(8)
+    sentences = make_sentences(200, 9)
+    for sentence, new_sentence in zip(sentences, mask_spans_in_batch(sentences, [0.35]*len(sentences), MASK, get_args())):
+        kept = [word for word in new_sentence if word != MASK]
+        assert kept == [word for word in sentence if word in set(kept)]
+
+def test_delimiters_are_never_masked():
+    np.random.seed(10)
+    documents = [sum([["s%dw%d" % (sent_idx, idx) for idx in range(8)]+[DELIMITER] for sent_idx in range(5)], [])[:-1] for _ in range(300)]
+    new_documents = mask_spans_in_batch(documents, [0.4]*len(documents), MASK, get_args(), protected_word=DELIMITER)
+    for document, new_document in zip(documents, new_documents):
+        assert new_document.count(DELIMITER) == document.count(DELIMITER)
+        masked_words = len(document) - len(new_document) + new_document.count(MASK)
+        assert masked_words <= int(0.4*len(document))
+        for sent_idx, segment in enumerate(" ".join(new_document).split(DELIMITER)):
+            assert all(word.startswith("s%dw" % sent_idx) for word in segment.split() if word != MASK) ## The delimiters stay between the words of their sentences.
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021 National Institute of Information and Communication Technology (Raj Dabre)
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the
+# Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute,
+# sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+# The above copyright notice and this permission notice shall
+# be included in all copies or substantial portions of the
+# Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY
+# KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+# WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+# PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS
+# OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+## Compares the --tokenize_once batches with the text based ones on the example data. Run with: python -m pytest tests
+
+## Basic imports
+import os
+import sys
+import unicodedata
+##
+
+## Other imports
+import numpy as np
+import pytest
+##
+
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+## Our imports
+from common_utils import get_word_start_flags, split_words_from_ids
+from binarize_corpus import load_tokenizer
+import check_tokenize_once
+##
+
+DATA_DIR = os.path.join(REPO_DIR, "examples", "data")
+TOKENIZER = os.path.join(REPO_DIR, "examples", "tokenizers", "albert-vienhi16k")
+LANGUAGES = ["en", "hi", "vi"]
+
+def read_dev_lines(lang):
+    with open(os.path.join(DATA_DIR, "dev."+lang)) as infile:
+        return [line.strip() for line in infile]
+
+def has_only_single_spaces(line):
+    """Lines with other whitespace or invisible formatting characters are split into words differently by the tokenizer. See split_words_from_ids."""
+    return " ".join(line.split()) == line and not any(unicodedata.category(char) == "Cf" for char in line)
+
+def write_lines(path, lines):
+    with open(path, "w") as outfile:
+        for line in lines:
+            outfile.write(line+"\n")
+
+def get_args(argv):
+    return check_tokenize_once.get_parser().parse_args(["--tokenizer_name_or_path", TOKENIZER]+argv)
+
+@pytest.fixture(scope="module")
+def tok():
+    args = get_args([])
+    args.use_official_pretrained_tokenizer = False
+    return load_tokenizer(args)
+
+@pytest.mark.parametrize("lang", LANGUAGES)
+def test_word_splits_match_space_splits(tok, lang):
+    """The words of the id path are the space separated words of the text path except for lines with other whitespace, which the tokenizer normalizes."""
+    word_starts = get_word_start_flags(tok)
+    for line in read_dev_lines(lang):
+        ids = tok(line, add_special_tokens=False).input_ids
+        words = split_words_from_ids(np.array(ids, dtype=np.int64), word_starts)
+        if has_only_single_spaces(line):
+            assert len(words) == len(line.split(" ")), line
+            assert [tok.decode(word.tolist()).strip() for word in words] == [tok.decode(tok(word, add_special_tokens=False).input_ids).strip() for word in line.split(" ")], line
+        else:
+            assert len(words) >= len(line.split()), line
+
+@pytest.mark.parametrize("lang", LANGUAGES)
+def test_monolingual_batches_match(tmp_path, lang):
+    src = str(tmp_path / ("dev."+lang))
+    write_lines(src, [line for line in read_dev_lines(lang) if has_only_single_spaces(line)])
+    args = get_args(["--mono", "--src", src, "--slang", lang, "--num_batches", "20", "--max_length", "20"])
+    assert check_tokenize_once.count_batch_mismatches(args) == 0
+
+def test_bilingual_batches_match(tmp_path):
+    src_lines, tgt_lines = read_dev_lines("en"), read_dev_lines("hi")
+    pairs = [(src_line, tgt_line) for src_line, tgt_line in zip(src_lines, tgt_lines) if has_only_single_spaces(src_line) and has_only_single_spaces(tgt_line)]
+    src, tgt = str(tmp_path / "dev.en"), str(tmp_path / "dev.hi")
+    write_lines(src, [src_line for src_line, _ in pairs])
+    write_lines(tgt, [tgt_line for _, tgt_line in pairs])
+    args = get_args(["--src", src, "--tgt", tgt, "--slang", "en", "--tlang", "hi", "--num_batches", "20", "--max_src_length", "20", "--max_tgt_length", "20"])
+    assert check_tokenize_once.count_batch_mismatches(args) == 0
@@ -73,12 +73,108 @@ import pdb
 torch.manual_seed(621311)
 ##
 
+def decode_dev_set(model, tok, args, dev_batches, inverse_permutation, tlang, gpu):
+    """Greedily decodes the cached length sorted batches of a dev set and returns the hypotheses in the original order of the sentences."""
+    hyps = []
+    for dev_input_ids, dev_input_masks in dev_batches:
+        if args.multi_source:
+            dev_input_ids_parent = dev_input_ids[1]
+            dev_input_ids = dev_input_ids[0]
+            dev_input_masks_parent = dev_input_masks[1]
+            dev_input_masks = dev_input_masks[0]
+            dev_input_ids_parent = dev_input_ids_parent.to(gpu) ## Move to GPU.
+            dev_input_masks_parent = dev_input_masks_parent.to(gpu) ## Move to GPU.
+
+        if args.prompt_tuning:
+            dev_input_shape = dev_input_masks.size()
+            encoder_pad = torch.ones(dev_input_shape[0], args.num_prompts).clone().detach()
+            dev_input_masks = torch.cat([encoder_pad, dev_input_masks], dim=1)
+        start = time.time()
+        dev_input_ids = dev_input_ids.to(gpu) ## Move to GPU.
+        dev_input_masks = dev_input_masks.to(gpu) ## Move to GPU.
+        if args.is_summarization: ## Things can be slow so best show progress
+            print("Decoding batch from a pool of", len(inverse_permutation), "examples")
+        with torch.no_grad(): ## torch.no_grad is apparently known to prevent the code from allocating memory for gradient computation in addition to making things faster. I have not verified this but have kept it as a safety measure to ensure that my model is not being directly tuned on the development set.
+            translations = model.module.generate(dev_input_ids, use_cache=True, num_beams=1, max_length=int((len(dev_input_ids[0])*args.max_decode_length_multiplier) if args.max_decode_length_multiplier > 0 else -args.max_decode_length_multiplier), min_length=int((len(dev_input_ids[0])*args.min_decode_length_multiplier) if args.min_decode_length_multiplier > 0 else -args.min_decode_length_multiplier), early_stopping=True, attention_mask=dev_input_masks, pad_token_id=tok.pad_token_id, eos_token_id=tok(["</s>"], add_special_tokens=False).input_ids[0][0], decoder_start_token_id=tok([tlang if args.use_official_pretrained else "<2"+tlang+">"], add_special_tokens=False).input_ids[0][0], bos_token_id=tok(["<s>"], add_special_tokens=False).input_ids[0][0], length_penalty=args.length_penalty, repetition_penalty=args.repetition_penalty, encoder_no_repeat_ngram_size=args.encoder_no_repeat_ngram_size, no_repeat_ngram_size=args.no_repeat_ngram_size, additional_input_ids=dev_input_ids_parent if args.multi_source else None, additional_input_ids_mask=dev_input_masks_parent if args.multi_source else None) ## We translate the batch. 
+        del dev_input_ids ## Delete to avoid retention.
+        del dev_input_masks ## Delete to avoid retention.
+        translations = translations.to('cpu') ## Delete to avoid retention.
+        if args.multi_source:
+            del dev_input_ids_parent ## Delete to avoid retention.
+            del dev_input_masks_parent ## Delete to avoid retention.
+        for translation in translations:
+            translation  = tok.decode(translation, skip_special_tokens=args.no_skip_special_tokens, clean_up_tokenization_spaces=False) ### Get the raw sentences.
+            hyps.append(translation)
+        del translations ## Delete to avoid retention.
+    return [hyps[idx] for idx in inverse_permutation]
+
+def build_dev_batch_cache(tok, args, inps, dev_files, rank):
+    """Tokenizes and batches the dev sets once so that every evaluation reuses the same length sorted batches. With distributed evaluation, every process only keeps the batches of a contiguous part of each dev set."""
+    dev_batch_cache = []
+    for dev_idx, [dev_pair, dev_pair_info] in enumerate(dev_files):
+        slangtlang =dev_pair.strip().split("-")
+        slang = slangtlang[0]+"-"+slangtlang[1] if args.multi_source else slangtlang[0] ## This will be split in the generate_batches_eval function as we expect a triplet. 
+        dev_lines = inps[dev_idx][1]
+        if args.distributed_eval:
+            start, end = get_shard_line_range(len(dev_lines), rank, args.world_size)
+            dev_lines = dev_lines[start:end]
+        dev_batches, inverse_permutation = build_sorted_eval_batches(tok, args, dev_lines, slang)
+        print("Cached", len(dev_batches), "batches for", len(dev_lines), "dev sentences of", dev_pair)
+        dev_batch_cache.append((dev_batches, inverse_permutation))
+    return dev_batch_cache
+
+def decode_dev_sets(model, tok, args, dev_batch_cache, dev_files, gpu):
+    """Decodes all dev sets using the cached batches. With distributed evaluation, every process decodes a contiguous part of each dev set and the hypotheses are gathered from all processes so that they are in the original order. Otherwise the whole dev sets are decoded by this process. Returns the hypotheses for each dev pair."""
+    hyp = [[dev_pair, []] for dev_pair, dev_pair_info in dev_files]
+    for dev_idx, [dev_pair, dev_pair_info] in enumerate(dev_files):
+        slangtlang =dev_pair.strip().split("-")
+        tlang = slangtlang[2] if args.multi_source else slangtlang[1] ## In case we do multisource NMT the target is the third language.
+        dev_batches, inverse_permutation = dev_batch_cache[dev_idx]
+        hyp[dev_idx][1] = decode_dev_set(model, tok, args, dev_batches, inverse_permutation, tlang, gpu)
+    if args.distributed_eval:
+        gathered_hyps = [None for _ in range(args.world_size)]
+        dist.all_gather_object(gathered_hyps, [dev_hyps for _, dev_hyps in hyp]) ## One collective for all pairs. The hypotheses are small compared to the time it takes to decode them.
+        for dev_idx in range(len(hyp)):
+            hyp[dev_idx][1] = [translation for rank_hyps in gathered_hyps for translation in rank_hyps[dev_idx]]
+    return hyp
+
+def build_teacher_cache(parent_model, tok, args, train_files, rank, gpu):
+    """Runs the parent model once over all the training examples of this process and writes the top-k log probabilities at the distillation temperature to a teacher output cache. The hidden states of the mapped parent layers are cached as well for hidden layer regression. The parent is run without dropout so that the cached distributions are deterministic."""
+    layers = sorted(set(int(layer_mapping.split("-")[0])-1 for layer_mapping in args.distillation_layer_mapping.strip().split(","))) if "hidden_layer_regression" in args.distillation_styles.split(",") else []
+    cache_writer = TeacherOutputCacheWriter(teacher_cache_shard_path(args.teacher_cache_path, rank), args.teacher_cache_topk, layers, args.distillation_temperature)
+    parent_model_training = parent_model.training
+    parent_model.eval()
+    num_examples = 0
+    start = time.time()
+    with torch.no_grad():
+        for input_ids, input_masks, decoder_input_ids, labels in generate_batches_for_teacher_cache(tok, args, train_files, rank):
+            parent_mod_compute = (parent_model.module if type(parent_model) == DistributedDataParallel else parent_model)(input_ids=input_ids.to(gpu), attention_mask=input_masks.to(gpu), decoder_input_ids=decoder_input_ids.to(gpu), output_hidden_states=len(layers) > 0) ## We bypass DDP since the processes have a different number of batches.
+            parent_lprobs = torch.nn.functional.log_softmax(parent_mod_compute.logits.float()/args.distillation_temperature, dim=-1)
+            topk_lprobs, topk_ids = parent_lprobs.topk(args.teacher_cache_topk, dim=-1)
+            topk_lprobs, topk_ids = topk_lprobs.cpu().numpy(), topk_ids.cpu().numpy()
+            if len(layers) > 0:
+                encoder_hidden_states = torch.stack([parent_mod_compute.encoder_hidden_states[layer] for layer in layers], dim=2).half().cpu().numpy()
+                decoder_hidden_states = torch.stack([parent_mod_compute.decoder_hidden_states[layer] for layer in layers], dim=2).half().cpu().numpy()
+            source_lengths = input_masks.sum(dim=1).tolist()
+            target_lengths = labels.ne(tok.pad_token_id).sum(dim=1).tolist()
+            for row, key in enumerate(teacher_cache_keys(input_ids, labels, tok.pad_token_id)):
+                if len(layers) > 0:
+                    cache_writer.add(int(key), topk_ids[row, :target_lengths[row]], topk_lprobs[row, :target_lengths[row]], encoder_hidden_states[row, :source_lengths[row]], decoder_hidden_states[row, :target_lengths[row]])
+                else:
+                    cache_writer.add(int(key), topk_ids[row, :target_lengths[row]], topk_lprobs[row, :target_lengths[row]])
+            num_examples += len(target_lengths)
+            if rank == 0 and num_examples // 100000 != (num_examples - len(target_lengths)) // 100000:
+                print("Cached the teacher outputs of", num_examples, "examples in", round(time.time()-start, 2), "seconds.")
+    cache_writer.close()
+    print("Cached the teacher outputs of", num_examples, "examples on rank", rank, "in", round(time.time()-start, 2), "seconds.")
+    parent_model.train(parent_model_training)
+
 def model_create_load_run_save(gpu, args, train_files, dev_files):
     """The main function which does the overall training. Should be split into multiple parts in the future. Currently monolithc intentionally."""
     
     rank = args.nr * args.gpus + gpu ## The rank of the current process out of the total number of processes indicated by world_size.
     print("Launching process:", rank)
-    dist.init_process_group(backend='nccl', init_method='env://', world_size=args.world_size, rank=rank)
+    gpu = setup_process_device(gpu, rank, args) ## From here on gpu is the device of this process which is the cpu with --device cpu.
     
     if args.shard_files and rank == 0: ## First shard the data using process 0 aka the prime process or master process. Other processes will wait.
         shard_files_bi(train_files, args)
@@ -106,6 +202,10 @@ def model_create_load_run_save(gpu, args, train_files, dev_files):
         elif "mbart" in args.tokenizer_name_or_path:
             tok = MBartTokenizer.from_pretrained(args.tokenizer_name_or_path, do_lower_case=False, use_fast=False, keep_accents=True)
         ## Fast tokenizers are not good because their behavior is weird. Accents should be kept or else the segmentation will be messed up on languages with accented characters. No lower case obviously because we want to train on the original case. Set to false if you are ok with the model not dealing with cases.
+    
+    if rank == 0: ## The prime process builds the missing corpus manifests so that the other processes never scan the corpora to get the line counts and length statistics.
+        prepare_corpus_manifests(get_corpus_paths(train_files + (dev_files if args.use_dev_for_fisher else [])), tok, args)
+    dist.barrier() ## Stop other processes from proceeding till the manifests are built.
     scorer = rouge_scorer.RougeScorer(['rouge1', 'rougeL'], use_stemmer=False) ## In case we do summarization.
     tok.save_pretrained(args.model_path+"_deploy") ## Save the tokenizer for future use.
     print("Tokenizer is:", tok)
@@ -140,8 +240,10 @@ def model_create_load_run_save(gpu, args, train_files, dev_files):
     if args.unidirectional_encoder:
         print("Using unidirectional encoder.")
     
+    checkpoint_writer = None ## Only the prime process saves checkpoints.
     if rank == 0:
         writer = SummaryWriter(args.model_path+".tflogs")
+        checkpoint_writer = CheckpointWriter(args.async_checkpointing) ## Checkpoints are written in the background if requested.
     
     if args.use_official_pretrained:
         if "mbart" in args.pretrained_model or "IndicBART" in args.pretrained_model:
@@ -202,8 +304,10 @@ def model_create_load_run_save(gpu, args, train_files, dev_files):
         model = MBartForConditionalGeneration(config)
     model.train()
     
+    teacher_cache = None
     if args.distillation: ## When distilling we need a parent model. The creation of the model is in the same way as the child. This model is immediately loaded with some pretrained params and then loaded into the GPU.
         print("We will do distillation from a parent model.")
+        parent_output_hidden_states, parent_output_attentions = get_parent_output_flags(args) ## The parent only computes what the distillation styles need.
         if args.use_official_parent_pretrained:
             if "mbart" in args.parent_pretrained_model or "IndicBART" in args.pretrained_model:
                 parent_config = MBartConfig.from_pretrained(args.parent_pretrained_model)
@@ -224,24 +328,42 @@ def model_create_load_run_save(gpu, args, train_files, dev_files):
         else: ## Its a locally pre-trained parent model.
             parent_config = MBartConfig(vocab_size=len(tok), encoder_layers=args.parent_encoder_layers, decoder_layers=args.parent_decoder_layers, dropout=args.parent_dropout, attention_dropout=args.parent_attention_dropout, activation_dropout=args.parent_activation_dropout, encoder_attention_heads=args.parent_encoder_attention_heads, decoder_attention_heads=args.parent_decoder_attention_heads, encoder_ffn_dim=args.parent_encoder_ffn_dim, decoder_ffn_dim=args.parent_decoder_ffn_dim, d_model=args.parent_d_model, no_embed_norm=args.no_embed_norm, scale_embedding=args.scale_embedding, pad_token_id=tok.pad_token_id, eos_token_id=tok(["</s>"], add_special_tokens=False).input_ids[0][0], bos_token_id=tok(["<s>"], add_special_tokens=False).input_ids[0][0], encoder_tying_config=args.encoder_tying_config, decoder_tying_config=args.decoder_tying_config, wait_k=args.wait_k, additional_source_wait_k=args.additional_source_wait_k, unidirectional_encoder=args.unidirectional_encoder, multi_source=args.multi_source, multi_source_method=args.multi_source_method, mid_fusion_layers=args.mid_fusion_layers, bottleneck_mid_fusion_tokens=args.bottleneck_mid_fusion_tokens, softmax_temperature=args.softmax_temperature, temperature_calibration=args.temperature_calibration, encoder_layerdrop=args.layerdrop, decoder_layerdrop=args.layerdrop, no_scale_attention_embedding=args.no_scale_attention_embedding, positional_encodings=args.positional_encodings, activation_function=args.activation_function, no_positional_encoding_encoder=args.no_positional_encoding_encoder, no_positional_encoding_decoder=args.no_positional_encoding_decoder, use_moe=args.use_moe, num_experts=args.num_experts, expert_ffn_size=args.expert_ffn_size)
             parent_model = MBartForConditionalGeneration(config)
-        parent_model.cuda(gpu)
+        parent_model.to(gpu)
         parent_model.train() ## We do this to enable dropout but we wont have an optimizer for this so we wont train this model. For now. Future implementations should ask if we want to do co-distill or not. By co-distillation I mean, the parent will learn together with the child.
-        parent_model = DistributedDataParallel(parent_model, device_ids=[gpu], output_device=gpu)
+        if not args.frozen_parent: ## A frozen parent is never trained so it does not need the DDP wrapper.
+            parent_model = wrap_in_ddp(parent_model, gpu)
         print("Loading a parent model from which distillation will be done.")
         dist.barrier()
         # configure map_location properly
-        map_location = {'cuda:%d' % 0: 'cuda:%d' % gpu}
+        map_location = get_map_location(gpu)
         if not args.use_official_parent_pretrained:
             parent_checkpoint_dict = torch.load(args.parent_pretrained_model, map_location=map_location)
             if type(parent_checkpoint_dict) == dict:
-                parent_model.load_state_dict(parent_checkpoint_dict['model']) # We never do any remapping of the parent. We always reuse it as it is.
+                if args.frozen_parent: ## The checkpoint was saved from a DDP wrapped model.
+                    parent_model.load_state_dict({key[len("module."):] if key.startswith("module.") else key: value for key, value in parent_checkpoint_dict['model'].items()}) # We never do any remapping of the parent. We always reuse it as it is.
+                else:
+                    parent_model.load_state_dict(parent_checkpoint_dict['model']) # We never do any remapping of the parent. We always reuse it as it is.
             else:
-                parent_model.module.load_state_dict(parent_checkpoint_dict) # We never do any remapping of the parent. We always reuse it as it is.
+                (parent_model if args.frozen_parent else parent_model.module).load_state_dict(parent_checkpoint_dict) # We never do any remapping of the parent. We always reuse it as it is.
             del parent_checkpoint_dict
             
-        parent_model.train()
+        if args.frozen_parent:
+            parent_model = prepare_frozen_parent(parent_model, args)
+        else:
+            parent_model.train()
+        if args.teacher_cache_path != "": ## The parent is only needed to build the cache. Afterwards its outputs are read from the cache and it is freed.
+            assert (args.tokenize_once or args.use_binarized_corpora) and not (args.cross_distillation or args.multi_source or args.pack_examples or args.unify_encoder or args.source_masking_for_bilingual or "attention_distillation" in args.distillation_styles.split(",")), "The teacher output cache needs --tokenize_once or --use_binarized_corpora and cant be used with cross distillation, multi source training, packing, encoder unification, source masking or attention distillation."
+            assert args.is_summarization or all(lang.strip().split("-")[0] != lang.strip().split("-")[1] for lang, _ in train_files), "The teacher output cache cant be used with copying task pairs like en-en since their sources are masked randomly so their examples can never be looked up. Remove these pairs from the training files."
+            teacher_cache_path = teacher_cache_shard_path(args.teacher_cache_path, rank)
+            if not os.path.exists(os.path.join(teacher_cache_path, "meta.json")): ## No barrier is needed afterwards since every process only reads its own cache. The cache of a process may take much longer to build than the others and a barrier could time out.
+                print("Building the teacher output cache", teacher_cache_path)
+                build_teacher_cache(parent_model, tok, args, train_files, rank, gpu)
+            teacher_cache = TeacherOutputCache(teacher_cache_path)
+            assert teacher_cache.topk == args.teacher_cache_topk and teacher_cache.temperature == args.distillation_temperature, "The teacher output cache was built with a different top-k or distillation temperature. Delete it or point to another path."
+            del parent_model
+            torch.cuda.empty_cache()
 
-    torch.cuda.set_device(gpu) ## Set the device to the current GPU. This is different from the rank so keep this in mind.
+    set_device(gpu) ## Set the device to the current GPU. This is different from the rank so keep this in mind.
     torch.cuda.empty_cache()
 
     if args.freeze_embeddings: ## If we wish to freeze the model embeddings. This may be useful when fine-tuning a pretrained model.
@@ -256,10 +378,10 @@ def model_create_load_run_save(gpu, args, train_files, dev_files):
 
     ### NOTE: Please freeze params before wrapping the model in DDP. Mandem almost had a stoke trying to figure this out.
 
-    model.cuda(gpu) ## Move the model to the GPU.
-    print("Memory consumed after moving model to GPU", round(torch.cuda.memory_allocated(gpu)/(1024**3), 2), "GB")
-    model = DistributedDataParallel(model, device_ids=[gpu], output_device=gpu) ## This wrapper around the model will enable distributed training.
-    print("Memory consumed after wrapping with DDP", round(torch.cuda.memory_allocated(gpu)/(1024**3), 2), "GB")
+    model.to(gpu) ## Move the model to the GPU.
+    print("Memory consumed after moving model to GPU", get_memory_allocated(gpu), "GB")
+    model = wrap_in_ddp(model, gpu) ## This wrapper around the model will enable distributed training.
+    print("Memory consumed after wrapping with DDP", get_memory_allocated(gpu), "GB")
     no_decay = ["bias", "LayerNorm.weight"]
     optimizer_grouped_parameters = [
         {
@@ -305,7 +427,7 @@ def model_create_load_run_save(gpu, args, train_files, dev_files):
         print("Loading from checkpoint. Strict loading by default but if there are missing or non matching keys or if we use prompt or adaptor tuning, they will be ignored when layer remapping or component selection is done. In case of prompt and adaptor tuning, new params are added to the model and hence strict matching of keys is not possible.")
         dist.barrier()
         # configure map_location properly
-        map_location = {'cuda:%d' % 0: 'cuda:%d' % gpu}
+        map_location = get_map_location(gpu)
         if args.locally_fine_tuned_model_path is not None: ## Now that the pretrained_model argument was used to instantiate the model, it can be replaced with the local model path. Remember to specify pure model or the model with the optimizer and scheduler states depending on your requirement by relying on the flag --no_reload_optimizer_ctr_and_scheduler.
             args.pretrained_model = args.locally_fine_tuned_model_path
         checkpoint_dict = torch.load(args.pretrained_model, map_location=map_location)
@@ -340,11 +462,10 @@ def model_create_load_run_save(gpu, args, train_files, dev_files):
             print("Training from scratch")
         CHECKPOINT_PATH = args.model_path
         if rank == 0:
-            checkpoint_dict = {'model': model.state_dict(), 'optimizer': optimizer.state_dict(), 'scheduler': scheduler.state_dict(), 'ctr': 0}
-            torch.save(checkpoint_dict, CHECKPOINT_PATH) ## Save a model by default every eval_every steps. This model will be saved with the same file name each time.
-            torch.save(model.module.state_dict(), CHECKPOINT_PATH+".pure_model")
+            checkpoint_writer.save(model, optimizer, scheduler, 0, CHECKPOINT_PATH) ## Save a model by default every eval_every steps. This model will be saved with the same file name each time.
+            checkpoint_writer.wait()
         dist.barrier()
-        map_location = {'cuda:%d' % 0: 'cuda:%d' % gpu}
+        map_location = get_map_location(gpu)
         checkpoint_dict = torch.load(CHECKPOINT_PATH, map_location=map_location)
         model.load_state_dict(checkpoint_dict['model'])
         optimizer.load_state_dict(checkpoint_dict['optimizer'])
@@ -387,12 +508,16 @@ def model_create_load_run_save(gpu, args, train_files, dev_files):
         else:
             print("Using regular seq2seq objective for computing Fisher coefficients.")
         datagenerator = generate_batches_bilingual(tok, args, files, rank)
-        ewc_loss = EWC(model, datagenerator, gpu, args.label_smoothing, ignore_index=tok.pad_token_id)
+        ewc_loss = EWC(model, datagenerator, gpu, args.label_smoothing, ignore_index=tok.pad_token_id, fisher_cache_path=get_fisher_cache_path(model, files, args))
         args.num_batches = num_batches_tmp
         print("Fisher coefficients learned.")
     
+    assert not (args.chunked_loss and (args.temperature_calibration or args.distillation or (args.multi_source and args.multi_source_method == "average_softmaxes"))), "The chunked loss never materializes the logits so it cant be used with temperature calibration or distillation or when averaging softmaxes for multi source NMT."
+    if args.chunked_loss and not isinstance(model.module, MBartForConditionalGeneration):
+        raise RuntimeError("--chunked_loss needs the MBart model of this repository which returns the decoder outputs fed to its LM head but the model is a "+type(model.module).__name__+". Train without --chunked_loss.")
     num_batches_this_optimizer_step = 0
     losses = 0
+    metrics = MetricAggregator(writer if rank == 0 else None, gpu, args.reduce_metrics_across_ranks) ## The losses are summed on the GPU and written every metrics_flush_every steps.
     global_sbleu_history = [] ## To save the global evaluation metric history.
     max_global_sbleu = 0 ## Maximum global evaluation metric score.
     max_global_sbleu_step = 0 ## Step at which we achieved the maximum global evaluation metric score.
@@ -406,62 +531,39 @@ def model_create_load_run_save(gpu, args, train_files, dev_files):
         refs = [[dev_pair, [[refline.strip() for refline in open(dev_pair_info[1])][:args.max_eval_batches*args.dev_batch_size]]] for dev_pair, dev_pair_info in dev_files] ## Get all references for each input. Select up to args.max_eval_batches*args.dev_batch_size examples.
     else:
         refs = [[dev_pair, [[refline.strip() for refline in open(dev_pair_info[1])][:args.max_eval_batches*args.dev_batch_size]]] for dev_pair, dev_pair_info in dev_files] ## Get all references for each input. Select up to args.max_eval_batches*args.dev_batch_size examples.
+    if not args.no_eval and (rank == 0 or args.distributed_eval): ## The dev batches are built once and reused for every evaluation.
+        dev_batch_cache = build_dev_batch_cache(tok, args, inps, dev_files, rank)
     if args.use_m2:
         ref_srcs = [[dev_pair, [[refline.strip() for refline in open(dev_pair_info[0])][:args.max_eval_batches*args.dev_batch_size]]] for dev_pair, dev_pair_info in dev_files] ## Get all references for each input. Select up to args.max_eval_batches*args.dev_batch_size examples.
     
     start = time.time()
     
-    for input_ids, input_masks, decoder_input_ids, labels in generate_batches_bilingual(tok, args, train_files, rank): #Batches are generated from here. The argument (0.30, 0.40) is a range which indicates the percentage of the source sentence to be masked in case we want masking during training just like we did during BART pretraining. The argument 3.5 is the lambda to the poisson length sampler which indicates the average length of a word sequence that will be masked.
+    batch_prefetcher = BatchPrefetcher(generate_batches_bilingual, {"tok": tok, "args": args, "files": train_files, "rank": rank}, rank, gpu, args.num_data_workers, args.data_queue_depth) ## Batches are created by background workers if requested.
+    data_wait_time = 0.0
+    for input_ids, input_masks, decoder_input_ids, labels in batch_prefetcher: #Batches are generated from here. The argument (0.30, 0.40) is a range which indicates the percentage of the source sentence to be masked in case we want masking during training just like we did during BART pretraining. The argument 3.5 is the lambda to the poisson length sampler which indicates the average length of a word sequence that will be masked.
+        data_wait_time += batch_prefetcher.last_wait_time
+        metrics.add("data wait time", batch_prefetcher.last_wait_time) ## If this is not close to 0 then increase --num_data_workers.
         if ctr % args.eval_every == 0 and num_batches_this_optimizer_step == 0: ## We have to evaluate our model every eval_every steps.
             CHECKPOINT_PATH = args.model_path
+            if args.distributed_eval and not args.no_eval: ## All processes decode their part of the dev sets and the hypotheses are gathered for scoring on the prime process.
+                if args.mixed_wait_k:
+                    model.module.config.wait_k = args.wait_k
+                model.eval() ## We go to eval mode so that there will be no dropout.
+                hyp = decode_dev_sets(model, tok, args, dev_batch_cache, dev_files, gpu)
+                if rank != 0:
+                    model.train()
             if rank == 0: ## Evaluation will be done only on the prime/master process which is at rank 0. Other processes will sleep.
+                checkpoint_links = [] ## Additional copies of the checkpoint (best models and intermediate checkpoints). These will be hardlinks to the checkpoint saved below.
+                deploy_path = None
                 if not args.no_eval: ## If we dont care about early stopping and only on training for a bazillion batches then you can save time by skipping evaluation.
                     print("Running eval on dev set(s)")
-                    if args.mixed_wait_k:
-                        model.module.config.wait_k = args.wait_k
-                    hyp = [[dev_pair, []] for dev_pair, dev_pair_info in dev_files]
+                    if not args.distributed_eval: ## Otherwise the hypotheses have already been gathered from all processes.
+                        if args.mixed_wait_k:
+                            model.module.config.wait_k = args.wait_k
+                        model.eval() ## We go to eval mode so that there will be no dropout.
+                        hyp = decode_dev_sets(model, tok, args, dev_batch_cache, dev_files, gpu)
                     sbleus = []
-                    model.eval() ## We go to eval mode so that there will be no dropout.
-                    checkpoint_dict = {'model': model.state_dict(), 'optimizer': optimizer.state_dict(), 'scheduler': scheduler.state_dict(), 'ctr': ctr} ## This training state will be saved.
-                    for dev_idx, [dev_pair, dev_pair_info] in enumerate(dev_files): ## For each evaluation pair we will decode and compute scores.
-                        slangtlang =dev_pair.strip().split("-")
-                        if args.multi_source: ## In case we do multisource NMT
-                            slang=slangtlang[0]+"-"+slangtlang[1] ## This will be split in the generate_batches_eval function as we expect a triplet. 
-                            tlang=slangtlang[2]
-                        else:
-                            slang=slangtlang[0]
-                            tlang=slangtlang[1]
-                        eval_batch_counter = 0
-                        for dev_input_ids, dev_input_masks in generate_batches_eval_bilingual(tok, args, inps[dev_idx][1], slang):
-                            if args.multi_source:
-                                dev_input_ids_parent = dev_input_ids[1]
-                                dev_input_ids = dev_input_ids[0]
-                                dev_input_masks_parent = dev_input_masks[1]
-                                dev_input_masks = dev_input_masks[0]
-                                dev_input_ids_parent = dev_input_ids_parent.to(gpu) ## Move to GPU.
-                                dev_input_masks_parent = dev_input_masks_parent.to(gpu) ## Move to GPU.
-                                
-                            if args.prompt_tuning:
-                                dev_input_shape = dev_input_masks.size()
-                                encoder_pad = torch.ones(dev_input_shape[0], args.num_prompts).clone().detach()
-                                dev_input_masks = torch.cat([encoder_pad, dev_input_masks], dim=1)
-                            start = time.time()
-                            dev_input_ids = dev_input_ids.to(gpu) ## Move to GPU.
-                            dev_input_masks = dev_input_masks.to(gpu) ## Move to GPU.
-                            if args.is_summarization: ## Things can be slow so best show progress
-                                print("Decoding batch from a pool of", len(inps[dev_idx][1]), "examples")
-                            with torch.no_grad(): ## torch.no_grad is apparently known to prevent the code from allocating memory for gradient computation in addition to making things faster. I have not verified this but have kept it as a safety measure to ensure that my model is not being directly tuned on the development set.
-                                translations = model.module.generate(dev_input_ids, use_cache=True, num_beams=1, max_length=int((len(dev_input_ids[0])*args.max_decode_length_multiplier) if args.max_decode_length_multiplier > 0 else -args.max_decode_length_multiplier), min_length=int((len(dev_input_ids[0])*args.min_decode_length_multiplier) if args.min_decode_length_multiplier > 0 else -args.min_decode_length_multiplier), early_stopping=True, attention_mask=dev_input_masks, pad_token_id=tok.pad_token_id, eos_token_id=tok(["</s>"], add_special_tokens=False).input_ids[0][0], decoder_start_token_id=tok([tlang if args.use_official_pretrained else "<2"+tlang+">"], add_special_tokens=False).input_ids[0][0], bos_token_id=tok(["<s>"], add_special_tokens=False).input_ids[0][0], length_penalty=args.length_penalty, repetition_penalty=args.repetition_penalty, encoder_no_repeat_ngram_size=args.encoder_no_repeat_ngram_size, no_repeat_ngram_size=args.no_repeat_ngram_size, additional_input_ids=dev_input_ids_parent if args.multi_source else None, additional_input_ids_mask=dev_input_masks_parent if args.multi_source else None) ## We translate the batch. 
-                            del dev_input_ids ## Delete to avoid retention.
-                            del dev_input_masks ## Delete to avoid retention.
-                            translations = translations.to('cpu') ## Delete to avoid retention.
-                            if args.multi_source:
-                                del dev_input_ids_parent ## Delete to avoid retention.
-                                del dev_input_masks_parent ## Delete to avoid retention.
-                            for translation in translations:
-                                translation  = tok.decode(translation, skip_special_tokens=args.no_skip_special_tokens, clean_up_tokenization_spaces=False) ### Get the raw sentences.
-                                hyp[dev_idx][1].append(translation)
-                            del translations ## Delete to avoid retention.
+                    for dev_idx, [dev_pair, dev_pair_info] in enumerate(dev_files): ## For each evaluation pair we will compute scores.
                         if args.use_rouge: ## Get the evaluation metric score.
                             scores = 0
                             for curr_ref, curr_pred in zip(refs[dev_idx][1][0], hyp[dev_idx][1]):
@@ -491,11 +593,9 @@ def model_create_load_run_save(gpu, args, train_files, dev_files):
                             max_individual_sbleu_step[dev_idx][1] = curr_eval_step
                             print("New peak reached for", dev_pair,". Saving.")
                             if args.save_intermediate_checkpoints:
-                                torch.save(checkpoint_dict, CHECKPOINT_PATH+".best_dev_bleu."+dev_pair+"."+str(ctr))
-                                torch.save(model.module.state_dict(), CHECKPOINT_PATH+".best_dev_bleu."+dev_pair+"."+str(ctr)+".pure_model") ## Pure model without any ddp markers or optimizer info.
+                                checkpoint_links.append(CHECKPOINT_PATH+".best_dev_bleu."+dev_pair+"."+str(ctr))
                             else:
-                                torch.save(checkpoint_dict, CHECKPOINT_PATH+".best_dev_bleu."+dev_pair)
-                                torch.save(model.module.state_dict(), CHECKPOINT_PATH+".best_dev_bleu."+dev_pair+".pure_model") 
+                                checkpoint_links.append(CHECKPOINT_PATH+".best_dev_bleu."+dev_pair)
                     ## Global stats
                     sbleu = sum(sbleus)/len(sbleus) ## The global score.
                     global_sbleu_history.append([sbleu, ctr]) ## Update the global score history.
@@ -506,13 +606,10 @@ def model_create_load_run_save(gpu, args, train_files, dev_files):
                         max_global_sbleu_step = curr_eval_step
                         print("New peak reached. Saving.")
                         if args.save_intermediate_checkpoints:
-                            torch.save(checkpoint_dict, CHECKPOINT_PATH+".best_dev_bleu.global."+str(ctr))
-                            torch.save(model.module.state_dict(), CHECKPOINT_PATH+".best_dev_bleu.global."+str(ctr)+".pure_model") ## Pure model without any ddp markers or optimizer info.
+                            checkpoint_links.append(CHECKPOINT_PATH+".best_dev_bleu.global."+str(ctr))
                         else:
-                            torch.save(checkpoint_dict, CHECKPOINT_PATH+".best_dev_bleu.global")
-                            torch.save(model.module.state_dict(), CHECKPOINT_PATH+".best_dev_bleu.global.pure_model") ## Pure model without any ddp markers or optimizer info.
-                            ## Copy the global best pure model to the deploy folder.
-                            os.system("cp "+CHECKPOINT_PATH+".best_dev_bleu.global.pure_model "+CHECKPOINT_PATH+"_deploy/pytorch_model.bin")
+                            checkpoint_links.append(CHECKPOINT_PATH+".best_dev_bleu.global")
+                            deploy_path = CHECKPOINT_PATH+"_deploy/pytorch_model.bin" ## The global best pure model goes to the deploy folder.
                     if curr_eval_step - max_global_sbleu_step > (args.early_stop_checkpoints + annealing_attempt*args.additional_early_stop_checkpoints_per_anneal_step): ## If the global scores have not improved for more than early_stop_checkpoints + some additional checkpoints to wait for till annealing is done then we stop training.
                         if annealing_attempt < args.max_annealing_attempts: ## We will only downscale the LR a fixed number of times. Each time we downscale the number of checkpoints to wait for declaring convergence will increase by a fixed value.
                             annealing_attempt += 1
@@ -536,21 +633,16 @@ def model_create_load_run_save(gpu, args, train_files, dev_files):
                 else: ## If no evaluation will be done then I consider it prudent to save the model every 10000 checkpoints by default. Change this to whatever value you want.
                     if ctr % args.no_eval_save_every == 0:
                         print("No evaluation based early stopping so saving every", args.no_eval_save_every, "checkpoints.")
-                        checkpoint_dict = {'model': model.state_dict(), 'optimizer': optimizer.state_dict(), 'scheduler': scheduler.state_dict(), 'ctr': ctr}
                         if args.save_intermediate_checkpoints:
-                            torch.save(checkpoint_dict, CHECKPOINT_PATH+"."+str(ctr))
-                            torch.save(model.module.state_dict(), CHECKPOINT_PATH+"."+str(ctr)+".pure_model")
-                        else:
-                            torch.save(checkpoint_dict, CHECKPOINT_PATH)
-                            torch.save(model.module.state_dict(), CHECKPOINT_PATH+".pure_model")
+                            checkpoint_links.append(CHECKPOINT_PATH+"."+str(ctr))
                 print("Saving the model")
                 sys.stdout.flush()
                 # All processes should see same parameters as they all start from same
                 # random parameters and gradients are synchronized in backward passes.
                 # Therefore, saving it in one process is sufficient.
-                checkpoint_dict = {'model': model.state_dict(), 'optimizer': optimizer.state_dict(), 'scheduler': scheduler.state_dict(), 'ctr': ctr}
-                torch.save(checkpoint_dict, CHECKPOINT_PATH) ## Save a model by default every eval_every steps. This model will be saved with the same file name each time.
-                torch.save(model.module.state_dict(), CHECKPOINT_PATH+".pure_model")
+                checkpoint_writer.save(model, optimizer, scheduler, ctr, CHECKPOINT_PATH, checkpoint_links, deploy_path) ## Save a model by default every eval_every steps. This model will be saved with the same file name each time.
+                if args.checkpoint_sync_mode == "reload": ## The other processes will read the checkpoint after the barrier.
+                    checkpoint_writer.wait()
                 
 
             # Use a barrier() to make sure that process 1 loads the model after process
@@ -560,16 +652,7 @@ def model_create_load_run_save(gpu, args, train_files, dev_files):
                 if f.read().strip() == "1":
                     print("All processess to die!")
                     break
-            # configure map_location properly
-            print("Loading from checkpoint")
-            sys.stdout.flush()
-            map_location = {'cuda:%d' % 0: 'cuda:%d' % gpu}
-            checkpoint_dict = torch.load(CHECKPOINT_PATH, map_location=map_location)
-            model.load_state_dict(checkpoint_dict['model'])
-            optimizer.load_state_dict(checkpoint_dict['optimizer'])
-            scheduler.load_state_dict(checkpoint_dict['scheduler'])
-            del checkpoint_dict
-            torch.cuda.empty_cache()
+            synchronize_after_checkpoint(model, optimizer, scheduler, CHECKPOINT_PATH, checkpoint_writer, gpu, args) ## By default every process reloads the checkpoint but this can be skipped or replaced by a cheap consistency check.
             
         dist.barrier()
         if args.cross_distillation or args.multi_source: ## The returned input ids and input masks are actually a list of two items each. The first item is to be fed to the parent model and the second item is to be fed to the child model.
@@ -585,16 +668,25 @@ def model_create_load_run_save(gpu, args, train_files, dev_files):
             domain_classifier_labels = torch.tensor(domain_classifier_labels, dtype=torch.int64).to(gpu) ## Move to gpu
             labels=labels[0]
             label_mask = labels.eq(tok.pad_token_id).unsqueeze(-1).to(gpu)
+        if args.pack_examples: ## The input masks are actually a list of the attention masks and the segment ids of the packed examples on the encoder and decoder sides.
+            input_masks, encoder_segment_ids, decoder_segment_ids = input_masks
+            segment_kwargs = {"encoder_segment_ids": encoder_segment_ids.to(gpu, non_blocking=True), "decoder_segment_ids": decoder_segment_ids.to(gpu, non_blocking=True)} ## The model uses these for block diagonal attention masks and to restart the positions for every packed example.
+        else:
+            segment_kwargs = {}
+        metrics.add("padding efficiency", get_padding_efficiency(input_ids, labels, tok.pad_token_id)) ## Real tokens divided by padded tokens. Use this to tune --bucket_width and --bucketing_pool_size.
         if args.prompt_tuning:
             input_shape = input_masks.size()
             encoder_pad = torch.ones(input_shape[0], args.num_prompts).clone().detach()
             input_masks = torch.cat([encoder_pad, input_masks], dim=1)
-        input_ids=input_ids.to(gpu) ## Move to gpu
-        input_masks=input_masks.to(gpu) ## Move to gpu
-        decoder_input_ids=decoder_input_ids.to(gpu) ## Move to gpu
-        labels=labels.to(gpu) ## Move to gpu
+        if teacher_cache is not None:
+            teacher_outputs = teacher_cache.lookup(input_ids, labels, tok.pad_token_id).to(gpu) ## The cached parent outputs of this batch.
+        input_ids=input_ids.to(gpu, non_blocking=True) ## Move to gpu. Non blocking because the batch is pinned when prefetched.
+        input_masks=input_masks.to(gpu, non_blocking=True) ## Move to gpu. Non blocking because the batch is pinned when prefetched.
+        decoder_input_ids=decoder_input_ids.to(gpu, non_blocking=True) ## Move to gpu. Non blocking because the batch is pinned when prefetched.
+        labels=labels.to(gpu, non_blocking=True) ## Move to gpu. Non blocking because the batch is pinned when prefetched.
         if num_batches_this_optimizer_step == 0: ## If this is the first batch then we need to initialize the optimizer.
             optimizer.zero_grad(set_to_none=True) ## Empty the gradients before any computation.
+        set_gradient_synchronization(model, num_batches_this_optimizer_step == args.multistep_optimizer_steps - 1) ## With gradient accumulation only the last batch of the optimizer step all-reduces the gradients.
         if rank == 0:
             writer.add_scalar("learning rate", scheduler.get_lr()[0], ctr)
         if args.mixed_wait_k:
@@ -604,25 +696,19 @@ def model_create_load_run_save(gpu, args, train_files, dev_files):
 
         if args.fp16: ## The difference between AMP and FP32 is the use of the autocast. The code below is duplicated and can be shrunk. TODO.
             with torch.cuda.amp.autocast():
-                mod_compute = model(input_ids=input_ids, attention_mask=input_masks ,decoder_input_ids=decoder_input_ids, output_hidden_states=args.distillation, output_attentions=args.distillation, additional_input_ids=input_ids_parent if args.multi_source else None, additional_input_ids_mask=input_masks_parent if args.multi_source else None, label_mask=label_mask if args.num_domains_for_domain_classifier > 1 else None) ## Run the model and get logits. 
+                mod_compute = model(input_ids=input_ids, attention_mask=input_masks ,decoder_input_ids=decoder_input_ids, output_hidden_states=args.distillation, output_attentions=args.distillation, additional_input_ids=input_ids_parent if args.multi_source else None, additional_input_ids_mask=input_masks_parent if args.multi_source else None, label_mask=label_mask if args.num_domains_for_domain_classifier > 1 else None, return_lm_hidden_states=args.chunked_loss, **segment_kwargs) ## Run the model and get logits. 
                 logits = mod_compute.logits
-                lprobs = torch.nn.functional.log_softmax(logits, dim=-1) ## Softmax tempering of logits if needed.
-                loss = label_smoothed_nll_loss(
-                    lprobs, labels, args.label_smoothing, ignore_index=tok.pad_token_id
-                ) ## Label smoothed cross entropy loss.
+                loss, entropy = compute_lm_loss(model, mod_compute.lm_hidden_states if args.chunked_loss else logits, labels, tok.pad_token_id, args) ## Label smoothed cross entropy loss. With --chunked_loss the logits are computed in chunks and never materialized and the entropy is computed along with the loss if needed.
                 loss = loss*args.softmax_temperature ## Up scale loss in case of non unitary temperatures. Note that in case of self calibrating temperature, the softmax temperature must be set to 1.
-                if rank == 0:
-                    writer.add_scalar("pure cross entropy loss", loss.detach().cpu().numpy(), ctr)
+                metrics.add("pure cross entropy loss", loss)
                 if args.ewc_importance != 0: ## Update the model with the EWC loss.
                     ewc_loss_current = args.ewc_importance * ewc_loss.penalty(model)
-                    if rank == 0:
-                        writer.add_scalar("EWC loss", ewc_loss_current.detach().cpu().numpy(), ctr)
+                    metrics.add("EWC loss", ewc_loss_current)
                     loss = loss + ewc_loss_current
                 if args.temperature_calibration: 
                     loss = loss*mod_compute.softmax_temperature
-                    if rank == 0:
-                        writer.add_scalar("calibrated temperature", mod_compute.softmax_temperature.detach().cpu().numpy(), ctr)
-                        writer.add_scalar("calibrated temperature loss", loss.detach().cpu().numpy(), ctr)
+                    metrics.add("calibrated temperature", mod_compute.softmax_temperature)
+                    metrics.add("calibrated temperature loss", loss)
                 if args.num_domains_for_domain_classifier > 1: ## We augment the main loss with the domain classifier loss
                     domain_classifier_logits = mod_compute.domain_classifier_logits
                     domain_classifier_lprobs = torch.nn.functional.log_softmax(domain_classifier_logits, dim=-1) ## Softmax tempering of logits if needed.
@@ -630,10 +716,14 @@ def model_create_load_run_save(gpu, args, train_files, dev_files):
                         domain_classifier_lprobs.view(-1,args.num_domains_for_domain_classifier), domain_classifier_labels.view(-1,1), args.label_smoothing
                     ) ## Label smoothed cross entropy loss. We are not going to do any temperature related stuff to this.
                     loss = domain_classifier_loss*args.domain_classifier_loss_weight + loss * (1.0-args.domain_classifier_loss_weight)
-                    if rank == 0:
-                        writer.add_scalar("domain classifier loss", domain_classifier_loss.detach().cpu().numpy(), ctr)
-                        writer.add_scalar("loss with domain classifier loss", loss.detach().cpu().numpy(), ctr)
+                    metrics.add("domain classifier loss", domain_classifier_loss)
+                    metrics.add("loss with domain classifier loss", loss)
                 ## We will do multilayer softmaxing without any consideration for entropy maximization or distillation.
+                if args.chunked_loss and mod_compute.additional_lm_hidden_states is not None:
+                    for additional_hidden_states in mod_compute.additional_lm_hidden_states:
+                        loss_extra, entropy_extra = compute_lm_loss(model, additional_hidden_states, labels, tok.pad_token_id, args)
+                        loss += loss_extra*args.softmax_temperature ## Up scale loss in case of non unitary temperatures.
+                        entropy += entropy_extra
                 if mod_compute.additional_lm_logits is not None:
                     for additional_logits in mod_compute.additional_lm_logits:
                         lprobs = torch.nn.functional.log_softmax(additional_logits, dim=-1) ## Softmax tempering of logits if needed.
@@ -646,60 +736,56 @@ def model_create_load_run_save(gpu, args, train_files, dev_files):
                         loss += loss_extra ## Up scale loss in case of non unitary temperatures. TODO: Perhaps log this too.
                 if args.max_ent_weight != -1: ## This deals with softmax entropy maximization. The logic is that we compute the softmax entropy of the predictions via -(P(Y/X)*log(P(Y/X))). We then add it to the cross entropy loss with a negative sign as we wish to maximize entropy. This should penalize overconfident predictions. 
                     assert (args.max_ent_weight >= 0 and args.max_ent_weight <= 1)
-                    logits = logits*args.softmax_temperature ## We have to undo the tempered logits else our entropy estimate will be wrong.
-                    if args.temperature_calibration: 
-                        logits = logits*mod_compute.softmax_temperature
-                    lprobs = torch.nn.functional.log_softmax(logits, dim=-1) ## No tempering here
-                    entropy = -(torch.exp(lprobs)*lprobs).mean()
-                    if rank == 0:
-                        writer.add_scalar("softmax entropy", entropy.detach().cpu().numpy(), ctr)
-                    if mod_compute.additional_lm_logits is not None:
-                        for additional_logits in mod_compute.additional_lm_logits: ## Compute entropy for each layer as well
-                            additional_logits = additional_logits*args.softmax_temperature ## We have to undo the tempered logits else our entropy estimate will be wrong.
-                            if args.temperature_calibration: 
-                                additional_logits = additional_logits*mod_compute.softmax_temperature
-                            lprobs = torch.nn.functional.log_softmax(additional_logits, dim=-1) ## No tempering here
-                            entropy_extra = -(torch.exp(lprobs)*lprobs).mean()
-                            entropy += entropy_extra
+                    if args.chunked_loss: ## The entropy was computed along with the loss.
+                        metrics.add("softmax entropy", entropy)
+                    else:
+                        logits = logits*args.softmax_temperature ## We have to undo the tempered logits else our entropy estimate will be wrong.
+                        if args.temperature_calibration: 
+                            logits = logits*mod_compute.softmax_temperature
+                        lprobs = torch.nn.functional.log_softmax(logits, dim=-1) ## No tempering here
+                        entropy = -(torch.exp(lprobs)*lprobs).mean()
+                        metrics.add("softmax entropy", entropy)
+                        if mod_compute.additional_lm_logits is not None:
+                            for additional_logits in mod_compute.additional_lm_logits: ## Compute entropy for each layer as well
+                                additional_logits = additional_logits*args.softmax_temperature ## We have to undo the tempered logits else our entropy estimate will be wrong.
+                                if args.temperature_calibration: 
+                                    additional_logits = additional_logits*mod_compute.softmax_temperature
+                                lprobs = torch.nn.functional.log_softmax(additional_logits, dim=-1) ## No tempering here
+                                entropy_extra = -(torch.exp(lprobs)*lprobs).mean()
+                                entropy += entropy_extra
                     loss = loss*(1-args.max_ent_weight) - entropy*args.max_ent_weight ## Maximize the entropy so a minus is needed. Weigh and add losses as required.
-                    if rank == 0:
-                        writer.add_scalar("loss with entropy loss", loss.detach().cpu().numpy(), ctr)
+                    metrics.add("loss with entropy loss", loss)
                 if args.distillation: ## Time to distill.
                     if args.cross_distillation: ## The input ids and masks should be replaced with those appropriate for the parent.
                         input_ids = input_ids_parent
                         input_masks = input_masks_parent
-                    with torch.no_grad(): ## No gradient to avoid memory allocation.
-                        parent_mod_compute = parent_model(input_ids=input_ids, attention_mask=input_masks ,decoder_input_ids=decoder_input_ids, output_hidden_states=args.distillation, output_attentions=args.distillation) ## Get the parent model's computations.
+                    if teacher_cache is not None:
+                        parent_mod_compute = teacher_outputs
+                    else:
+                        with torch.no_grad(): ## No gradient to avoid memory allocation.
+                            parent_mod_compute = parent_model(input_ids=input_ids, attention_mask=input_masks ,decoder_input_ids=decoder_input_ids, output_hidden_states=parent_output_hidden_states, output_attentions=parent_output_attentions, **segment_kwargs) ## Get the parent model's computations.
                     distillation_loss = compute_distillation_losses(mod_compute, parent_mod_compute, labels, tok.pad_token_id, args) ## Compute distillation losses.
                     loss = args.distillation_loss_weight*distillation_loss + (1.0 - args.distillation_loss_weight)*loss ## Update the main loss with weighing and adding.
-                    if rank == 0:
-                        writer.add_scalar("distillation loss", distillation_loss.detach().cpu().numpy(), ctr)
-                        writer.add_scalar("final loss", loss.detach().cpu().numpy(), ctr)
+                    metrics.add("distillation loss", distillation_loss)
+                    metrics.add("final loss", loss)
                 if args.use_moe or args.moe_adaptors: ## add MOE losses too.
                     moe_loss = torch.sum(torch.stack(mod_compute.encoder_moe_losses)) + torch.sum(torch.stack(mod_compute.decoder_moe_losses))
-                    if rank == 0:
-                        writer.add_scalar("moe loss", moe_loss.detach().cpu().numpy(), ctr)
+                    metrics.add("moe loss", moe_loss)
                     loss += moe_loss
         else:
-            mod_compute = model(input_ids=input_ids, attention_mask=input_masks, decoder_input_ids=decoder_input_ids, output_hidden_states=args.distillation, output_attentions=args.distillation, additional_input_ids=input_ids_parent if args.multi_source else None, additional_input_ids_mask=input_masks_parent if args.multi_source else None, label_mask=label_mask if args.num_domains_for_domain_classifier > 1 else None) ## Run the model and get logits.
+            mod_compute = model(input_ids=input_ids, attention_mask=input_masks, decoder_input_ids=decoder_input_ids, output_hidden_states=args.distillation, output_attentions=args.distillation, additional_input_ids=input_ids_parent if args.multi_source else None, additional_input_ids_mask=input_masks_parent if args.multi_source else None, label_mask=label_mask if args.num_domains_for_domain_classifier > 1 else None, return_lm_hidden_states=args.chunked_loss, **segment_kwargs) ## Run the model and get logits.
             logits = mod_compute.logits
-            lprobs = torch.nn.functional.log_softmax(logits, dim=-1) ## Softmax tempering of logits if needed.
-            loss = label_smoothed_nll_loss(
-                lprobs, labels, args.label_smoothing, ignore_index=tok.pad_token_id
-            ) ## Label smoothed cross entropy loss.
+            loss, entropy = compute_lm_loss(model, mod_compute.lm_hidden_states if args.chunked_loss else logits, labels, tok.pad_token_id, args) ## Label smoothed cross entropy loss. With --chunked_loss the logits are computed in chunks and never materialized and the entropy is computed along with the loss if needed.
             loss = loss*args.softmax_temperature ## Up scale loss in case of non unitary temperatures.
-            if rank == 0:
-                writer.add_scalar("pure cross entropy loss", loss.detach().cpu().numpy(), ctr)
+            metrics.add("pure cross entropy loss", loss)
             if args.ewc_importance != 0: ## Update the model with the EWC loss.
                 ewc_loss_current = args.ewc_importance * ewc_loss.penalty(model)
-                if rank == 0:
-                    writer.add_scalar("EWC loss", ewc_loss_current.detach().cpu().numpy(), ctr)
+                metrics.add("EWC loss", ewc_loss_current)
                 loss = loss + ewc_loss_current
             if args.temperature_calibration: 
                 loss = loss*mod_compute.softmax_temperature
-                if rank == 0:
-                    writer.add_scalar("calibrated temperature", mod_compute.softmax_temperature.detach().cpu().numpy(), ctr)
-                    writer.add_scalar("calibrated temperature loss", loss.detach().cpu().numpy(), ctr)
+                metrics.add("calibrated temperature", mod_compute.softmax_temperature)
+                metrics.add("calibrated temperature loss", loss)
             if args.num_domains_for_domain_classifier > 1: ## We augment the main loss with the domain classifier loss
                 domain_classifier_logits = mod_compute.domain_classifier_logits
                 domain_classifier_lprobs = torch.nn.functional.log_softmax(domain_classifier_logits, dim=-1) ## Softmax tempering of logits if needed.
@@ -707,10 +793,14 @@ def model_create_load_run_save(gpu, args, train_files, dev_files):
                     domain_classifier_lprobs.view(-1,args.num_domains_for_domain_classifier), domain_classifier_labels.view(-1,1), args.label_smoothing
                 ) ## Label smoothed cross entropy loss. We are not going to do any temperature related stuff to this.
                 loss = domain_classifier_loss*args.domain_classifier_loss_weight + loss * (1.0-args.domain_classifier_loss_weight)
-                if rank == 0:
-                    writer.add_scalar("domain classifier loss", domain_classifier_loss.detach().cpu().numpy(), ctr)
-                    writer.add_scalar("loss with domain classifier loss", loss.detach().cpu().numpy(), ctr)
+                metrics.add("domain classifier loss", domain_classifier_loss)
+                metrics.add("loss with domain classifier loss", loss)
             ## We will do multilayer softmaxing without any consideration for distillation or domain classification.
+            if args.chunked_loss and mod_compute.additional_lm_hidden_states is not None:
+                for additional_hidden_states in mod_compute.additional_lm_hidden_states:
+                    loss_extra, entropy_extra = compute_lm_loss(model, additional_hidden_states, labels, tok.pad_token_id, args)
+                    loss += loss_extra*args.softmax_temperature ## Up scale loss in case of non unitary temperatures.
+                    entropy += entropy_extra
             if mod_compute.additional_lm_logits is not None:
                 for additional_logits in mod_compute.additional_lm_logits:
                     lprobs = torch.nn.functional.log_softmax(additional_logits, dim=-1) ## Softmax tempering of logits if needed.
@@ -723,39 +813,41 @@ def model_create_load_run_save(gpu, args, train_files, dev_files):
                     loss += loss_extra ## Up scale loss in case of non unitary temperatures. TODO: Perhaps log this too.
             if args.max_ent_weight != -1: ## This deals with softmax entropy maximization. The logic is that we compute the softmax entropy of the predictions via -(P(Y/X)*log(P(Y/X))). We then add it to the cross entropy loss with a negative sign as we wish to maximize entropy. This should penalize overconfident predictions. 
                 assert (args.max_ent_weight >= 0 and args.max_ent_weight <= 1)
-                logits = logits*args.softmax_temperature ## We have to undo the tempered logits else our entropy estimate will be wrong.
-                if args.temperature_calibration: 
-                    logits = logits*mod_compute.softmax_temperature
-                lprobs = torch.nn.functional.log_softmax(logits, dim=-1) ## No tempering here
-                entropy = -(torch.exp(lprobs)*lprobs).mean()
-                if rank == 0:
-                    writer.add_scalar("softmax entropy", entropy.detach().cpu().numpy(), ctr)
-                if mod_compute.additional_lm_logits is not None:
-                    for additional_logits in mod_compute.additional_lm_logits: ## Compute entropy for each layer as well
-                        additional_logits = additional_logits*args.softmax_temperature ## We have to undo the tempered logits else our entropy estimate will be wrong.
-                        if args.temperature_calibration: 
-                            additional_logits = additional_logits*mod_compute.softmax_temperature
-                        lprobs = torch.nn.functional.log_softmax(additional_logits, dim=-1) ## No tempering here
-                        entropy_extra = -(torch.exp(lprobs)*lprobs).mean()
-                        entropy += entropy_extra
+                if args.chunked_loss: ## The entropy was computed along with the loss.
+                    metrics.add("softmax entropy", entropy)
+                else:
+                    logits = logits*args.softmax_temperature ## We have to undo the tempered logits else our entropy estimate will be wrong.
+                    if args.temperature_calibration: 
+                        logits = logits*mod_compute.softmax_temperature
+                    lprobs = torch.nn.functional.log_softmax(logits, dim=-1) ## No tempering here
+                    entropy = -(torch.exp(lprobs)*lprobs).mean()
+                    metrics.add("softmax entropy", entropy)
+                    if mod_compute.additional_lm_logits is not None:
+                        for additional_logits in mod_compute.additional_lm_logits: ## Compute entropy for each layer as well
+                            additional_logits = additional_logits*args.softmax_temperature ## We have to undo the tempered logits else our entropy estimate will be wrong.
+                            if args.temperature_calibration: 
+                                additional_logits = additional_logits*mod_compute.softmax_temperature
+                            lprobs = torch.nn.functional.log_softmax(additional_logits, dim=-1) ## No tempering here
+                            entropy_extra = -(torch.exp(lprobs)*lprobs).mean()
+                            entropy += entropy_extra
                 loss = loss*(1-args.max_ent_weight) - entropy*args.max_ent_weight ## Maximize the entropy so a minus is needed. Weigh and add losses as required.
-                if rank == 0:
-                    writer.add_scalar("loss with entropy loss", loss.detach().cpu().numpy(), ctr)
+                metrics.add("loss with entropy loss", loss)
             if args.distillation: ## Time to distill.
                 if args.cross_distillation: ## The input ids and masks should be replaced with those appropriate for the parent.
                     input_ids = input_ids_parent
                     input_masks = input_masks_parent
-                with torch.no_grad(): ## No gradient to avoid memory allocation.
-                    parent_mod_compute = parent_model(input_ids=input_ids, attention_mask=input_masks ,decoder_input_ids=decoder_input_ids, output_hidden_states=args.distillation, output_attentions=args.distillation) ## Get the parent model's computations.
+                if teacher_cache is not None:
+                    parent_mod_compute = teacher_outputs
+                else:
+                    with torch.no_grad(): ## No gradient to avoid memory allocation.
+                        parent_mod_compute = parent_model(input_ids=input_ids, attention_mask=input_masks ,decoder_input_ids=decoder_input_ids, output_hidden_states=parent_output_hidden_states, output_attentions=parent_output_attentions, **segment_kwargs) ## Get the parent model's computations.
                 distillation_loss = compute_distillation_losses(mod_compute, parent_mod_compute, labels, tok.pad_token_id, args) ## Compute distillation losses.
                 loss = args.distillation_loss_weight*distillation_loss + (1.0 - args.distillation_loss_weight)*loss ## Update the main loss with weighing and adding.
-                if rank == 0:
-                    writer.add_scalar("distillation loss", distillation_loss.detach().cpu().numpy(), ctr)
-                    writer.add_scalar("final loss", loss.detach().cpu().numpy(), ctr)
+                metrics.add("distillation loss", distillation_loss)
+                metrics.add("final loss", loss)
             if args.use_moe or args.moe_adaptors: ## add MOE losses too.
                 moe_loss = torch.sum(torch.stack(mod_compute.encoder_moe_losses)) + torch.sum(torch.stack(mod_compute.decoder_moe_losses))
-                if rank == 0:
-                    writer.add_scalar("moe loss", moe_loss.detach().cpu().numpy(), ctr)
+                metrics.add("moe loss", moe_loss)
                 loss += moe_loss
 
         del input_ids ## Delete to avoid retention.
@@ -767,14 +859,14 @@ def model_create_load_run_save(gpu, args, train_files, dev_files):
             del input_masks_parent ## Delete to avoid retention.
         
         if ctr % 100 == 0 and rank  % 8 == 0:
-            fwd_memory = round(torch.cuda.memory_allocated(gpu)/(1024**3), 2)
+            fwd_memory = get_memory_allocated(gpu)
 
         ## Optimization part of the model from this point forward.
         if args.fp16: ## The gradient scaler needs to be invoked with FP16/AMP computation. ## With FP16/AMP computation we need to unscale gradients before clipping them. We then optimize and update the scaler.
             loss = loss/args.multistep_optimizer_steps
             scaler.scale(loss).backward()
             num_batches_this_optimizer_step += 1
-            losses += loss.detach().cpu().numpy()
+            losses += loss.detach() ## Stays on the device till it is printed.
             if num_batches_this_optimizer_step < args.multistep_optimizer_steps:
                 continue
             if args.max_gradient_clip_value != 0.0:
@@ -792,7 +884,7 @@ def model_create_load_run_save(gpu, args, train_files, dev_files):
             loss = loss/args.multistep_optimizer_steps
             loss.backward()
             num_batches_this_optimizer_step += 1
-            losses += loss.detach().cpu().numpy()
+            losses += loss.detach() ## Stays on the device till it is printed.
             if num_batches_this_optimizer_step < args.multistep_optimizer_steps:
                 continue
             if args.max_gradient_clip_value != 0.0:
@@ -803,10 +895,11 @@ def model_create_load_run_save(gpu, args, train_files, dev_files):
         losses = 0
         num_batches_this_optimizer_step = 0
         if ctr % 100 == 0 and rank  % 8 == 0: ## Print the current loss every 10 batches but only for the master/prime process.
-            bwd_memory=round(torch.cuda.memory_allocated(gpu)/(1024**3), 2)
+            bwd_memory=get_memory_allocated(gpu)
             end = time.time()
-            print(ctr, round(lv.item(),2), round(end-start, 2), "seconds for 100 batches. Memory used post forward / backward passes:", fwd_memory, "/", bwd_memory, "GB.")
+            print(ctr, round(lv.item(),2), round(end-start, 2), "seconds for 100 batches. Memory used post forward / backward passes:", fwd_memory, "/", bwd_memory, "GB.", round(data_wait_time, 2), "seconds were spent waiting for batches.")
             start = time.time()
+            data_wait_time = 0.0
             sys.stdout.flush()
         
         if ctr % args.eval_every == 0 and rank == 0 and args.save_weights_and_gradeint_info: ## Save the model weight and gradient info every time this condition is triggered.
@@ -815,9 +908,12 @@ def model_create_load_run_save(gpu, args, train_files, dev_files):
                     writer.add_histogram("weights."+param_name, param_value.detach().cpu().numpy(), ctr)
                     writer.add_histogram("gradients."+param_name, param_value.grad.detach().cpu().numpy(), ctr)
                 
+        if ctr % args.metrics_flush_every == 0:
+            metrics.flush(ctr)
         ctr += 1
         del mod_compute, loss
     
+    batch_prefetcher.close()
     if rank == 0:
         CHECKPOINT_PATH = args.model_path
         print("Saving the model after the final step")
@@ -827,11 +923,8 @@ def model_create_load_run_save(gpu, args, train_files, dev_files):
         if not args.no_eval:
             print("The best",metric, "using", scorertool,"was:", round(max_global_sbleu, 2))
             print("The corresponding step was:", max_global_sbleu_step*args.eval_every)
-        checkpoint_dict = {'model': model.state_dict(), 'optimizer': optimizer.state_dict(), 'scheduler': scheduler.state_dict(), 'ctr': ctr}
-        torch.save(checkpoint_dict, CHECKPOINT_PATH) ## Save one last time.
-        torch.save(model.module.state_dict(), CHECKPOINT_PATH+".pure_model") ## Pure model without any ddp markers or optimizer info.
-        if args.no_eval: # Save the last checkpoint to the deploy folder.
-            os.system("cp "+CHECKPOINT_PATH+".pure_model "+CHECKPOINT_PATH+"_deploy/pytorch_model.bin")
+        checkpoint_writer.save(model, optimizer, scheduler, ctr, CHECKPOINT_PATH, deploy_path=CHECKPOINT_PATH+"_deploy/pytorch_model.bin" if args.no_eval else None) ## Save one last time. The pure model has no ddp markers or optimizer info. Without evaluation the last checkpoint goes to the deploy folder.
+        checkpoint_writer.wait()
     dist.barrier() ## Wait till all processes reach this point so that the prime process saves the final checkpoint.
     dist.destroy_process_group() ## Everything that has a beginning has an end, Neo!
     
@@ -1034,6 +1127,64 @@ def run_demo():
                         help='What weight should we give to the domain classifier? 1 minus this weight will be given to the main loss.')
     parser.add_argument('--shard_files', action='store_true', 
                         help='Should we shard the training data? Set to true only if the data is not already pre-sharded.')
+    parser.add_argument('--tokenize_once', action='store_true', 
+                        help='Should we tokenize each training sentence exactly once? Truncation, masking, language indicator tokens, shifting and padding are then done on token ids instead of re-tokenizing (and decoding) the text several times per sentence. Sentences are truncated and masked at the word level using the subword word boundary markers, which gives the same words as splitting on spaces except for lines with tabs, non breaking spaces, runs of spaces or zero width joiners. check_tokenize_once.py and tests/test_tokenize_once.py compare the batches with the text based ones. Same restrictions as --use_binarized_corpora which is what you should use if you want to tokenize only once for the whole training.')
+    parser.add_argument('--virtual_sharding', action='store_true', 
+                        help='Should we avoid writing physical shards? If set then --shard_files only builds a byte offset line index next to each training file and each process reads its own range of lines directly from the original file. Saves disk space and sharding time for huge corpora. With --use_binarized_corpora, binarize the whole files without --num_shards and each process uses its own range of the offsets.')
+    parser.add_argument('--num_data_workers', default=0, type=int, 
+                        help='How many background processes per GPU should create batches? Each worker runs its own copy of the batch generator with a different seed and creates its share of the batches. If 0 then batches are created in the main process between optimizer steps. Look at the "data wait time" in tensorboard to decide if you need more workers.')
+    parser.add_argument('--data_queue_depth', default=8, type=int, 
+                        help='How many ready batches can be queued up by the background workers? Higher values smooth out slow batches but cost CPU memory.')
+    parser.add_argument('--bucketed_batching', action='store_true', 
+                        help='Should we batch with length buckets? A pool of examples is grouped into buckets of similar source and target lengths, each bucket is cut into batches which fill the batch size (or token budget) and the batches of the pool are shuffled. This greatly reduces padding compared to batching examples in the order in which they are sampled. Works only with --tokenize_once or --use_binarized_corpora because exact token lengths are needed. Look at the "padding efficiency" in tensorboard to tune it.')
+    parser.add_argument('--bucket_width', default=8, type=int, 
+                        help='How many tokens wide should each length bucket be? Smaller values mean less padding but more leftover examples waiting in half filled buckets.')
+    parser.add_argument('--bucketing_pool_size', default=100000, type=int, 
+                        help='How many examples should be pooled before they are bucketed and batched? Larger pools give fuller buckets and less padding but cost CPU memory.')
+    parser.add_argument('--pack_examples', action='store_true', 
+                        help='Should we pack several short examples into one row of the batch? Consecutive examples are concatenated until --pack_length tokens are reached on the source or target side. The model then uses block diagonal attention masks and restarts the positions for every packed example so that the examples do not attend to each other. For corpora of short sentences this greatly increases the number of useful tokens per batch. Works only with --tokenize_once or --use_binarized_corpora and MBart models. Incompatible with domain classifiers, encoder unification and contrastive decoder training.')
+    parser.add_argument('--pack_length', default=256, type=int, 
+                        help='What is the maximum number of tokens in a row of packed examples? Should not be more than the maximum number of positions of the model.')
+    parser.add_argument('--language_homogeneous_batches', action='store_true', 
+                        help='Should the batches contain sentences from a single language (pair)? Each sampled language is used for --language_run_length consecutive sentences so that a batch uses one set of language indicator tokens and has a similar length distribution. With --bucketed_batching every batch has exactly one language. Otherwise a batch may span the boundary between two runs. The overall language sampling ratios do not change.')
+    parser.add_argument('--language_run_length', default=256, type=int, 
+                        help='How many consecutive sentences should be drawn from a language before sampling a new one when using --language_homogeneous_batches? This should be at least the number of sentences in a batch.')
+    parser.add_argument('--checkpoint_sync_mode', default='reload', type=str, choices=['reload', 'none', 'checksum'], 
+                        help='How should the processes be synchronized after the prime process saves a checkpoint every eval_every steps? "reload" makes every process load the saved checkpoint (the old behavior). "none" skips this since DDP already keeps the model replicas identical. "checksum" broadcasts a cheap per parameter checksum from the prime process and reloads the checkpoint only if some process has diverged. The last two avoid reading the (large) checkpoint from every process which can stall training for minutes on shared file systems.')
+    parser.add_argument('--async_checkpointing', action='store_true', 
+                        help='Should checkpoints be written to disk in a background thread? The model, optimizer and scheduler states are copied to the CPU once and training continues while they are written. The pure model, the best/intermediate checkpoints and the deploy model are derived from the same copy and the extra copies are hardlinks. When --checkpoint_sync_mode is reload, the other processes still have to wait for the checkpoint to be written so use this with none or checksum.')
+    parser.add_argument('--distributed_eval', action='store_true', 
+                        help='Should all processes decode the dev sets during evaluation? Each process decodes a part of every dev set and the hypotheses are gathered so that the prime process can compute the scores. Without this the prime process decodes everything while the other processes wait.')
+    parser.add_argument('--dev_batch_tokens', default=0, type=int, 
+                        help='The maximum number of tokens (post padding) in a dev set batch during evaluation. The dev sentences are tokenized once, sorted by length and batched so that there is little padding. If 0 then each batch will have --dev_batch_size sentences instead.')
+    parser.add_argument('--chunked_loss', action='store_true', 
+                        help='Should the label smoothed cross entropy loss be computed a chunk of target tokens at a time? The model returns the decoder outputs instead of the logits and the LM head projection, the loss and (if needed) the softmax entropy are computed chunk by chunk with a custom backward pass. The [batch, target length, vocabulary] logits are never materialized which saves a lot of memory for large vocabularies and allows for larger batches. Applies to multilayer softmaxing and entropy maximization as well. Works only with MBart models. Incompatible with temperature calibration and distillation.')
+    parser.add_argument('--loss_chunk_size', default=1024, type=int, 
+                        help='The number of target tokens whose logits are computed at a time when using --chunked_loss. The peak memory for the logits is this times the vocabulary size.')
+    parser.add_argument('--teacher_cache_path', default='', type=str, 
+                        help='Should the parent outputs for distillation be read from a cache instead of running the parent model at every step? Each process stores the top-k log probabilities (and, for hidden layer regression, the hidden states of the mapped parent layers) of all the examples of its training shards in memory mapped files in a directory named by this path followed by a dot and the rank. If the cache does not exist, it is built by running the parent model (without dropout) once over the training data before training starts. The parent model is freed afterwards. Needs --tokenize_once or --use_binarized_corpora. Incompatible with cross distillation, multi source training, packing, encoder unification, source masking and attention distillation. The cache must be rebuilt when the training data, the number of processes, the truncation flags or the distillation temperature change.')
+    parser.add_argument('--teacher_cache_topk', default=64, type=int, 
+                        help='How many of the most likely tokens of the parent distribution should be cached for each target position? The parent distribution is renormalized over these tokens during distillation.')
+    parser.add_argument('--frozen_parent', action='store_true', 
+                        help='Should the parent model for distillation be an inference only teacher? It is not wrapped in DDP, its parameters are frozen and it is run in eval mode so that dropout is disabled. This saves the memory and time of the parent a lot. Look at --frozen_parent_dropout and --parent_precision for more options.')
+    parser.add_argument('--frozen_parent_dropout', action='store_true', 
+                        help='Should the frozen parent model be kept in train mode so that it uses dropout like the default parent?')
+    parser.add_argument('--parent_precision', default='fp32', type=str, choices=["fp32", "fp16", "int8"], 
+                        help='The precision of the frozen parent model weights. fp16 casts the parent to half precision. int8 stores the weights of the linear layers (except for the LM head) as int8 with a scale per output feature and dequantizes them on the fly which saves memory but not time. Only used with --frozen_parent.')
+    parser.add_argument('--distillation_topk', default=0, type=int, 
+                        help='If more than 0 then the cross entropy distillation loss only matches the parent distribution over its top-k tokens at each position, renormalized, instead of the whole vocabulary. The child log probabilities are only gathered for these tokens.')
+    parser.add_argument('--ewc_fisher_cache_dir', default='', type=str, 
+                        help='The directory in which the Fisher coefficients for elastic weight consolidation should be cached. The coefficients are saved under a hash of the initial model parameters and of the data and flags used to compute them, and are loaded instead of being recomputed whenever a later run starts from the same checkpoint with the same setup.')
+    parser.add_argument('--metrics_flush_every', default=100, type=int, 
+                        help='The training losses are summed on the GPU and their averages are written to tensorboard every these many steps. Bringing a loss to the CPU makes us wait for the GPU so doing it for every loss at every step slows down training. Use 1 to log the losses of every step.')
+    parser.add_argument('--reduce_metrics_across_ranks', action='store_true', 
+                        help='Should the logged training losses be averaged over all the processes instead of being those of the first process?')
+    parser.add_argument('--device', default='gpu', type=str, choices=["gpu", "cpu"], 
+                        help='Should we run on GPUs or on CPUs? With cpu, --gpus is the number of processes per node, the processes communicate with the gloo backend and the cores of the node are split among them.')
+    parser.add_argument('--num_threads_per_process', default=0, type=int, 
+                        help='The number of threads each process uses with --device cpu. 0 means the number of cores divided by the number of processes per node.')
+    parser.add_argument('--use_binarized_corpora', action='store_true', 
+                        help='Should we read the training data from memory mapped token id arrays created by binarize_corpus.py instead of tokenizing raw text on the fly? The binarized shards must exist for all training files (use the --num_shards argument of binarize_corpus.py) so dont pass --shard_files. Sentences are truncated and masked at the word level using the subword word boundary markers. Incompatible with stochastic tokenization, span prediction, document level denoising, multi source and cross distillation.')
     parser.add_argument('--multi_source', action='store_true', 
                         help='Are we doing multisource NMT? In that case you should specify the train_src as a hyphen separated pair indicating the parent language and the child language. You should also ensure that the source file is a tab separated file where each line contains "the parent pair source sentence[tab]child pair source sentence".')
     parser.add_argument('--multilayer_softmaxing', default=None, 
@@ -1130,6 +1281,8 @@ def run_demo():
                         help='Should we minimize the encoder representation distances instead of regular cross entropy minimization on the parallel corpus?')
     args = parser.parse_args()
     assert len(args.token_masking_probs_range) <= 2
+    assert not (args.device == "cpu" and args.fp16), "Mixed precision training needs a GPU."
+    assert not args.bucketed_batching or args.tokenize_once or args.use_binarized_corpora, "Bucketed batching needs exact token lengths. Use it with --tokenize_once or --use_binarized_corpora."
     print("IP address is", args.ipaddr)
     
     args.world_size = args.gpus * args.nodes                #
@@ -565,6 +565,8 @@ class Seq2SeqLMOutput(ModelOutput):
     domain_classifier_logits: Optional[torch.FloatTensor] = None
     encoder_moe_losses: Optional[Tuple[torch.FloatTensor]] = None ## Modified by Raj Dabre.
     decoder_moe_losses: Optional[Tuple[torch.FloatTensor]] = None ## Modified by Raj Dabre.
+    lm_hidden_states: Optional[torch.FloatTensor] = None ## The inputs to the LM head when the logits are computed in the loss function instead of the model.
+    additional_lm_hidden_states: Optional[Tuple[torch.FloatTensor]] = None ## Same as above but for multilayer softmaxing.
     ## Modified by Raj Dabre. End.
 
 @dataclass
@@ -85,9 +85,10 @@ def shift_tokens_right(input_ids: torch.Tensor, pad_token_id: int):
 
 
 # Copied from transformers.models.bart.modeling_bart._make_causal_mask
-def _make_causal_mask(input_ids_shape: torch.Size, dtype: torch.dtype, past_key_values_length: int = 0):
+def _make_causal_mask(input_ids_shape: torch.Size, dtype: torch.dtype, past_key_values_length: int = 0, segment_ids: Optional[torch.Tensor] = None):
     """
-    Make causal mask used for bi-directional self-attention.
+    Make causal mask used for bi-directional self-attention. If `segment_ids` of shape `[bsz, seq_len]` are given then the
+    mask is also block diagonal so that packed sequences do not attend to each other.
     """
     bsz, tgt_len = input_ids_shape
     mask = torch.full((tgt_len, tgt_len), torch.finfo(dtype).min) ## Changed here to -1e10 float("-inf") ## Modified by Raj Dabre.
@@ -97,19 +98,27 @@ def _make_causal_mask(input_ids_shape: torch.Size, dtype: torch.dtype, past_key_
 
     if past_key_values_length > 0:
         mask = torch.cat([torch.zeros(tgt_len, past_key_values_length, dtype=dtype), mask], dim=-1)
-    return mask[None, None, :, :].expand(bsz, 1, tgt_len, tgt_len + past_key_values_length)
+    mask = mask[None, None, :, :].expand(bsz, 1, tgt_len, tgt_len + past_key_values_length)
+    if segment_ids is not None: ## Packed sequences. Only used during training so there are no past key values.
+        mask = mask.to(segment_ids.device).masked_fill(segment_ids[:, None, :, None] != segment_ids[:, None, None, :], torch.finfo(dtype).min)
+    return mask
 
 
 ## Modified by Raj Dabre. Start.
 # Copied from transformers.models.bart.modeling_bart._expand_mask
-def _expand_mask(mask: torch.Tensor, dtype: torch.dtype, tgt_len: Optional[int] = None, wait_k: Optional[int] = -1, curr_decode_length: Optional[int] = -1):
+def _expand_mask(mask: torch.Tensor, dtype: torch.dtype, tgt_len: Optional[int] = None, wait_k: Optional[int] = -1, curr_decode_length: Optional[int] = -1, src_segment_ids: Optional[torch.Tensor] = None, tgt_segment_ids: Optional[torch.Tensor] = None):
     """
-    Expands attention_mask from `[bsz, seq_len]` to `[bsz, 1, tgt_seq_len, src_seq_len]`.
+    Expands attention_mask from `[bsz, seq_len]` to `[bsz, 1, tgt_seq_len, src_seq_len]`. If `src_segment_ids` of shape
+    `[bsz, src_seq_len]` are given then the mask is block diagonal so that a token of a packed sequence only attends to
+    the tokens of the same sequence. `tgt_segment_ids` default to `src_segment_ids` which is what self-attention needs.
     """
     bsz, src_len = mask.size()
     tgt_len = tgt_len if tgt_len is not None else src_len
 
     expanded_mask = mask[:, None, None, :].expand(bsz, 1, tgt_len, src_len).to(dtype)
+    if src_segment_ids is not None:
+        tgt_segment_ids = tgt_segment_ids if tgt_segment_ids is not None else src_segment_ids
+        expanded_mask = expanded_mask * (tgt_segment_ids[:, None, :, None] == src_segment_ids[:, None, None, :]).to(dtype)
     if wait_k != -1:
         if curr_decode_length == -1:
             expanded_mask = torch.tril(expanded_mask, wait_k-1) ## This causes the attention mask to be lower triangular to mask future tokens. If wait-k is k then the diagonal shift should be k-1.
@@ -119,6 +128,16 @@ def _expand_mask(mask: torch.Tensor, dtype: torch.dtype, tgt_len: Optional[int]
 
     return inverted_mask.masked_fill(inverted_mask.bool(), torch.finfo(dtype).min) # torch.finfo(dtype).min -1e10
 
+def _segment_positions(segment_ids: torch.Tensor):
+    """
+    Computes the position of every token within its packed sequence from `[bsz, seq_len]` segment ids so that the
+    positions restart from 0 for every sequence.
+    """
+    token_positions = torch.arange(segment_ids.size(1), device=segment_ids.device).expand_as(segment_ids)
+    segment_starts = torch.zeros_like(token_positions)
+    segment_starts[:, 1:] = token_positions[:, 1:] * (segment_ids[:, 1:] != segment_ids[:, :-1]).long()
+    return token_positions - torch.cummax(segment_starts, dim=1)[0]
+
 def cast_tuple(el):
     return el if isinstance(el, tuple) else (el,)
 
@@ -189,12 +208,13 @@ class MBartSinusoidalPositionalEmbedding(nn.Embedding):
         return out
 
     @torch.no_grad()
-    def forward(self, input_ids_shape: torch.Size, past_key_values_length: int = 0):
-        """`input_ids_shape` is expected to be [bsz x seqlen]."""
+    def forward(self, input_ids_shape: torch.Size, past_key_values_length: int = 0, positions: Optional[torch.Tensor] = None):
+        """`input_ids_shape` is expected to be [bsz x seqlen]. Explicit [bsz x seqlen] `positions` can be given for packed sequences."""
         bsz, seq_len = input_ids_shape[:2]
-        positions = torch.arange(
-            past_key_values_length, past_key_values_length + seq_len, dtype=torch.long, device=self.weight.device
-        )
+        if positions is None:
+            positions = torch.arange(
+                past_key_values_length, past_key_values_length + seq_len, dtype=torch.long, device=self.weight.device
+            )
         return super().forward(positions)
 
 ## Modified by Raj Dabre. End.
@@ -212,12 +232,13 @@ class MBartLearnedPositionalEmbedding(nn.Embedding):
         self.offset = 2
         super().__init__(num_embeddings + self.offset, embedding_dim, padding_idx=padding_idx)
 
-    def forward(self, input_ids_shape: torch.Size, past_key_values_length: int = 0):
-        """`input_ids_shape` is expected to be [bsz x seqlen]."""
+    def forward(self, input_ids_shape: torch.Size, past_key_values_length: int = 0, positions: Optional[torch.Tensor] = None):
+        """`input_ids_shape` is expected to be [bsz x seqlen]. Explicit [bsz x seqlen] `positions` can be given for packed sequences."""
         bsz, seq_len = input_ids_shape[:2]
-        positions = torch.arange(
-            past_key_values_length, past_key_values_length + seq_len, dtype=torch.long, device=self.weight.device
-        )
+        if positions is None:
+            positions = torch.arange(
+                past_key_values_length, past_key_values_length + seq_len, dtype=torch.long, device=self.weight.device
+            )
         return super().forward(positions + self.offset)
 
 
@@ -1198,6 +1219,7 @@ class MBartEncoder(MBartPreTrainedModel):
         deep_adaptor_tuning_ffn_only=False, ## Whether to use deep adaptor tuning only after ffn or not.
         parallel_adaptors=False, ## Whether to use parallel adaptors or not.
         moe_adaptors=False, ## Whether to use moe adaptors or not.
+        segment_ids=None, ## Segment ids of the packed sequences. 0 for padding.
     ):
         r"""
         Args:
@@ -1283,7 +1305,7 @@ class MBartEncoder(MBartPreTrainedModel):
             #     prompt_pos = self.embed_positions(prompt_shape, 0)
             #     embed_pos = self.embed_positions(input_shape, prompt_shape[1])
             # else:
-            embed_pos = self.embed_positions(input_shape)
+            embed_pos = self.embed_positions(input_shape, positions=_segment_positions(segment_ids) if segment_ids is not None else None) ## Positions restart for every packed sequence.
 
         hidden_states = inputs_embeds + embed_pos
         # if prompt_params is not None:
@@ -1313,7 +1335,7 @@ class MBartEncoder(MBartPreTrainedModel):
         if attention_mask is not None:
             # [bsz, seq_len] -> [bsz, 1, tgt_seq_len, src_seq_len]
             input_shape = inputs_embeds.size()[:-1]
-            attention_mask = _expand_mask(attention_mask, inputs_embeds.dtype, tgt_len=input_shape[1] if prompt_params is not None else None, wait_k=1 if self.config.wait_k!=-1 or self.config.unidirectional_encoder else -1) ## Raj: Just make the mask wait-k with a k=1 and we are good to go. We want to have a unidirectional encoder no matter what.
+            attention_mask = _expand_mask(attention_mask, inputs_embeds.dtype, tgt_len=input_shape[1] if prompt_params is not None else None, wait_k=1 if self.config.wait_k!=-1 or self.config.unidirectional_encoder else -1, src_segment_ids=segment_ids) ## Raj: Just make the mask wait-k with a k=1 and we are good to go. We want to have a unidirectional encoder no matter what.
         ## Modified by Raj Dabre. End.
 
         encoder_states = () if output_hidden_states else None
@@ -1465,13 +1487,13 @@ class MBartDecoder(MBartPreTrainedModel):
         self.embed_tokens = value
 
     # Copied from transformers.models.bart.modeling_bart.BartDecoder._prepare_decoder_attention_mask
-    def _prepare_decoder_attention_mask(self, attention_mask, input_shape, inputs_embeds, past_key_values_length): # prompting=False
+    def _prepare_decoder_attention_mask(self, attention_mask, input_shape, inputs_embeds, past_key_values_length, segment_ids=None): # prompting=False
         # create causal mask
         # [bsz, seq_len] -> [bsz, 1, tgt_seq_len, src_seq_len]
         combined_attention_mask = None
         if input_shape[-1] > 1:
             combined_attention_mask = _make_causal_mask(
-                input_shape, inputs_embeds.dtype, past_key_values_length=past_key_values_length
+                input_shape, inputs_embeds.dtype, past_key_values_length=past_key_values_length, segment_ids=segment_ids
             ).to(self.device)
             # if prompting:
             #     bsz, _, tgt_seq_len, src_seq_len = combined_attention_mask.size()
@@ -1479,7 +1501,7 @@ class MBartDecoder(MBartPreTrainedModel):
 
         if attention_mask is not None:
             # [bsz, seq_len] -> [bsz, 1, tgt_seq_len, src_seq_len]
-            expanded_attn_mask = _expand_mask(attention_mask, inputs_embeds.dtype, tgt_len=input_shape[-1])
+            expanded_attn_mask = _expand_mask(attention_mask, inputs_embeds.dtype, tgt_len=input_shape[-1], src_segment_ids=segment_ids)
             combined_attention_mask = (
                 expanded_attn_mask if combined_attention_mask is None else expanded_attn_mask + combined_attention_mask
             )
@@ -1510,6 +1532,8 @@ class MBartDecoder(MBartPreTrainedModel):
         deep_adaptor_tuning_ffn_only=False, ## Whether to use deep adaptor tuning after ffn only.
         parallel_adaptors=False, ## Whether to use parallel adaptors.
         moe_adaptors=False, ## Whether to use moe adaptors.
+        segment_ids=None, ## Segment ids of the packed target sequences. 0 for padding.
+        encoder_segment_ids=None, ## Segment ids of the packed source sequences. 0 for padding.
     ):
         r"""
         Args:
@@ -1614,14 +1638,14 @@ class MBartDecoder(MBartPreTrainedModel):
                 prompt_params[3][prompt_params_idx] = prompt_params[3][prompt_params_idx].repeat(batch_dims[0], 1, 1)# Repeat the embeddings for each batch
             
         attention_mask = self._prepare_decoder_attention_mask(
-            attention_mask, input_shape, inputs_embeds, past_key_values_length
+            attention_mask, input_shape, inputs_embeds, past_key_values_length, segment_ids=segment_ids
         ) ## Will be none if not training.
                 
         ## Modified by Raj Dabre. Start.
         # expand encoder attention mask
         if encoder_hidden_states is not None and encoder_attention_mask is not None:
             # [bsz, seq_len] -> [bsz, 1, tgt_seq_len, src_seq_len]
-            encoder_attention_mask = _expand_mask(encoder_attention_mask, inputs_embeds.dtype, tgt_len=input_shape[-1], wait_k=self.config.wait_k, curr_decode_length=curr_decode_length) ## Raj: Just make the mask wait-k and we are good to go. We wont deal with wait-k and prompts at the moment since it gets a bit tricky. TODO: Make prompts and wait-k work together. #  +(prompt_shape[1] if prompt_params is not None and (self.training or curr_decode_length == 1) else 0)
+            encoder_attention_mask = _expand_mask(encoder_attention_mask, inputs_embeds.dtype, tgt_len=input_shape[-1], wait_k=self.config.wait_k, curr_decode_length=curr_decode_length, src_segment_ids=encoder_segment_ids, tgt_segment_ids=segment_ids) ## Raj: Just make the mask wait-k and we are good to go. We wont deal with wait-k and prompts at the moment since it gets a bit tricky. TODO: Make prompts and wait-k work together. #  +(prompt_shape[1] if prompt_params is not None and (self.training or curr_decode_length == 1) else 0)
             if self.config.multi_source:
                 if additional_encoder_hidden_states is not None and additional_encoder_attention_mask is not None:
                     additional_encoder_attention_mask = _expand_mask(additional_encoder_attention_mask, inputs_embeds.dtype, tgt_len=input_shape[-1], wait_k=self.config.additional_source_wait_k, curr_decode_length=curr_decode_length) ## Raj: Just make the mask wait-k and we are good to go.
@@ -1638,7 +1662,7 @@ class MBartDecoder(MBartPreTrainedModel):
             if prompt_params is not None:
                 positions = self.embed_positions(inputs_embeds.size()) ## No matter what, the past key values length will be be properly updated.
             else:
-                positions = self.embed_positions(inputs_embeds.size(), past_key_values_length-num_prompts) ## No matter what, the past key values length will be be properly updated.
+                positions = self.embed_positions(inputs_embeds.size(), past_key_values_length-num_prompts, positions=_segment_positions(segment_ids) if segment_ids is not None else None) ## No matter what, the past key values length will be be properly updated. Positions restart for every packed sequence.
         hidden_states = inputs_embeds + positions
 
         # if prompt_params is not None:
@@ -1896,6 +1920,8 @@ class MBartModel(MBartPreTrainedModel):
         deep_adaptor_tuning_ffn_only=False,
         parallel_adaptors=False,
         moe_adaptors=False,
+        encoder_segment_ids=None,
+        decoder_segment_ids=None,
     ):
         output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
         output_hidden_states = (
@@ -1924,6 +1950,7 @@ class MBartModel(MBartPreTrainedModel):
                 deep_adaptor_tuning_ffn_only=deep_adaptor_tuning_ffn_only,
                 parallel_adaptors=parallel_adaptors,
                 moe_adaptors=moe_adaptors,
+                segment_ids=encoder_segment_ids,
             )
         # If the user passed a tuple for encoder_outputs, we wrap it in a BaseModelOutput when return_dict=True
         elif return_dict and not isinstance(encoder_outputs, BaseModelOutput):
@@ -2155,6 +2182,8 @@ class MBartModel(MBartPreTrainedModel):
             deep_adaptor_tuning_ffn_only=deep_adaptor_tuning_ffn_only,
             parallel_adaptors=parallel_adaptors,
             moe_adaptors=moe_adaptors,
+            segment_ids=decoder_segment_ids,
+            encoder_segment_ids=encoder_segment_ids,
         )
 
         # if prompt_params is not None and (self.training or curr_decode_length == 1):
@@ -2591,6 +2620,9 @@ class MBartForConditionalGeneration(MBartPreTrainedModel):
         curr_decode_length=-1,
         context_encoder_representations=None,
         label_mask=None,
+        encoder_segment_ids=None,
+        decoder_segment_ids=None,
+        return_lm_hidden_states=False,
     ):
         r"""
         labels (:obj:`torch.LongTensor` of shape :obj:`(batch_size, sequence_length)`, `optional`):
@@ -2635,6 +2667,8 @@ class MBartForConditionalGeneration(MBartPreTrainedModel):
                 deep_adaptor_tuning_ffn_only = self.config.deep_adaptor_tuning_ffn_only, 
                 parallel_adaptors=self.config.parallel_adaptors,
                 moe_adaptors=self.config.moe_adaptors,
+                encoder_segment_ids=encoder_segment_ids,
+                decoder_segment_ids=decoder_segment_ids,
             )
             if self.config.embed_low_rank_dim > 0: ## Downproject the LM head. Note that we cant create a linear layer whose weight is the transpose of the up projection layer of the encoder and decoder embeddings. This is why we resort to this approach. DIS IS DA WAE!
                 outputs["last_hidden_state"] = torch.nn.functional.linear(outputs[0], self.model.shared_proj.weight.T) ## Note the assignment is done with a string as key but when accesing it can be done with an integer index. Bizzarre!
@@ -2701,20 +2735,28 @@ class MBartForConditionalGeneration(MBartPreTrainedModel):
                 deep_adaptor_tuning_ffn_only = self.config.deep_adaptor_tuning_ffn_only,
                 parallel_adaptors=self.config.parallel_adaptors,
                 moe_adaptors=self.config.moe_adaptors,
+                encoder_segment_ids=encoder_segment_ids,
+                decoder_segment_ids=decoder_segment_ids,
             )
             if self.config.embed_low_rank_dim > 0: ## Downproject the LM head
                 outputs["last_hidden_state"] = torch.nn.functional.linear(outputs[0], self.model.shared_proj.weight.T)
-            lm_logits = (self.lm_head(outputs[0]) + self.final_logits_bias)/self.config.softmax_temperature ## Divide the logits by a temperature to get a smoothed softmax.
-            if self.config.temperature_calibration:
-                lm_logits = lm_logits/self.softmax_temperature
+            if return_lm_hidden_states: ## The logits will be computed chunk by chunk in the loss function so we dont compute them here.
+                lm_logits = None
+            else:
+                lm_logits = (self.lm_head(outputs[0]) + self.final_logits_bias)/self.config.softmax_temperature ## Divide the logits by a temperature to get a smoothed softmax.
+                if self.config.temperature_calibration:
+                    lm_logits = lm_logits/self.softmax_temperature
         
         additional_lm_logits = []
+        additional_lm_hidden_states = []
         if self.config.multilayer_softmaxing is not None:
             for layer_id in self.config.multilayer_softmaxing: ## We count the embedding layer too. Who knows what may happen? However we wont do anything for the final layer as its already dealt with.
                 lm_representation = outputs.decoder_hidden_states[layer_id]
                 if self.config.embed_low_rank_dim > 0: ## Downproject the LM head
                     lm_representation = torch.nn.functional.linear(lm_representation, self.model.shared_proj.weight.T)
-
+                if return_lm_hidden_states:
+                    additional_lm_hidden_states.append(lm_representation)
+                    continue
                 additional_lm_logits.append((self.lm_head(lm_representation) + self.final_logits_bias)/self.config.softmax_temperature) ## The additional logits will be collected here and then returned to my main code. Divide the logits by a temperature to get a smoothed softmax.
                 if self.config.temperature_calibration:
                     additional_lm_logits[-1] = additional_lm_logits[-1]/self.softmax_temperature ## The softmax_temperature config param should be 1.0
@@ -2757,6 +2799,8 @@ class MBartForConditionalGeneration(MBartPreTrainedModel):
             domain_classifier_logits = domain_classifier_logits if self.config.num_domains_for_domain_classifier > 1 else None,
             encoder_moe_losses = outputs.encoder_moe_losses, 
             decoder_moe_losses = outputs.decoder_moe_losses, 
+            lm_hidden_states = outputs[0] if return_lm_hidden_states else None,
+            additional_lm_hidden_states = additional_lm_hidden_states if return_lm_hidden_states else None,
         )
 
     def prepare_inputs_for_generation(